@@ -11,9 +11,10 @@ import numpy as np
 matplotlib.use("Qt5Agg")
 import matplotlib.pyplot as plt
 
-from libs.pascal_voc_io import PascalVocReader
+from libs.brush import Brush
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocReader
 from PyQt5.QtWidgets import QApplication
-from PyQt5.QtCore import QSize
+from PyQt5.QtCore import QRect, QSize
 
 
 def parse():
@@ -25,22 +26,26 @@ def parse():
     height = int(root.xpath("/annotation/size/height")[0].text)
     size = QSize(width, height)
 
-    categories = (
-        ("Objects", "object"),
-        ("Suction Regions", "suction_region")
-    )
-    reader = PascalVocReader(args.file, categories)
+    reader = PascalVocReader(args.file, LABEL_CATEGORIES)
     raw_shapes = reader.getShapes()
 
     shapes = defaultdict(list)
 
-    for cat_id, shape in loadLabels(raw_shapes, categories):
+    for cat_id, shape in loadLabels(raw_shapes, LABEL_CATEGORIES):
         shapes[cat_id].append(shape)
-        mask = np.copy(shape.get_unoccluded_mask(size))
+        # Only the part of the image around the shape
+        rect = shape.boundingRect()
+        if isinstance(shape, Brush):
+            rect.translate(-shape.offset)
+        rect = rect.toAlignedRect().intersected(QRect(0, 0, size.width(), size.height()))
+        if rect.isEmpty():
+            continue
+        window = (rect.left(), rect.top(), rect.right() + 1, rect.bottom() + 1)
+        mask = np.copy(shape.get_unoccluded_mask(size, window))
 
         plt.figure()
         plt.title(f"{cat_id} {shape.label} {repr(shape.attributes)}")
-        plt.imshow(mask)
+        plt.imshow(mask, extent=(window[0], window[2], window[3], window[1]))
         plt.show()
 
 
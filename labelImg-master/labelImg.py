@@ -42,8 +42,11 @@ from libs.attributesDialog import AttributesDialog
 from libs.colorDialog import ColorDialog
 from libs.labelFile import LabelFile, LabelFileError
 from libs.toolBar import ToolBar
-from libs.pascal_voc_io import PascalVocReader
-from libs.pascal_voc_io import XML_EXT
+from libs.pascal_voc_io import LABEL_CATEGORIES, XML_EXT
+from libs.annotationCache import AnnotationCache
+from libs.corpusIndex import CorpusIndex, index_path
+from libs.corpusRefresher import CorpusRefresher
+from libs.saveWorker import SaveWorker
 from libs.ustr import ustr
 
 __appname__ = 'labelImg'
@@ -108,10 +111,10 @@ def loadLabels(shapes, labelCategories):
                 for x, y in points:
                     shape.addPoint(QPointF(x, y))
             elif type == 'brush':
-                size, offset, history = points
+                size, offset, history, mask = points
                 shape = Brush(
                     size=QSize(size[0], size[1]), label=label, attributes=attributes, history=history,
-                    offset=QPointF(offset[0], offset[1])
+                    offset=QPointF(offset[0], offset[1]), mask=mask
                 )
             else:
                 raise NotImplementedError
@@ -119,6 +122,38 @@ def loadLabels(shapes, labelCategories):
             shape.close()
             yield cat_id, shape
 
+
+def shapeSnapshot(shape):
+    """A shape as a plain dict, as taken by LabelFile.pascalVocWriter."""
+    if isinstance(shape, Polygon):
+        return dict(
+            type="polygon",
+            label=shape.label,
+            attributes=list(shape.attributes),
+            points=[(p.x(), p.y()) for p in shape.points],
+        )
+    elif isinstance(shape, Shape):
+        return dict(
+            type="rect",
+            label=shape.label,
+            attributes=list(shape.attributes),
+            points=[(p.x(), p.y()) for p in shape.points],
+        )
+    elif isinstance(shape, Brush):
+        x, y, mask = shape.croppedMask()
+        return dict(
+            type="brush",
+            label=shape.label,
+            attributes=list(shape.attributes),
+            size=(shape.size.width(), shape.size.height()),
+            history=list(shape.history),
+            offset=(shape.offset.x(), shape.offset.y()),
+            mask=(x, y, mask.copy()),
+        )
+    else:
+        raise NotImplementedError
+
+
 class LoginWindow(QWidget):
     show_project_win_signal = pyqtSignal()
     def __init__(self):
@@ -215,6 +250,24 @@ class MainWindow(QMainWindow, WindowMixin):
         # Whether we need to save or not.
         self.dirty = False
 
+        # Parsed annotations, so revisiting an unchanged image skips the XML parse
+        self.annotationCache = AnnotationCache()
+
+        # Annotation files are serialized and written off the UI thread
+        self.saveWorker = SaveWorker(self)
+        self.saveWorker.saved.connect(self.annotationSaved)
+        self.saveWorker.failed.connect(self.annotationSaveFailed)
+        # Content hash of what each annotation file holds, see savedDigest
+        self.savedDigests = {}
+        # Image of every annotation file queued for writing, marked labeled once it is written
+        self.savingImages = {}
+
+        # Summary of the annotations of the opened directory, see openDir
+        self.corpusIndex = None
+        # Background refresh of the index and the file list rows of every annotation path
+        self.corpusRefresher = None
+        self.annotationRows = {}
+
         # clip board for copying / pasting shapes
         self.clipBoardShapes = None
 
@@ -362,6 +415,9 @@ class MainWindow(QMainWindow, WindowMixin):
         openPrevImg = action('&Prev Image', self.openPrevImg,
                              'a', 'prev', u'Open Prev')
 
+        openNextUnverifiedImg = action('Next &Unverified Image', self.openNextUnverifiedImg,
+                                       'Shift+D', 'next', u'Open the next image that is not verified yet')
+
         save = action('&Save', self.saveFile,
                       'Ctrl+S', 'save', u'Save labels to file', enabled=True)
         saveAs = action('&Save As', self.saveFileAs,
@@ -402,6 +458,12 @@ class MainWindow(QMainWindow, WindowMixin):
         eraseBrush = action('Start Erasing', self.eraseBrush,
                             'e', 'new', u'Erase regions from Brush', enabled=False)
 
+        undoBrushStroke = action('Undo Stroke', self.undoBrushStroke,
+                                 'Ctrl+Z', 'undo', u'Undo the last brush stroke')
+
+        redoBrushStroke = action('Redo Stroke', self.redoBrushStroke,
+                                 'Ctrl+Shift+Z', 'undo', u'Redo the last undone brush stroke')
+
         copyAllShapes = action('Copy Shapes', self.copyAllShapes,
                                'Ctrl+C', 'copy', u'Copy all annotations to the clipboard', enabled=False)
 
@@ -410,6 +472,10 @@ class MainWindow(QMainWindow, WindowMixin):
                                 u'Paste all (and overwrite any existing) annotations in the clipboard',
                                 enabled=False)
 
+        brushToPolygons = action('Brush to Polygons', self.brushToPolygons,
+                                 None, 'edit', u'Replace the selected brush by polygons traced from it',
+                                 enabled=False)
+
         delete = action('Delete', self.deleteSelectedShape,
                         'Delete', 'delete', u'Delete', enabled=False)
         # copy = action('&Duplicate\nRectBox', self.copySelectedShape,
@@ -513,6 +579,9 @@ class MainWindow(QMainWindow, WindowMixin):
                               eraseBrush=eraseBrush,
                               copyAllShapes=copyAllShapes,
                               pasteAllShapes=pasteAllShapes,
+                              brushToPolygons=brushToPolygons,
+                              undoBrushStroke=undoBrushStroke,
+                              redoBrushStroke=redoBrushStroke,
                               # createMode=createMode, editMode=editMode,
                               # advancedMode=advancedMode,
                               shapeLineColor=shapeLineColor, shapeFillColor=shapeFillColor,
@@ -524,10 +593,14 @@ class MainWindow(QMainWindow, WindowMixin):
                               beginner=(),  # advanced=(),
                               editMenu=(edit,
                                         # copy,
+                                        undoBrushStroke,
+                                        redoBrushStroke,
+                                        brushToPolygons,
                                         delete,
                                         None),
                               beginnerContext=(createPolygon, copyAllShapes, pasteAllShapes, edit,
                                                # copy,
+                                               brushToPolygons,
                                                delete),
                               # advancedContext=(createMode, editMode, edit, copy,
                               #                  delete, shapeLineColor, shapeFillColor),
@@ -559,7 +632,7 @@ class MainWindow(QMainWindow, WindowMixin):
 
         addActions(self.menus.file,
                    (open, opendir, changeSavedir, openAnnotation, self.menus.recentFiles, save, saveAs, close, None,
-                    quit))
+                    openNextUnverifiedImg, None, quit))
         addActions(self.menus.view, (
             self.autoSaving,
             # self.singleClassMode,
@@ -931,6 +1004,14 @@ class MainWindow(QMainWindow, WindowMixin):
             self.actions.copyAllShapes.setEnabled(False)
             self.actions.pasteAllShapes.setEnabled(False)
 
+    def undoBrushStroke(self):
+        if self.canvas.undoBrushStroke():
+            self.setDirty()
+
+    def redoBrushStroke(self):
+        if self.canvas.redoBrushStroke():
+            self.setDirty()
+
     def toggleDrawingSensitive(self, drawing=True):
         """In the middle of drawing, toggling between modes should be disabled."""
         if not drawing:
@@ -1041,6 +1122,7 @@ class MainWindow(QMainWindow, WindowMixin):
             self.actions.eraseBrush.setEnabled(False)
 
         self.actions.delete.setEnabled(selected)
+        self.actions.brushToPolygons.setEnabled(selected and isinstance(self.canvas.selectedShape, Brush))
         self.actions.edit.setEnabled(selected)
         self.actions.editAttributes.setEnabled(selected)
         self.actions.shapeLineColor.setEnabled(selected)
@@ -1075,49 +1157,38 @@ class MainWindow(QMainWindow, WindowMixin):
             ss[cat_id].append(shape)
         self.canvas.loadShapes(ss)
 
+    def shapesSnapshot(self):
+        """
+            Copy the canvas shapes into plain dicts as taken by LabelFile.pascalVocWriter.
+        """
+        return {
+            categoryId: [shapeSnapshot(shape) for shape in self.canvas.getSortedShapes(categoryId)]
+            for _, categoryId in self.labelCategories
+        }
+
     def saveLabels(self, annotationFilePath):
         annotationFilePath = ustr(annotationFilePath)
         if self.labelFile is None:
             self.labelFile = LabelFile()
             self.labelFile.verified = self.canvas.verified
 
-        def format_shape(s):
-            if isinstance(s, Polygon):
-                return dict(
-                    type="polygon",
-                    label=s.label,
-                    attributes=s.attributes,
-                    points=[(p.x(), p.y()) for p in s.points],
-                )
-            elif isinstance(s, Shape):
-                return dict(
-                    type="rect",
-                    label=s.label,
-                    attributes=s.attributes,
-                    points=[(p.x(), p.y()) for p in s.points],
-                )
-            elif isinstance(s, Brush):
-                return dict(
-                    type="brush",
-                    label=s.label,
-                    attributes=s.attributes,
-                    size=(s.size.width(), s.size.height()),
-                    history=s.history,
-                    offset=(s.offset.x(), s.offset.y()),
-                )
-            else:
-                raise NotImplementedError
-
-        shapes = {
-            categoryId: [format_shape(shape) for shape in self.canvas.getSortedShapes(categoryId)]
-            for _, categoryId in self.labelCategories
-        }
-
         # Can add differrent annotation formats here
         try:
             if self.usingPascalVocFormat is True:
-                self.labelFile.savePascalVocFormat(annotationFilePath, shapes, self.filePath, self.imageData,
-                                                   self.labelCategories)
+                shapes = self.shapesSnapshot()
+                # The writer holds an immutable snapshot of the shapes, so it
+                # can be serialized while the user keeps editing
+                writer = self.labelFile.pascalVocWriter(shapes, self.filePath, self.labelCategories,
+                                                        image=self.image)
+                digest = LabelFile.shapesDigest(shapes, self.labelCategories, writer.verified, writer.getHeader())
+                if ((os.path.isfile(annotationFilePath) or self.saveWorker.isPending(annotationFilePath))
+                        and digest == self.savedDigest(annotationFilePath)):
+                    # Saving would write what the file already holds, so
+                    # leave it (and its mtime) alone
+                    self.status('No changes to save to %s' % annotationFilePath)
+                    return True
+                self.saveWorker.submit(annotationFilePath, writer.save)
+                self.savedDigests[os.path.abspath(annotationFilePath)] = digest
             else:
                 raise NotImplementedError
                 self.labelFile.save(annotationFilePath, shapes, self.filePath, self.imageData,
@@ -1128,6 +1199,25 @@ class MainWindow(QMainWindow, WindowMixin):
                               u'<b>%s</b>' % e)
             return False
 
+    def savedDigest(self, annotationFilePath):
+        """
+            LabelFile.shapesDigest of what annotationFilePath holds: the last
+            snapshot written to it or else its shapes as they load onto the
+            canvas, None when it cannot be read.
+        """
+        key = os.path.abspath(annotationFilePath)
+        if key not in self.savedDigests:
+            try:
+                shapes, verified, header = self.annotationCache.read(key, self.labelCategories)
+            except Exception:
+                # An unreadable file is simply written again
+                return None
+            loaded = defaultdict(list)
+            for categoryId, shape in loadLabels(shapes, self.labelCategories):
+                loaded[categoryId].append(shapeSnapshot(shape))
+            self.savedDigests[key] = LabelFile.shapesDigest(loaded, self.labelCategories, verified, header)
+        return self.savedDigests[key]
+
     def copySelectedShape(self):
         self.addLabel(self.canvas.copySelectedShape())
         # fix copy and delete
@@ -1418,6 +1508,13 @@ class MainWindow(QMainWindow, WindowMixin):
     def closeEvent(self, event):
         if not self.mayContinue():
             event.ignore()
+            return
+        self.saveWorker.wait()
+        if self.saveWorker.failedPaths() and not self.discardFailedSavesDialog():
+            event.ignore()
+            return
+        self.saveWorker.shutdown()
+        self.stopCorpusRefresh()
         s = self.settings
         # If it loads images from dir, don't load it at the begining
         if self.dirname is None:
@@ -1475,6 +1572,10 @@ class MainWindow(QMainWindow, WindowMixin):
         if dirpath is not None and len(dirpath) > 1:
             self.defaultSaveDir = dirpath
 
+        # The annotations now come from another directory
+        if self.mImgList:
+            self.refreshCorpusIndex()
+
         self.statusBar().showMessage('%s . Annotation will be saved to %s' %
                                      ('Change saved folder', self.defaultSaveDir))
         self.statusBar().show()
@@ -1522,16 +1623,70 @@ class MainWindow(QMainWindow, WindowMixin):
         self.mImgList = self.scanAllImages(dirpath)
         self.openNextImg()
         for imgPath in self.mImgList:
-            if os.path.exists(os.path.splitext(imgPath)[0] + '.xml'):
-                item = QListWidgetItem(imgPath + ' (labeled)')
-            else:
-                item = QListWidgetItem(imgPath)
-            self.fileListWidget.addItem(item)
+            self.fileListWidget.addItem(QListWidgetItem(imgPath))
+        self.refreshCorpusIndex()
 
             # if len(self.mImgList) > 0:
             #     import ipdb; ipdb.set_trace()
             #     self.loadFile(self.mImgList[0])
 
+    def annotationPathFor(self, imgPath):
+        """Absolute path of the annotation file saved for imgPath."""
+        basename = os.path.splitext(os.path.basename(imgPath))[0] + XML_EXT
+        if self.defaultSaveDir is not None and len(ustr(self.defaultSaveDir)):
+            return os.path.abspath(os.path.join(ustr(self.defaultSaveDir), basename))
+        return os.path.abspath(os.path.join(os.path.dirname(imgPath), basename))
+
+    def refreshCorpusIndex(self):
+        """
+            Open the index of the current directory and its save dir and
+            mark the files it already knows as labeled. Changed annotations
+            are re-read in the background, see corpusIndexUpdated.
+        """
+        key = '%s|%s' % (self.dirname, self.defaultSaveDir or '')
+        if self.corpusIndex is None or self.corpusIndex.dbPath != index_path(key):
+            if self.corpusIndex is not None:
+                self.corpusIndex.close()
+            self.corpusIndex = CorpusIndex(index_path(key), self.labelCategories)
+        # Batches of the previous refresh are ignored from here on
+        self.stopCorpusRefresh(wait=False)
+
+        self.annotationRows = {}
+        for row, imgPath in enumerate(self.mImgList):
+            self.annotationRows.setdefault(self.annotationPathFor(imgPath), []).append(row)
+        labeled = self.corpusIndex.paths()
+        for row, imgPath in enumerate(self.mImgList):
+            labeledText = ' (labeled)' if self.annotationPathFor(imgPath) in labeled else ''
+            self.fileListWidget.item(row).setText(imgPath + labeledText)
+
+        directories = set(os.path.dirname(path) for path in self.annotationRows)
+        refresher = CorpusRefresher(self.corpusIndex.dbPath, self.labelCategories, directories, parent=self)
+        refresher.updated.connect(partial(self.corpusIndexUpdated, refresher))
+        refresher.failed.connect(partial(self.corpusIndexFailed, refresher))
+        self.corpusRefresher = refresher
+        refresher.start()
+
+    def stopCorpusRefresh(self, wait=True):
+        if self.corpusRefresher is not None:
+            self.corpusRefresher.cancel()
+            if wait:
+                self.corpusRefresher.wait()
+            self.corpusRefresher = None
+
+    def corpusIndexUpdated(self, refresher, paths, removed):
+        if refresher is not self.corpusRefresher:
+            # A batch of a refresh that was since replaced
+            return
+        for labeled, annotationPaths in ((True, paths), (False, removed)):
+            for path in annotationPaths:
+                for row in self.annotationRows.get(path, ()):
+                    imgPath = self.mImgList[row]
+                    self.fileListWidget.item(row).setText(imgPath + ' (labeled)' if labeled else imgPath)
+
+    def corpusIndexFailed(self, refresher, message):
+        if refresher is self.corpusRefresher:
+            self.status('Could not index the annotations: %s' % message)
+
     def verifyImg(self, _value=False):
         # Proceding next image without dialog if having any label
         if self.filePath is not None:
@@ -1591,6 +1746,25 @@ class MainWindow(QMainWindow, WindowMixin):
         if filename:
             self.loadFile(filename)
 
+    def openNextUnverifiedImg(self, _value=False):
+        if self.autoSaving.isChecked() and self.defaultSaveDir is not None:
+            if self.dirty is True:
+                self.saveFile()
+
+        if not self.mayContinue():
+            return
+
+        if len(self.mImgList) <= 0 or self.corpusIndex is None:
+            return
+
+        start = self.mImgList.index(self.filePath) + 1 if self.filePath in self.mImgList else 0
+        verified = self.corpusIndex.verifiedPaths()
+        for filename in self.mImgList[start:] + self.mImgList[:start]:
+            if filename != self.filePath and self.annotationPathFor(filename) not in verified:
+                self.loadFile(filename)
+                return
+        self.status('Every image is verified')
+
     def openFile(self, _value=False):
         if not self.mayContinue():
             return
@@ -1642,10 +1816,48 @@ class MainWindow(QMainWindow, WindowMixin):
     def _saveFile(self, annotationFilePath):
         if annotationFilePath and self.saveLabels(annotationFilePath):
             self.setClean()
-            self.statusBar().showMessage('Saved to  %s' % annotationFilePath)
+            if self.saveWorker.isPending(annotationFilePath):
+                # Only labeled once the file is actually written, see annotationSaved
+                self.savingImages[os.path.abspath(annotationFilePath)] = self.filePath
+                self.statusBar().showMessage('Saving to  %s' % annotationFilePath)
+            else:
+                self.setLabeled(self.filePath, True)
             self.statusBar().show()
-        index = self.mImgList.index(self.filePath)
-        self.fileListWidget.item(index).setText(self.filePath + " (labeled)")
+
+    def setLabeled(self, imgPath, labeled):
+        if imgPath not in self.mImgList:
+            return
+        index = self.mImgList.index(imgPath)
+        self.fileListWidget.item(index).setText(imgPath + " (labeled)" if labeled else imgPath)
+
+    def annotationSaved(self, annotationFilePath):
+        self.annotationCache.invalidate(annotationFilePath)
+        if self.corpusIndex is not None:
+            self.corpusIndex.update(annotationFilePath)
+        imgPath = self.savingImages.pop(os.path.abspath(annotationFilePath), None)
+        if imgPath is not None:
+            self.setLabeled(imgPath, True)
+        self.statusBar().showMessage('Saved to  %s' % annotationFilePath)
+        self.statusBar().show()
+
+    def annotationSaveFailed(self, annotationFilePath, message):
+        key = os.path.abspath(annotationFilePath)
+        self.savedDigests.pop(key, None)
+        imgPath = self.savingImages.get(key)
+        if imgPath is not None:
+            self.setLabeled(imgPath, False)
+            if imgPath == self.filePath:
+                # The edits on screen are not on disk after all
+                self.setDirty()
+        retry, discard = QMessageBox.Retry, QMessageBox.Discard
+        answer = QMessageBox.critical(self, u'Error saving label data',
+                                      u'<p><b>Error saving label data</b></p><b>%s</b><p>%s</p>'
+                                      u'<p>Retry writing these annotations?</p>' % (message, annotationFilePath),
+                                      retry | discard)
+        if answer == retry and self.saveWorker.retry(annotationFilePath):
+            return
+        self.saveWorker.discard(annotationFilePath)
+        self.savingImages.pop(key, None)
 
     def closeFile(self, _value=False):
         if not self.mayContinue():
@@ -1664,6 +1876,12 @@ class MainWindow(QMainWindow, WindowMixin):
         msg = u'You have unsaved changes, proceed anyway?'
         return yes == QMessageBox.warning(self, u'Attention', msg, yes | no)
 
+    def discardFailedSavesDialog(self):
+        yes, no = QMessageBox.Yes, QMessageBox.No
+        msg = u'Some annotations could not be written:<br>%s<br>Quit and lose them?' % (
+            u'<br>'.join(self.saveWorker.failedPaths()))
+        return yes == QMessageBox.warning(self, u'Attention', msg, yes | no)
+
     def errorMessage(self, title, message):
         return QMessageBox.critical(self, title,
                                     '<p><b>%s</b></p>%s' % (title, message))
@@ -1703,6 +1921,32 @@ class MainWindow(QMainWindow, WindowMixin):
             for action in self.actions.onShapesPresent:
                 action.setEnabled(False)
 
+    def brushToPolygons(self):
+        brush = self.canvas.selectedShape
+        if not isinstance(brush, Brush):
+            return
+        polygons = brush.toPolygons()
+        if not polygons:
+            self.status('The brush is empty')
+            return
+        self.remLabel(self.canvas.deleteSelected())
+        for geom in polygons:
+            shape = Polygon(label=brush.label, attributes=brush.attributes)
+            for x, y in geom.exterior.coords[:-1]:
+                shape.addPoint(QPointF(x, y))
+            shape.close()
+            self.canvas.currentShapes.append(shape)
+            self.addLabel(self.currentCategoryId, shape)
+        holes = sum(len(geom.interiors) for geom in polygons)
+        if holes:
+            # Polygon shapes have no holes
+            self.status('Traced %d polygons, %d holes filled' % (len(polygons), holes))
+        else:
+            self.status('Traced %d polygons' % len(polygons))
+        self.actions.brushToPolygons.setEnabled(False)
+        self.canvas.update()
+        self.setDirty()
+
     def chshapeLineColor(self):
         color = self.colorDialog.getColor(self.lineColor, u'Choose line color',
                                           default=DEFAULT_LINE_COLOR)
@@ -1766,13 +2010,17 @@ class MainWindow(QMainWindow, WindowMixin):
     def loadPascalXMLByFilename(self, xmlPath, labelCategories):
         if self.filePath is None:
             return
+        # Never read a file while a newer snapshot of it is still being written
+        self.saveWorker.wait(xmlPath)
         if os.path.isfile(xmlPath) is False:
             return
 
-        tVocParseReader = PascalVocReader(xmlPath, labelCategories)
-        shapes = tVocParseReader.getShapes()
+        shapes, verified, _ = self.annotationCache.read(xmlPath, labelCategories)
         self.loadLabels(shapes)
-        self.canvas.verified = tVocParseReader.verified
+        self.canvas.verified = verified
+        # The file holds brush histories compacted, so what was last saved
+        # digests differently once loaded; digest the file as it loads instead
+        self.savedDigests.pop(os.path.abspath(xmlPath), None)
 
 
 class Settings(object):
@@ -1835,10 +2083,7 @@ def get_main_app(argv=[]):
     win = MainWindow(
         os.path.join('predefined_classes.txt'),
         os.path.join('predefined_attributes.txt'),
-        labelCategories=(
-            ("Objects", "object"),
-            ("Suction Regions", "suction_region")
-        )
+        labelCategories=LABEL_CATEGORIES
     )
     # win.show()
     #win.queueEvent(partial(win.openDir, dirpath="/nfs1/data/general_object_suction_picking/mrcnn_finetune_05102018/"))
@@ -1866,10 +2111,7 @@ if __name__ == '__main__':
     mainWin = MainWindow(
         os.path.join('predefined_classes.txt'),
         os.path.join('predefined_attributes.txt'),
-        labelCategories=(
-            ("Objects", "object"),
-            ("Suction Regions", "suction_region")
-        )
+        labelCategories=LABEL_CATEGORIES
     )
     subWin = LoginWindow()
     projectWin = ProjectListWindow()
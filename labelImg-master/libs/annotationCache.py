@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import struct
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from libs.pascal_voc_io import PascalVocReader, pack_history, unpack_history
+from libs.rle import rle_decode, rle_encode
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Bumped whenever the encoding below changes, older sidecars are then ignored
+SIDECAR_MAGIC = b'LHAC3'
+SIDECAR_EXT = '.annc'
+# An entry is the magic, the uint32 length of a UTF-8 JSON document, then the
+# arrays it lists (RLE masks, packed brush histories) back to back
+_LENGTH = struct.Struct('<I')
+
+
+def _encodeMask(mask, arrays):
+    if mask is None:
+        return None
+    x, y, cropped = mask
+    height, width = cropped.shape
+    arrays.append(rle_encode(cropped).astype('<u4'))
+    return [int(x), int(y), height, width, len(arrays) - 1]
+
+
+def _decodeMask(mask, arrays):
+    if mask is None:
+        return None
+    x, y, height, width, i = mask
+    return x, y, rle_decode(arrays[i], (height, width))
+
+
+def encodeEntry(key, shapes, verified, header):
+    """Serialize a PascalVocReader result without pickle, see decodeEntry."""
+    arrays = []
+    objects = {}
+    for categoryId, categoryShapes in shapes.items():
+        encoded = objects[categoryId] = []
+        for label, attributes, points, typ in categoryShapes:
+            if typ == 'brush':
+                size, offset, history, mask = points
+                checkpoint = None
+                if history and history[0][0] == 'checkpoint':
+                    checkpoint = _encodeMask(history[0][1], arrays)
+                    history = history[1:]
+                arrays.append(pack_history(history))
+                points = dict(size=size, offset=offset, history=len(arrays) - 1, checkpoint=checkpoint,
+                              mask=_encodeMask(mask, arrays))
+            encoded.append([label, list(attributes), points, typ])
+    document = json.dumps(dict(
+        key=json.dumps(key), verified=verified, header=header, shapes=objects,
+        arrays=[[array.dtype.str, list(array.shape)] for array in arrays],
+    )).encode('utf-8')
+    return b''.join([SIDECAR_MAGIC, _LENGTH.pack(len(document)), document] + [array.tobytes() for array in arrays])
+
+
+def decodeEntry(data):
+    """Return (key, (shapes, verified, header)) from encodeEntry output, raising ValueError when it is not one."""
+    if data[:len(SIDECAR_MAGIC)] != SIDECAR_MAGIC:
+        raise ValueError('not an annotation cache entry')
+    start = len(SIDECAR_MAGIC) + _LENGTH.size
+    length, = _LENGTH.unpack_from(data, len(SIDECAR_MAGIC))
+    document = json.loads(data[start:start + length].decode('utf-8'))
+    arrays = []
+    offset = start + length
+    for dtype, shape in document['arrays']:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        arrays.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape))
+        offset += count * dtype.itemsize
+
+    shapes = defaultdict(list)
+    for categoryId, categoryShapes in document['shapes'].items():
+        for label, attributes, points, typ in categoryShapes:
+            if typ == 'brush':
+                history = unpack_history(arrays[points['history']])
+                if points['checkpoint'] is not None:
+                    history.insert(0, ('checkpoint', _decodeMask(points['checkpoint'], arrays)))
+                points = (tuple(points['size']), tuple(points['offset']), history,
+                          _decodeMask(points['mask'], arrays))
+            else:
+                points = [tuple(point) for point in points]
+            shapes[categoryId].append((label, attributes, points, typ))
+    folder, filename, path, size = document['header']
+    header = (folder, filename, path, None if size is None else tuple(size))
+    return document['key'], (shapes, document['verified'], header)
+
+
+class AnnotationCache(object):
+    """
+        Parsed PascalVocReader results keyed on (path, mtime, size).
+
+        Entries are kept encoded (see encodeEntry), both in an in-memory LRU
+        bounded by maxBytes and, when sidecarDir is set, in one binary file
+        per XML.
+    """
+
+    def __init__(self, maxBytes=DEFAULT_MAX_BYTES, sidecarDir=None):
+        self.maxBytes = maxBytes
+        self.sidecarDir = sidecarDir
+        self.hits = 0
+        self.sidecarHits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def read(self, xmlPath, labelCategories):
+        """Return (shapes, verified, header) for xmlPath, parsing it only on a miss."""
+        path = os.path.abspath(xmlPath)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size, tuple(labelCategories))
+
+        payload = self._entries.get(key)
+        if payload is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return decodeEntry(payload)[1]
+
+        payload = self._readSidecar(key)
+        if payload is not None:
+            self.sidecarHits += 1
+        else:
+            self.misses += 1
+            reader = PascalVocReader(path, labelCategories)
+            payload = encodeEntry(key, reader.getShapes(), reader.verified, reader.getHeader())
+            self._writeSidecar(payload)
+        self._store(key, payload)
+        return decodeEntry(payload)[1]
+
+    def invalidate(self, xmlPath):
+        path = os.path.abspath(xmlPath)
+        for key in [k for k in self._entries if k[0] == path]:
+            self._bytes -= len(self._entries.pop(key))
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits, sidecarHits=self.sidecarHits, misses=self.misses,
+                    entries=len(self._entries), bytes=self._bytes, maxBytes=self.maxBytes)
+
+    def _store(self, key, payload):
+        if len(payload) > self.maxBytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = payload
+        self._bytes += len(payload)
+        while self._bytes > self.maxBytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def _sidecarPath(self, path):
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest() + SIDECAR_EXT
+        return os.path.join(self.sidecarDir, name)
+
+    def _readSidecar(self, key):
+        if self.sidecarDir is None:
+            return None
+        try:
+            with open(self._sidecarPath(key[0]), 'rb') as f:
+                payload = f.read()
+            storedKey, _ = decodeEntry(payload)
+        except (OSError, ValueError, KeyError, IndexError, TypeError, struct.error):
+            return None
+        return payload if storedKey == json.dumps(key) else None
+
+    def _writeSidecar(self, payload):
+        if self.sidecarDir is None:
+            return
+        target = self._sidecarPath(json.loads(decodeEntry(payload)[0])[0])
+        tmp = target + '.tmp'
+        try:
+            os.makedirs(self.sidecarDir, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp, target)
+        except OSError:
+            # The sidecar is only an optimisation
+            pass
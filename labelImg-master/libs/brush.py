@@ -8,11 +8,44 @@ except ImportError:
 
 import numpy as np
 
+from libs.brush_undo import BrushStroke
+from libs.contour import mask_polygons
+from libs.mask_storage import CroppedMask, TiledMask
+from libs.raster import capsule_window, dilate_mask, disc_window
+
 
 def point_to_tuple(pt):
     return (pt.x(), pt.y())
 
 
+# Set1 from matplotlib, for the brushes labelled Rank1 to Rank9:
+#     color_list = plt.cm.Set1(np.linspace(0, 1, 9))
+#     color_list = [(x*255).astype(int).tolist()[:3] for x in color_list]
+RANK_COLORS = [QColor(*rgb) for rgb in [[228, 26, 28],
+                                        [55, 126, 184],
+                                        [77, 175, 74],
+                                        [152, 78, 163],
+                                        [255, 127, 0],
+                                        [255, 255, 51],
+                                        [166, 86, 40],
+                                        [247, 129, 191],
+                                        [153, 153, 153]]]
+
+# Brushes are drawn half transparent over the image
+OVERLAY_ALPHA = 128
+
+
+def overlay_from_mask(mask, color):
+    """Build a QPixmap the size of a 2d bool mask, color where it is set and transparent elsewhere."""
+    height, width = mask.shape
+    # Premultiplied ARGB, one uint32 per pixel
+    a = OVERLAY_ALPHA
+    pixel = (a << 24) | (color.red() * a // 255 << 16) | (color.green() * a // 255 << 8) | color.blue() * a // 255
+    data = np.where(mask, np.uint32(pixel), np.uint32(0))
+    image = QImage(data.data, width, height, 4 * width, QImage.Format_ARGB32_Premultiplied)
+    return QPixmap.fromImage(image)
+
+
 # class SerializableBitmap(QBitmap):
 #
 #     def __setstate__(self, state):
@@ -33,19 +66,27 @@ class Brush(object):
     highlightColor = QColor(220, 0, 0)
     highlightBorderColor = QColor(220, 220, 220)
     fillColor = QColor(0, 220, 0)
+    # Width of the outline drawn around filled brushes
+    boundaryWidth = 2
+    # Images with at least this many pixels store brushes as sparse tiles
+    tiledArea = 8192 * 8192
 
-    def __init__(self, size, label=None, attributes=(), history=(), offset=None):
+    def __init__(self, size, label=None, attributes=(), history=(), offset=None, mask=None):
         self.label = label
         self.attributes = attributes
         self.size = size
-        self.bitmap = QBitmap(size)
-        self.bitmap.clear()
-        self.boundaryBitmap = QBitmap(size)
-        self.boundaryBitmap.clear()
-        self._image = None
+        # Only the region around the painted pixels is stored
+        storage = TiledMask if size.width() * size.height() >= self.tiledArea else CroppedMask
+        self._storage = storage(size.width(), size.height())
+        # (name, key) -> (version, rgba, pixmap) of the drawn blocks
+        self._overlays = {}
         self._rect = None
-        self._mask = None
-        self.painter = QPainter()
+        # Bounding box (x0, y0, x1, y1) of the set pixels as of the last close()
+        self._box = None
+        # Region (x0, y0, x1, y1) edited since the last close(), None when clean
+        self._dirty = None
+        # Pixels under the stroke being drawn, as they were before it
+        self._stroke = None
         self.selected = False
         self.fill = False
         if offset is None:
@@ -53,7 +94,10 @@ class Brush(object):
         else:
             self.offset = offset
         self.history = list(history)
-        self.loadHistory(history)
+        if mask is None:
+            self.loadHistory(history)
+        else:
+            self.loadMask(mask)
 
     def __getstate__(self):
         return dict(
@@ -62,15 +106,12 @@ class Brush(object):
             attributes=self.attributes,
             history=self.history,
             offset=self.offset,
-            _mask=self._mask,
-            _rect=self._rect,
+            mask=self.croppedMask(),
         )
 
     def __setstate__(self, state):
         self.__init__(size=state['size'], label=state['label'], attributes=state['attributes'],
-                      history=state['history'], offset=state['offset'])
-        self._mask = state['_mask']
-        self._rect = state['_rect']
+                      history=state['history'], offset=state['offset'], mask=state['mask'])
 
     @property
     def labelWithAttributes(self):
@@ -79,17 +120,97 @@ class Brush(object):
         else:
             return self.label
 
+    def loadMask(self, mask):
+        self._loadCropped(mask)
+        self.close()
+
+    def _loadCropped(self, mask):
+        x, y, cropped = mask
+        cropped = np.asarray(cropped, dtype=bool)
+        self._storage.load(x, y, cropped)
+        self._edited((0, 0, self.size.width(), self.size.height()))
+
+    def _edited(self, window):
+        x0, y0, x1, y1 = window
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.size.width()), min(y1, self.size.height())
+        if x1 <= x0 or y1 <= y0:
+            return
+        if self._dirty is not None:
+            x0, y0 = min(x0, self._dirty[0]), min(y0, self._dirty[1])
+            x1, y1 = max(x1, self._dirty[2]), max(y1, self._dirty[3])
+        self._dirty = (x0, y0, x1, y1)
+
+    def dirtyRect(self):
+        """Region edited since the last close(), in image coordinates, or None."""
+        if self._dirty is None:
+            return None
+        x0, y0, x1, y1 = self._dirty
+        return QRectF(x0 + self.offset.x(), y0 + self.offset.y(), x1 - x0, y1 - y0)
+
+    def beginStroke(self):
+        """Start recording the pixels the following strokes paint over, until endStroke()."""
+        start = max(len(self.history) - 1, 0)
+        # The last entry goes too, addPolyline may extend it
+        self._stroke = dict(window=None, pixels=None, historyStart=start, historyTail=self.history[start:])
+
+    def endStroke(self):
+        """Return a BrushStroke that undoes everything painted since beginStroke(), or None."""
+        stroke, self._stroke = self._stroke, None
+        if stroke is None or stroke['window'] is None:
+            return None
+        return BrushStroke(self, stroke['window'], stroke['pixels'], stroke['historyStart'], stroke['historyTail'])
+
+    def swapStroke(self, stroke):
+        """Exchange the pixels and history of the brush with those saved in stroke."""
+        x0, y0, x1, y1 = stroke.window
+        current = self._storage.region(stroke.window)
+        self._storage.paste(x0, y0, stroke.pixels())
+        stroke.packed = np.packbits(current)
+        tail = self.history[stroke.historyStart:]
+        self.history[stroke.historyStart:] = stroke.historyTail
+        stroke.historyTail = tail
+        self._edited((x0 - self.boundaryWidth, y0 - self.boundaryWidth,
+                      x1 + self.boundaryWidth, y1 + self.boundaryWidth))
+
+    def _saveUnder(self, window):
+        """Remember the pixels in window before the stroke being recorded changes them."""
+        stroke = self._stroke
+        if stroke is None:
+            return
+        x0, y0, x1, y1 = window
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.size.width()), min(y1, self.size.height())
+        if x1 <= x0 or y1 <= y0:
+            return
+        saved = stroke['window']
+        if saved is not None:
+            if x0 >= saved[0] and y0 >= saved[1] and x1 <= saved[2] and y1 <= saved[3]:
+                return
+            x0, y0 = min(x0, saved[0]), min(y0, saved[1])
+            x1, y1 = max(x1, saved[2]), max(y1, saved[3])
+            # Grow with slack, like CroppedMask, so a long stroke copies
+            # its pixels a logarithmic number of times
+            marginX, marginY = (saved[2] - saved[0]) // 2, (saved[3] - saved[1]) // 2
+            x0, y0 = max(x0 - marginX, 0), max(y0 - marginY, 0)
+            x1, y1 = min(x1 + marginX, self.size.width()), min(y1 + marginY, self.size.height())
+        # Nothing outside the saved window has been painted yet
+        pixels = self._storage.region((x0, y0, x1, y1))
+        if saved is not None:
+            pixels[saved[1] - y0:saved[3] - y0, saved[0] - x0:saved[2] - x0] = stroke['pixels']
+        stroke['window'], stroke['pixels'] = (x0, y0, x1, y1), pixels
+
     def addPoint(self, point, radius, erasing, record_history=True):
-        if erasing:
-            self._addPoint(point, self.bitmap, radius, Qt.color0)
-            self._addPoint(point, self.boundaryBitmap, radius - 2, Qt.color0)
-        else:
-            self._addPoint(point, self.bitmap, radius, Qt.color1)
-            self._addPoint(point, self.boundaryBitmap, radius + 2, Qt.color1)
+        center = point_to_tuple(point)
+        self._saveUnder(disc_window(center, radius))
+        self._storage.stampDisc(center, radius, not erasing)
+        # The outline around the stroke changes too
+        self._edited(disc_window(center, radius + self.boundaryWidth))
         if record_history:
-            self.history.append(('addPoint', (point_to_tuple(point), radius, erasing)))
+            self.history.append(('addPoint', (center, radius, erasing)))
 
     def loadHistory(self, history):
+        """Paint history onto the brush."""
         for hist_type, hist_data in history:
             if hist_type == 'addPoint':
                 point, radius, erasing = hist_data
@@ -100,92 +221,141 @@ class Brush(object):
                 pos1 = QPointF(pos1[0], pos1[1])
                 pos2 = QPointF(pos2[0], pos2[1])
                 self.addLine(pos1, pos2, radius, erasing, record_history=False)
+            elif hist_type == 'addPolyline':
+                points, radius, erasing = hist_data
+                self.addPolyline([QPointF(*point) for point in points], radius, erasing, record_history=False)
+            elif hist_type == 'checkpoint':
+                # Mask of all the strokes compacted away, see brush_history
+                self._loadCropped(hist_data)
             else:
                 raise ValueError(f"Unrecognized history type {hist_type}")
 
-    def _addPoint(self, point, bitmap, radius, color):
-        p = self.painter
-        p.begin(bitmap)
-        p.setPen(color)
-        p.setBrush(color)
-        p.drawEllipse(point, radius, radius)
-        p.end()
-
     def addLine(self, pos1, pos2, radius, erasing, record_history=True):
-        if erasing:
-            self._addLine(pos1, pos2, self.bitmap, radius, Qt.color0)
-            self._addLine(pos1, pos2, self.boundaryBitmap, radius - 2, Qt.color0)
-        else:
-            self._addLine(pos1, pos2, self.bitmap, radius, Qt.color1)
-            self._addLine(pos1, pos2, self.boundaryBitmap, radius + 2, Qt.color1)
+        pos1, pos2 = point_to_tuple(pos1), point_to_tuple(pos2)
+        self._saveUnder(capsule_window(pos1, pos2, radius))
+        self._storage.stampCapsule(pos1, pos2, radius, not erasing)
+        self._edited(capsule_window(pos1, pos2, radius + self.boundaryWidth))
         if record_history:
-            self.history.append(('addLine', (point_to_tuple(pos1), point_to_tuple(pos2), radius, erasing)))
-
-    def _addLine(self, pos1, pos2, bitmap, radius, color):
-        p = self.painter
-        p.begin(bitmap)
-        pen = QPen()
-        pen.setColor(color)
-        pen.setWidth(radius * 2)
-        pen.setCapStyle(Qt.RoundCap)
-        p.setPen(pen)
-        p.setBrush(color)
-        p.drawLine(pos1, pos2)
-        p.end()
-
-    def _paint(self, p, bitmap, color):
-        pen = QPen(color)
-        p.setPen(pen)
-        bgMode = p.backgroundMode()
-        p.setOpacity(0.5)
-        p.setBackgroundMode(Qt.TransparentMode)
-        p.drawPixmap(self.offset.x(), self.offset.y(), bitmap)
-        p.setBackgroundMode(bgMode)
-
-    def paint(self, p, scale=None, prev_shapes=None):
+            self.history.append(('addLine', (pos1, pos2, radius, erasing)))
+
+    def addPolyline(self, points, radius, erasing, record_history=True):
+        """Paint connected segments; a polyline continuing the last one recorded extends it."""
+        points = [point_to_tuple(point) for point in points]
+        for pos1, pos2 in zip(points, points[1:]):
+            self._saveUnder(capsule_window(pos1, pos2, radius))
+            self._storage.stampCapsule(pos1, pos2, radius, not erasing)
+            self._edited(capsule_window(pos1, pos2, radius + self.boundaryWidth))
+        if not record_history or len(points) < 2:
+            return
+        if self.history:
+            hist_type, hist_data = self.history[-1]
+            if hist_type == 'addPolyline' and hist_data[0][-1] == points[0] and hist_data[1:] == (radius, erasing):
+                self.history[-1] = ('addPolyline', (hist_data[0] + points[1:], radius, erasing))
+                return
+        self.history.append(('addPolyline', (points, radius, erasing)))
+
+    def _version(self, name, key):
+        if name == 'mask':
+            return self._storage.version(key)
+        return self._storage.outlineVersion(key)
 
+    def _overlay(self, name, key, data, color):
         """
-        import matplotlib.pyplot as plt
-        import numpy as np
-        color_list = plt.cm.Set1(np.linspace(0, 1, 9))
-        color_list = [(x*255).astype(int).tolist()[:3] for x in color_list]
-        color_list
+            Coloured pixmap of one mask or outline block, rebuilt only when
+            the block or its colour changed. Outlines are derived from the
+            mask here, on first use.
         """
+        version = self._version(name, key)
+        rgba = color.rgba()
+        cached = self._overlays.get((name, key))
+        if cached is None or cached[:2] != (version, rgba):
+            if data is None:
+                data = self._storage.outline(key, self.boundaryWidth)
+            cached = (version, rgba, overlay_from_mask(data, color) if data.any() else None)
+            self._overlays[name, key] = cached
+        return cached[2]
+
+    def _exposedWindow(self, p):
+        """Part of the brush, in its own coordinates, that the painter can reach."""
+        if p.hasClipping():
+            rect = p.clipBoundingRect()
+        else:
+            transform, invertible = p.worldTransform().inverted()
+            if not invertible:
+                return None
+            rect = transform.mapRect(QRectF(p.viewport()))
+        return (int(np.floor(rect.left() - self.offset.x())), int(np.floor(rect.top() - self.offset.y())),
+                int(np.ceil(rect.right() - self.offset.x())) + 1, int(np.ceil(rect.bottom() - self.offset.y())) + 1)
+
+    def _paint(self, p, name, color):
+        box = self._storage.bbox()
+        if box is None:
+            # Erased down to nothing, there is no block worth an overlay
+            return
+        # Blocks away from the painted pixels, e.g. left empty by an erase,
+        # get no overlay either
+        radius = 0 if name == 'mask' else self.boundaryWidth
+        window = (box[0] - radius, box[1] - radius, box[2] + radius, box[3] + radius)
+        exposed = self._exposedWindow(p)
+        if exposed is not None:
+            window = (max(window[0], exposed[0]), max(window[1], exposed[1]),
+                      min(window[2], exposed[2]), min(window[3], exposed[3]))
+            if window[2] <= window[0] or window[3] <= window[1]:
+                return
+        if name == 'mask':
+            blocks = self._storage.blocks(window)
+        else:
+            blocks = ((key, x, y, None) for key, x, y in self._storage.outlineBlocks(self.boundaryWidth, window))
+        for key, x, y, data in blocks:
+            pixmap = self._overlay(name, key, data, color)
+            if pixmap is not None:
+                p.drawPixmap(QPointF(self.offset.x() + x, self.offset.y() + y), pixmap)
 
-        color_list = [[228, 26, 28],
-                     [55, 126, 184],
-                     [77, 175, 74],
-                     [152, 78, 163],
-                     [255, 127, 0],
-                     [255, 255, 51],
-                     [166, 86, 40],
-                     [247, 129, 191],
-                     [153, 153, 153]]
-
-        fillColor = self.fillColor
+    def color(self):
         if self.label is not None and self.label.startswith("Rank"):
-            fillColor = QColor(*color_list[int(self.label[4])-1])
+            return RANK_COLORS[int(self.label[4]) - 1]
+        return self.fillColor
 
+    def paint(self, p, scale=None, prev_shapes=None, occlusion=None):
         if self.fill:
-            self._paint(p, self.boundaryBitmap, self.highlightBorderColor)
-            self._paint(p, self.bitmap, fillColor)
-        else:
-            self._paint(p, self.bitmap, fillColor)
+            self._paint(p, 'boundary', self.highlightBorderColor)
+        self._paint(p, 'mask', self.color())
 
     def highlightClear(self):
         pass
 
+    def _bbox(self):
+        if self._dirty is None and self._rect is not None:
+            return self._box
+        return self._storage.bbox()
+
     def containsPoint(self, pos):
-        assert self._mask is not None
         x = int(pos.x() - self.offset.x())
         y = int(pos.y() - self.offset.y())
-        if x < 0 or y < 0 or x >= self._mask.shape[1] or y >= self._mask.shape[0]:
+        box = self._bbox()
+        if box is None or not (box[0] <= x < box[2] and box[1] <= y < box[3]):
             return False
-        return self._mask[y, x]
+        return self._storage.contains(x, y)
+
+    def containsPoints(self, points):
+        """containsPoint() for a sequence of QPointF or an (n, 2) array of image coordinates at once."""
+        if not isinstance(points, np.ndarray):
+            points = [point_to_tuple(point) for point in points]
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        xs = (points[:, 0] - self.offset.x()).astype(np.int64)
+        ys = (points[:, 1] - self.offset.y()).astype(np.int64)
+        inside = np.zeros(len(points), dtype=bool)
+        box = self._bbox()
+        if box is None:
+            return inside
+        hit = np.flatnonzero((xs >= box[0]) & (xs < box[2]) & (ys >= box[1]) & (ys < box[3]))
+        inside[hit] = self._storage.containsPoints(xs[hit], ys[hit])
+        return inside
 
     def boundingRect(self):
+        """QRectF in image coordinates like Shape.boundingRect; moved brushes may have a fractional offset."""
         assert self._rect is not None
-        return QRect(
+        return QRectF(
             self._rect.x() + self.offset.x(),
             self._rect.y() + self.offset.y(),
             self._rect.width(),
@@ -196,26 +366,38 @@ class Brush(object):
         self.offset += offset
 
     def close(self):
-        # self.bitmap.
-        self._image = self.bitmap.toImage().convertToFormat(QImage.Format_Indexed8)
-        ptr = self._image.constBits()
-        ptr.setsize(self._image.byteCount())
-        mask = np.frombuffer(ptr, count=self._image.byteCount(), dtype=np.uint8).reshape(
-            self._image.height(), self._image.bytesPerLine())[:self._image.height(), :self._image.width()]
-        xs, ys = np.where(mask)
-        if len(xs) == 0:
-            min_x = 0
-            min_y = 0
-            max_x = 0
-            max_y = 0
+        if self._dirty is None and self._rect is not None:
+            return
+        self._dirty = None
+        # Give back the slack reserved while painting
+        self._storage.compact()
+        for name, key in list(self._overlays):
+            if self._version(name, key) != self._overlays[name, key][0]:
+                del self._overlays[name, key]
+        bbox = self._box = self._storage.bbox()
+        if bbox is None:
+            self._rect = QRect(0, 0, 0, 0)
         else:
-            min_x = xs.min()
-            min_y = ys.min()
-            max_x = xs.max()
-            max_y = ys.max()
-        self._mask = mask
-        self._rect = QRect(min_x, min_y, max_x - min_x, max_y - min_y)
-
-    def get_unoccluded_mask(self, size):
-        assert tuple(self._mask.shape) == (size.height(), size.width())
-        return self._mask
+            x0, y0, x1, y1 = bbox
+            self._rect = QRect(x0, y0, x1 - x0 - 1, y1 - y0 - 1)
+
+    def croppedMask(self):
+        """Return (x, y, mask) for the bounding box of the painted pixels."""
+        self.close()
+        return self._storage.crop()
+
+    def toPolygons(self, tolerance=1.0, minArea=0):
+        """Trace the painted pixels into shapely Polygons with holes, in image coordinates."""
+        x, y, cropped = self.croppedMask()
+        return mask_polygons(cropped, x + self.offset.x(), y + self.offset.y(), tolerance=tolerance, minArea=minArea)
+
+    def get_unoccluded_mask(self, size, window=None):
+        """
+            Painted pixels as uint8, over the whole size or only the window
+            (x0, y0, x1, y1) given, so a small brush on a large image does
+            not cost a full size array.
+        """
+        assert (size.height(), size.width()) == (self.size.height(), self.size.width())
+        if window is None:
+            return self._storage.full().view(np.uint8)
+        return self._storage.region(window).view(np.uint8)
@@ -0,0 +1,181 @@
+import numpy as np
+
+from libs.raster import replay_history, stamp_stroke, stroke_window
+from libs.rle import crop_mask
+
+# Default number of strokes a compacted history may hold after its checkpoint
+DEFAULT_CHECKPOINT_INTERVAL = 256
+# Dropping redundant strokes repeats until nothing changes, or this many passes
+DEFAULT_MAX_PASSES = 4
+
+
+def _footprint(hist_type, hist_data, window):
+    """
+        Pixels a stroke touches inside window, as (slices, mask) where
+        slices index the window and mask only covers the stroke itself.
+    """
+    x0, y0, x1, y1 = window
+    sx0, sy0, sx1, sy1 = stroke_window(hist_type, hist_data)
+    sx0, sy0 = max(sx0, x0), max(sy0, y0)
+    sx1, sy1 = max(min(sx1, x1), sx0), max(min(sy1, y1), sy0)
+    mask = np.zeros((sy1 - sy0, sx1 - sx0), dtype=bool)
+    stamp_stroke(mask, hist_type, hist_data, value=True, origin=(sx0, sy0))
+    return (slice(sy0 - y0, sy1 - y0), slice(sx0 - x0, sx1 - x0)), mask
+
+
+def _split_checkpoint(history):
+    if history and history[0][0] == 'checkpoint':
+        return history[0], list(history[1:])
+    return None, list(history)
+
+
+def _history_window(checkpoint, strokes, width, height):
+    """
+        Pixel rectangle (x0, y0, x1, y1) of the image that checkpoint and
+        strokes may touch, or None when they cannot touch it at all.
+    """
+    windows = [stroke_window(*stroke) for stroke in strokes]
+    if checkpoint is not None:
+        x, y, cropped = checkpoint[1]
+        h, w = cropped.shape
+        if h and w:
+            windows.append((x, y, x + w, y + h))
+    if not windows:
+        return None
+    x0 = max(min(w[0] for w in windows), 0)
+    y0 = max(min(w[1] for w in windows), 0)
+    x1 = min(max(w[2] for w in windows), width)
+    y1 = min(max(w[3] for w in windows), height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
+
+
+def _replay_window(history, window):
+    x0, y0, x1, y1 = window
+    return replay_history(history, y1 - y0, x1 - x0, origin=(x0, y0))
+
+
+def drop_redundant(history, width, height, maxPasses=DEFAULT_MAX_PASSES):
+    """
+        Remove strokes that do not change the final mask: strokes that
+        paint only pixels already set, erase only unset pixels, or are
+        entirely painted or erased over again by later strokes.
+    """
+    checkpoint, strokes = _split_checkpoint(history)
+    if not strokes:
+        return list(history)
+    # Only the pixels the strokes touch matter, the rest of the mask is
+    # never allocated
+    window = _history_window(None, strokes, width, height)
+    if window is None:
+        return [checkpoint] if checkpoint else []
+    start = _replay_window([checkpoint] if checkpoint else [], window)
+    footprints = [_footprint(hist_type, hist_data, window) for hist_type, hist_data in strokes]
+    keep = np.ones(len(strokes), dtype=bool)
+
+    # Dropping a stroke can make others redundant, e.g. an erase of a dot
+    # that was itself painted over, so repeat until nothing changes
+    for _ in range(maxPasses):
+        kept = np.count_nonzero(keep)
+
+        # Forward: strokes that leave the mask as it was
+        mask = start.copy()
+        for i in np.flatnonzero(keep):
+            region, footprint = footprints[i]
+            if strokes[i][1][-1]:
+                keep[i] = (mask[region] & footprint).any()
+                mask[region] &= ~footprint
+            else:
+                keep[i] = (footprint & ~mask[region]).any()
+                mask[region] |= footprint
+
+        # Backward: strokes whose every pixel is overwritten later on
+        covered = np.zeros_like(mask)
+        for i in np.flatnonzero(keep)[::-1]:
+            region, footprint = footprints[i]
+            if not (footprint & ~covered[region]).any():
+                keep[i] = False
+            covered[region] |= footprint
+
+        if np.count_nonzero(keep) == kept:
+            break
+
+    return ([checkpoint] if checkpoint else []) + [stroke for stroke, k in zip(strokes, keep) if k]
+
+
+def merge_polylines(history):
+    """Merge runs of connected addLine strokes with the same radius and mode into addPolyline strokes."""
+    merged = []
+    for hist_type, hist_data in history:
+        if hist_type == 'addLine' and merged:
+            pos1, pos2, radius, erasing = hist_data
+            prev_type, prev_data = merged[-1]
+            if prev_type == 'addLine' and prev_data[1] == pos1 and prev_data[2:] == (radius, erasing):
+                merged[-1] = ('addPolyline', ([prev_data[0], pos1, pos2], radius, erasing))
+                continue
+            if prev_type == 'addPolyline' and prev_data[0][-1] == pos1 and prev_data[1:] == (radius, erasing):
+                merged[-1] = ('addPolyline', (prev_data[0] + [pos2], radius, erasing))
+                continue
+        merged.append((hist_type, hist_data))
+    return merged
+
+
+def simplify_polyline(points, tolerance):
+    """
+        Ramer-Douglas-Peucker: drop the points of a polyline that lie within
+        tolerance of the simplified one. The end points are always kept.
+    """
+    pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    keep = np.zeros(len(pts), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(pts) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        seg = pts[j] - pts[i]
+        rel = pts[i + 1:j] - pts[i]
+        # Distance to the segment rather than the line, so strokes that
+        # double back on themselves keep their turning point
+        lengthSq = seg.dot(seg)
+        t = np.clip(rel.dot(seg) / lengthSq, 0, 1) if lengthSq else np.zeros(len(rel))
+        dist = np.hypot(*(rel - t[:, None] * seg).T)
+        k = int(np.argmax(dist))
+        if dist[k] > tolerance:
+            keep[i + 1 + k] = True
+            stack.extend(((i, i + 1 + k), (i + 1 + k, j)))
+    return [tuple(p) for p in pts[keep].tolist()]
+
+
+def add_checkpoint(history, width, height, interval=DEFAULT_CHECKPOINT_INTERVAL):
+    """
+        Fold the oldest strokes into a checkpoint so that fewer than
+        interval strokes follow it.
+    """
+    checkpoint, strokes = _split_checkpoint(history)
+    if len(strokes) < interval:
+        return list(history)
+    folded = len(strokes) - len(strokes) % interval
+    window = _history_window(checkpoint, strokes[:folded], width, height)
+    if window is None:
+        return [('checkpoint', (0, 0, np.zeros((0, 0), dtype=bool)))] + strokes[folded:]
+    x, y, cropped = crop_mask(_replay_window(([checkpoint] if checkpoint else []) + strokes[:folded], window))
+    if cropped.size:
+        x, y = x + window[0], y + window[1]
+    return [('checkpoint', (x, y, cropped))] + strokes[folded:]
+
+
+def compact_history(history, width, height, checkpointInterval=DEFAULT_CHECKPOINT_INTERVAL):
+    """
+        Return an equivalent, shorter brush history: redundant strokes are
+        dropped, connected segments merged and, unless checkpointInterval is
+        None, old strokes folded into a checkpoint. Until checkpointInterval
+        strokes follow the last checkpoint the history is returned as it is.
+    """
+    if checkpointInterval is not None and len(_split_checkpoint(history)[1]) < checkpointInterval:
+        return list(history)
+    history = merge_polylines(drop_redundant(history, width, height))
+    if checkpointInterval is not None:
+        history = add_checkpoint(history, width, height, checkpointInterval)
+    return history
@@ -0,0 +1,102 @@
+import sys
+
+import numpy as np
+
+# Default memory, in bytes, the undo and redo stacks may hold together
+DEFAULT_UNDO_BUDGET = 64 * 1024 * 1024
+
+
+def history_nbytes(history):
+    """Approximate memory held by brush history entries, arrays and Python objects alike."""
+    if isinstance(history, np.ndarray):
+        return history.nbytes
+    if isinstance(history, (tuple, list)):
+        return sys.getsizeof(history) + sum(history_nbytes(item) for item in history)
+    return sys.getsizeof(history)
+
+
+class BrushStroke(object):
+    """
+        One undoable stroke: the pixels of brush under window before (or,
+        once undone, after) the stroke, bit-packed, and the history tail
+        from historyStart on that goes with them.
+    """
+
+    def __init__(self, brush, window, pixels, historyStart, historyTail):
+        self.brush = brush
+        self.window = window
+        self.packed = np.packbits(pixels)
+        self.historyStart = historyStart
+        self.historyTail = historyTail
+
+    @property
+    def historyTail(self):
+        return self._historyTail
+
+    @historyTail.setter
+    def historyTail(self, historyTail):
+        self._historyTail = historyTail
+        self._historyBytes = history_nbytes(historyTail)
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes + self._historyBytes
+
+    def pixels(self):
+        x0, y0, x1, y1 = self.window
+        return np.unpackbits(self.packed, count=(y1 - y0) * (x1 - x0)).reshape(y1 - y0, x1 - x0).view(bool)
+
+    def swap(self):
+        """Put the stored state back on the brush and keep the one it replaces, so undo and redo are the same."""
+        self.brush.swapStroke(self)
+
+
+class BrushUndoStack(object):
+    """
+        Undo and redo stacks of brush strokes. The oldest strokes are
+        forgotten once all of them together take more than maxBytes.
+    """
+
+    def __init__(self, maxBytes=DEFAULT_UNDO_BUDGET):
+        self.maxBytes = maxBytes
+        self._undo = []
+        self._redo = []
+
+    @property
+    def nbytes(self):
+        return sum(stroke.nbytes for stroke in self._undo) + sum(stroke.nbytes for stroke in self._redo)
+
+    def canUndo(self):
+        return bool(self._undo)
+
+    def canRedo(self):
+        return bool(self._redo)
+
+    def clear(self):
+        self._undo = []
+        self._redo = []
+
+    def push(self, stroke):
+        """Record a new stroke; whatever was undone before can no longer be redone."""
+        self._redo = []
+        self._undo.append(stroke)
+        total = self.nbytes
+        while self._undo and total > self.maxBytes:
+            total -= self._undo.pop(0).nbytes
+
+    def undo(self):
+        """Revert the last stroke and return it, or None when there is nothing to undo."""
+        if not self._undo:
+            return None
+        stroke = self._undo.pop()
+        stroke.swap()
+        self._redo.append(stroke)
+        return stroke
+
+    def redo(self):
+        if not self._redo:
+            return None
+        stroke = self._redo.pop()
+        stroke.swap()
+        self._undo.append(stroke)
+        return stroke
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from libs.pascal_voc_io import PascalVocReader, XML_EXT
+
+SHAPE_TYPES = ('rect', 'polygon', 'brush')
+
+
+class AnnotationTable(object):
+    """
+        Columnar view of many annotation files, one row per object.
+
+        paths[image_id] is the XML an object came from, categories[category]
+        its label category id and labels[label] its label text. Object i has
+        vertices[vertex_offsets[i]:vertex_offsets[i + 1]] (empty for brushes)
+        and bbox[i] = (xmin, ymin, xmax, ymax).
+    """
+
+    def __init__(self, paths, categories, labels, image_id, category, label, shape_type, bbox,
+                 vertex_offsets, vertices, errors):
+        self.paths = paths
+        self.categories = categories
+        self.labels = labels
+        self.image_id = image_id
+        self.category = category
+        self.label = label
+        self.shape_type = shape_type
+        self.bbox = bbox
+        self.vertex_offsets = vertex_offsets
+        self.vertices = vertices
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.image_id)
+
+    def objectVertices(self, i):
+        return self.vertices[self.vertex_offsets[i]:self.vertex_offsets[i + 1]]
+
+
+def brush_bbox(offset, history, mask):
+    """Bounding box of a brush in image coordinates, from its stored mask or its painted strokes."""
+    ox, oy = offset
+    if mask is not None:
+        x, y, cropped = mask
+        h, w = cropped.shape
+        if h == 0 or w == 0:
+            return (np.nan,) * 4
+        return (ox + x, oy + y, ox + x + w - 1, oy + y + h - 1)
+    xs, ys = [], []
+    for hist_type, hist_data in history:
+        if hist_type == 'checkpoint':
+            x, y, cropped = hist_data
+            h, w = cropped.shape
+            if h and w:
+                xs.extend((x, x + w - 1))
+                ys.extend((y, y + h - 1))
+            continue
+        erasing = hist_data[-1]
+        if erasing:
+            continue
+        radius = hist_data[-2]
+        points = hist_data[0] if hist_type == 'addPolyline' else hist_data[:-2]
+        for px, py in points:
+            xs.extend((px - radius, px + radius))
+            ys.extend((py - radius, py + radius))
+    if not xs:
+        return (np.nan,) * 4
+    return (ox + min(xs), oy + min(ys), ox + max(xs), oy + max(ys))
+
+
+def _read_chunk(args):
+    start, paths, labelCategories = args
+    categoryIndex = dict((cat_id, i) for i, (_, cat_id) in enumerate(labelCategories))
+    image_id, category, label, shape_type, bbox, counts, vertices = [], [], [], [], [], [], []
+    errors = []
+    for i, path in enumerate(paths):
+        # Build a file's rows apart so a malformed shape drops only that file
+        rows = []
+        try:
+            shapes = PascalVocReader(path, labelCategories).getShapes()
+            for _, cat_id in labelCategories:
+                for lbl, _attributes, points, typ in shapes[cat_id]:
+                    if typ == 'brush':
+                        size, offset, history, mask = points
+                        box = brush_bbox(offset, history, mask)
+                        points = []
+                    else:
+                        xs = [p[0] for p in points]
+                        ys = [p[1] for p in points]
+                        box = (min(xs), min(ys), max(xs), max(ys))
+                    rows.append((categoryIndex[cat_id], lbl if lbl is not None else '',
+                                 SHAPE_TYPES.index(typ), box, points))
+        except Exception as e:
+            errors.append((path, '%s: %s' % (type(e).__name__, e)))
+            continue
+        for cat, lbl, typ, box, points in rows:
+            image_id.append(start + i)
+            category.append(cat)
+            label.append(lbl)
+            shape_type.append(typ)
+            bbox.append(box)
+            counts.append(len(points))
+            vertices.extend(points)
+    return (np.asarray(image_id, dtype=np.int32),
+            np.asarray(category, dtype=np.int16),
+            label,
+            np.asarray(shape_type, dtype=np.int8),
+            np.asarray(bbox, dtype=np.float32).reshape(-1, 4),
+            np.asarray(counts, dtype=np.int64),
+            np.asarray(vertices, dtype=np.float32).reshape(-1, 2),
+            errors)
+
+
+def list_annotation_files(source):
+    """Return the sorted XML files under a directory, or the given file list unchanged."""
+    if isinstance(source, str):
+        found = []
+        for root, dirs, files in os.walk(source):
+            for name in files:
+                if name.lower().endswith(XML_EXT):
+                    found.append(os.path.join(root, name))
+        return sorted(found)
+    return list(source)
+
+
+def read_annotations(source, labelCategories, processes=None, chunksize=256):
+    """
+        Parse every annotation in source (a directory or a list of XML paths)
+        across a process pool and return an AnnotationTable.
+    """
+    paths = list_annotation_files(source)
+    labelCategories = tuple(tuple(c) for c in labelCategories)
+    jobs = [(start, paths[start:start + chunksize], labelCategories)
+            for start in range(0, len(paths), chunksize)]
+    if processes == 1 or len(jobs) <= 1:
+        chunks = [_read_chunk(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            chunks = list(pool.map(_read_chunk, jobs))
+
+    if not chunks:
+        chunks = [_read_chunk((0, [], labelCategories))]
+    image_id, category, label, shape_type, bbox, counts, vertices, errors = zip(*chunks)
+    labelText = [lbl for chunk in label for lbl in chunk]
+    labels, labelIds = np.unique(np.asarray(labelText, dtype=object).astype(str), return_inverse=True)
+    vertex_offsets = np.zeros(sum(len(c) for c in counts) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(counts), out=vertex_offsets[1:])
+    return AnnotationTable(
+        paths=paths,
+        categories=[cat_id for _, cat_id in labelCategories],
+        labels=labels.tolist(),
+        image_id=np.concatenate(image_id),
+        category=np.concatenate(category),
+        label=labelIds.astype(np.int32).reshape(-1),
+        shape_type=np.concatenate(shape_type),
+        bbox=np.concatenate(bbox),
+        vertex_offsets=vertex_offsets,
+        vertices=np.concatenate(vertices),
+        errors=[e for chunk in errors for e in chunk],
+    )
@@ -12,7 +12,10 @@ except ImportError:
 
 from libs.shape import Shape
 from libs.polygon import Polygon
-from libs.brush import Brush
+from libs.brush import Brush, point_to_tuple
+from libs.brush_history import simplify_polyline
+from libs.brush_undo import DEFAULT_UNDO_BUDGET, BrushUndoStack
+from libs.occlusion import OcclusionGraph
 from libs.lib import distance
 
 CURSOR_DEFAULT = Qt.ArrowCursor
@@ -39,6 +42,12 @@ class Canvas(QWidget):
     CREATE, CREATE_POLYGON, CREATE_BRUSH, EDIT, EDIT_BRUSH = list(range(5))
 
     epsilon = 20  # 420  # 11.0
+    # Brush moves are queued and painted once per this many ms, about a frame
+    brushFlushInterval = 16
+    # Queued brush moves are simplified within this distance, in image pixels
+    brushSimplifyTolerance = 0.5
+    # Bytes the brush stroke undo history may use
+    brushUndoBudget = DEFAULT_UNDO_BUDGET
 
     def __init__(self, *args, **kwargs):
         super(Canvas, self).__init__(*args, **kwargs)
@@ -82,6 +91,15 @@ class Canvas(QWidget):
         self._brushEraseCursor = None
         self._brushDrawCursor = None
         self._updateBrushCursors()
+        self._pendingBrushPoints = []
+        self._brushFlushTimer = QTimer(self)
+        self._brushFlushTimer.setSingleShot(True)
+        self._brushFlushTimer.setInterval(self.brushFlushInterval)
+        self._brushFlushTimer.timeout.connect(self.flushBrushStroke)
+        # Brush recording the stroke in progress, see endBrushStroke
+        self._strokeBrush = None
+        self.brushUndo = BrushUndoStack(self.brushUndoBudget)
+        self.occlusion = OcclusionGraph()
 
     def showRangeCursor(self):
         return self._showRangeCursor
@@ -96,6 +114,7 @@ class Canvas(QWidget):
         return self._trackThickness
 
     def setBrushRadius(self, radius):
+        self.flushBrushStroke()
         self._brushRadius = radius
         self._updateBrushCursors()
 
@@ -109,6 +128,7 @@ class Canvas(QWidget):
         return self._erasing
 
     def setErasing(self, val):
+        self.flushBrushStroke()
         self._erasing = val
 
     def scale(self):
@@ -166,7 +186,10 @@ class Canvas(QWidget):
         return self.mode == self.EDIT
 
     def setMode(self, mode):
+        self.endBrushStroke()
         self.mode = mode
+        if not self.drawingBrush():
+            self.brushUndo.clear()
         if mode in [self.CREATE, self.CREATE_POLYGON, self.CREATE_BRUSH, self.EDIT_BRUSH]:
             self.mousePressed = False
             self.prevPosition = None
@@ -351,6 +374,7 @@ class Canvas(QWidget):
             self.repaint()
 
     def mouseReleaseEvent(self, ev):
+        self.endBrushStroke()
         self.mousePressed = False
         self.prevPosition = None
         if ev.button() == Qt.RightButton:
@@ -450,26 +474,93 @@ class Canvas(QWidget):
             self.drawingShape.emit(True)
             self.update()
 
-    def handleDrawingBrush(self, pos):
-        if self.outOfPixmap(pos):
-            return
-        if self.pixmap is None:
-            return
+    def brushTarget(self):
         if self.mode == Canvas.EDIT_BRUSH:
             assert self.selectedShape is not None
-            target = self.selectedShape
+            return self.selectedShape
         elif self.mode == Canvas.CREATE_BRUSH:
             if self.current is None:
                 self.current = Brush(self.pixmap.size())
-            target = self.current
+            return self.current
         else:
             raise NotImplementedError
+
+    def handleDrawingBrush(self, pos):
+        if self.outOfPixmap(pos):
+            return
+        if self.pixmap is None:
+            return
         if self.prevPosition is None:
+            target = self.brushTarget()
+            target.beginStroke()
+            self._strokeBrush = target
             target.addPoint(pos - target.offset, self.brushRadius(), self.erasing())
+            self.updateBrushRegion([pos])
+            self.prevPosition = pos
         else:
-            target.addLine(self.prevPosition - target.offset, pos - target.offset, self.brushRadius(), self.erasing())
-        self.update()
-        self.prevPosition = pos
+            # Mouse moves can come in much faster than frames are drawn
+            self._pendingBrushPoints.append(pos)
+            if not self._brushFlushTimer.isActive():
+                self._brushFlushTimer.start()
+
+    def flushBrushStroke(self):
+        """Paint the queued brush moves as one simplified polyline."""
+        self._brushFlushTimer.stop()
+        points, self._pendingBrushPoints = self._pendingBrushPoints, []
+        if not points or self.prevPosition is None or not self.drawingBrush():
+            return
+        target = self.brushTarget()
+        offset = target.offset
+        simplified = simplify_polyline([point_to_tuple(self.prevPosition - offset)] +
+                                       [point_to_tuple(point - offset) for point in points],
+                                       self.brushSimplifyTolerance)
+        target.addPolyline([QPointF(*point) for point in simplified], self.brushRadius(), self.erasing())
+        self.updateBrushRegion([self.prevPosition] + points)
+        self.prevPosition = points[-1]
+
+    def endBrushStroke(self):
+        """Paint the queued moves and make the stroke since the mouse press undoable."""
+        self.flushBrushStroke()
+        brush, self._strokeBrush = self._strokeBrush, None
+        if brush is not None:
+            stroke = brush.endStroke()
+            if stroke is not None:
+                self.brushUndo.push(stroke)
+
+    def clearBrushUndo(self):
+        """Finish the stroke in progress and forget every undoable one, e.g. when their brushes go away."""
+        self.endBrushStroke()
+        self.brushUndo.clear()
+
+    def undoBrushStroke(self):
+        """Revert the last brush stroke; returns False when there is none."""
+        return self._swapBrushStroke(self.brushUndo.undo)
+
+    def redoBrushStroke(self):
+        return self._swapBrushStroke(self.brushUndo.redo)
+
+    def _swapBrushStroke(self, swap):
+        if not self.drawingBrush():
+            return False
+        self.endBrushStroke()
+        self.prevPosition = None
+        stroke = swap()
+        if stroke is None:
+            return False
+        x0, y0, x1, y1 = stroke.window
+        offset = stroke.brush.offset
+        self.updateBrushRegion([QPointF(x0, y0) + offset, QPointF(x1, y1) + offset])
+        return True
+
+    def updateBrushRegion(self, points):
+        """Schedule a repaint of the part of the widget brush strokes through points can change."""
+        margin = self.brushRadius() + Brush.boundaryWidth + 1
+        xs = [point.x() for point in points]
+        ys = [point.y() for point in points]
+        rect = QRectF(min(xs) - margin, min(ys) - margin, max(xs) - min(xs) + 2 * margin,
+                      max(ys) - min(ys) + 2 * margin).translated(self.offsetToCenter())
+        s = self.scale()
+        self.update(QRectF(rect.x() * s, rect.y() * s, rect.width() * s, rect.height() * s).toAlignedRect())
 
     def setHiding(self, enable=True):
         self._hideBackround = self.hideBackround if enable else False
@@ -569,6 +660,7 @@ class Canvas(QWidget):
         return False
 
     def deSelectShape(self):
+        self.endBrushStroke()
         if self.selectedShape:
             self.selectedShape.selected = False
             self.selectedShape = None
@@ -642,11 +734,12 @@ class Canvas(QWidget):
 
         # if len(self.shapes) > 0:
         sortedShapes = self.sortedShapes
+        self.occlusion.update(sortedShapes)
 
-        for idx, shape in enumerate(sortedShapes):
+        for shape in sortedShapes:
             if (shape.selected or not self._hideBackround) and self.isVisible(shape):
                 shape.fill = shape.selected or shape == self.hShape
-                shape.paint(p, prev_shapes=sortedShapes[:idx], scale=self.scale())
+                shape.paint(p, occlusion=self.occlusion, scale=self.scale())
         if self.current:
             self.current.fill = True
             self.current.paint(p, scale=self.scale())
@@ -731,6 +824,7 @@ class Canvas(QWidget):
 
     def finalize(self):
         assert self.current
+        self.endBrushStroke()
         self.current.close()
         self.currentShapes.append(self.current)
         self.current = None
@@ -932,6 +1026,7 @@ class Canvas(QWidget):
         self.repaint()
 
     def loadShapes(self, shapes):
+        self.clearBrushUndo()
         self.shapes = shapes  # list(shapes)
         self.current = None
         self.repaint()
@@ -949,6 +1044,7 @@ class Canvas(QWidget):
         QApplication.restoreOverrideCursor()
 
     def resetState(self):
+        self.clearBrushUndo()
         self.restoreCursor()
         self.pixmap = None
         self.update()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+import json
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from libs.bulk_reader import list_annotation_files
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocReader
+from libs.raster import polygon_mask, replay_history
+from libs.rle import clip_mask, coco_rle_counts, coco_rle_string, crop_mask
+
+
+def _bbox(x, y, cropped):
+    rows = np.flatnonzero(cropped.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(cropped.any(axis=0))
+    return [x + int(cols[0]), y + int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)]
+
+
+def _mask_annotation(x, y, cropped, height, width):
+    # Pixels off the image are in neither the segmentation nor its box and area
+    x, y, cropped = clip_mask(x, y, cropped, height, width)
+    bbox = _bbox(x, y, cropped)
+    if bbox is None:
+        return None
+    counts = coco_rle_counts(x, y, cropped, height, width)
+    return dict(
+        segmentation=dict(size=[height, width], counts=coco_rle_string(counts)),
+        area=int(np.count_nonzero(cropped)),
+        bbox=bbox,
+    )
+
+
+def brush_mask(points):
+    """Return (x, y, cropped) in image coordinates for a brush, replaying its history without a stored mask."""
+    size, offset, history, mask = points
+    if mask is None:
+        width, height = size
+        mask = crop_mask(replay_history(history, height, width))
+    x, y, cropped = mask
+    return int(offset[0]) + x, int(offset[1]) + y, cropped
+
+
+def _annotation(label, attributes, points, typ, height, width):
+    if typ == 'rect':
+        (xmin, ymin), _, (xmax, ymax), _ = points
+        return dict(
+            segmentation=[[xmin, ymin, xmax, ymin, xmax, ymax, xmin, ymax]],
+            area=(xmax - xmin) * (ymax - ymin),
+            bbox=[xmin, ymin, xmax - xmin, ymax - ymin],
+        )
+    elif typ == 'polygon':
+        return _mask_annotation(*polygon_mask(points, height, width), height, width)
+    elif typ == 'brush':
+        return _mask_annotation(*brush_mask(points), height, width)
+    raise NotImplementedError(typ)
+
+
+def convert_image(args):
+    """
+        Worker: turn one annotation file into (image, annotations, skipped, errors).
+        image is None when the file could not be read at all; a shape that
+        fails to convert is left out and its error listed.
+    """
+    xmlPath, labelCategories = args
+    try:
+        reader = PascalVocReader(xmlPath, labelCategories)
+        if reader.imgSize is None:
+            return None, [], 0, ['missing <size>']
+        height, width = reader.imgSize[:2]
+        shapes = reader.getShapes()
+    except Exception as e:
+        return None, [], 0, ['%s: %s' % (type(e).__name__, e)]
+    image = dict(file_name=reader.filename or os.path.basename(xmlPath), width=width, height=height,
+                 annotation_file=xmlPath)
+    annotations = []
+    skipped = 0
+    errors = []
+    for categoryIndex, (_, cat_id) in enumerate(labelCategories):
+        for label, attributes, points, typ in shapes[cat_id]:
+            try:
+                ann = _annotation(label, attributes, points, typ, height, width)
+            except Exception as e:
+                errors.append('%s %r: %s: %s' % (typ, label, type(e).__name__, e))
+                continue
+            if ann is None:
+                skipped += 1
+                continue
+            ann.update(category_id=categoryIndex + 1, iscrowd=0, label=label, attributes=list(attributes))
+            annotations.append(ann)
+    return image, annotations, skipped, errors
+
+
+class CocoExportStats(object):
+
+    def __init__(self):
+        self.images = 0
+        self.annotations = 0
+        self.skipped = 0
+        # Shapes left out of an exported image, and files not exported at all
+        self.failed = []
+        self.errors = []
+        self.seconds = 0.0
+
+    def summary(self):
+        rate = self.images / self.seconds if self.seconds > 0 else float('inf')
+        return ('%d images, %d annotations, %d skipped (empty), %d failed, %d errors in %.1fs (%.1f images/s)'
+                % (self.images, self.annotations, self.skipped, len(self.failed), len(self.errors),
+                   self.seconds, rate))
+
+
+def export_coco(source, outPath, labelCategories, processes=None, chunksize=16, progress=None):
+    """
+        Stream a directory (or list) of annotation files into a COCO JSON file.
+
+        Images are converted in worker processes and written out as they
+        arrive; only the small image records are spooled until the end.
+        progress, if given, is called with the stats every few hundred images.
+    """
+    labelCategories = tuple(tuple(c) for c in labelCategories)
+    paths = list_annotation_files(source)
+    stats = CocoExportStats()
+    start = time.time()
+    jobs = ((path, labelCategories) for path in paths)
+
+    with open(outPath, 'w', encoding='utf-8') as out, \
+            tempfile.TemporaryFile('w+', encoding='utf-8') as images:
+        categories = [dict(id=i + 1, name=cat_id, supercategory=name)
+                      for i, (name, cat_id) in enumerate(labelCategories)]
+        out.write('{"info": %s, "categories": %s, "annotations": [' % (
+            json.dumps(dict(description='labelImg export', date_created=time.strftime('%Y-%m-%d'))),
+            json.dumps(categories)))
+
+        pool = Pool(processes) if processes != 1 else None
+        try:
+            results = pool.imap(convert_image, jobs, chunksize) if pool else map(convert_image, jobs)
+            for path, (image, annotations, skipped, errors) in zip(paths, results):
+                if image is None:
+                    stats.errors.extend((path, error) for error in errors)
+                    continue
+                stats.failed.extend((path, error) for error in errors)
+                stats.images += 1
+                image['id'] = stats.images
+                images.write((',' if stats.images > 1 else '') + json.dumps(image))
+                for ann in annotations:
+                    ann['image_id'] = image['id']
+                    ann['id'] = stats.annotations + 1
+                    out.write((',' if stats.annotations else '') + json.dumps(ann))
+                    stats.annotations += 1
+                stats.skipped += skipped
+                if progress is not None and stats.images % 500 == 0:
+                    stats.seconds = time.time() - start
+                    progress(stats)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        out.write('], "images": [')
+        images.seek(0)
+        for block in iter(lambda: images.read(1 << 20), ''):
+            out.write(block)
+        out.write(']}\n')
+
+    stats.seconds = time.time() - start
+    return stats
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Export annotation XML files to COCO JSON')
+    parser.add_argument('source', type=str, help='directory of annotation XML files')
+    parser.add_argument('output', type=str, help='COCO JSON file to write')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    def progress(stats):
+        print(stats.summary(), file=sys.stderr)
+
+    stats = export_coco(args.source, args.output, LABEL_CATEGORIES, processes=args.processes, progress=progress)
+    for path, error in stats.failed + stats.errors:
+        print('%s: %s' % (path, error), file=sys.stderr)
+    print(stats.summary(), file=sys.stderr)
+    return 1 if stats.failed or stats.errors else 0
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+import numpy as np
+import shapely
+
+# Edge directions, clockwise on screen (y down): +x, +y, -x, -y
+_STEPS = np.array([(1, 0), (0, 1), (-1, 0), (0, -1)], dtype=np.int64)
+
+
+def _boundary_edges(mask):
+    """
+        Unit pixel edges between set and unset pixels as (x, y, direction)
+        arrays, directed so that the set pixel is on the right.
+    """
+    h, w = mask.shape
+    padded = np.zeros((h + 2, w + 2), dtype=bool)
+    padded[1:-1, 1:-1] = mask
+    # Horizontal edge (x, y) lies between pixel rows y - 1 and y
+    above, below = padded[:-1, 1:-1], padded[1:, 1:-1]
+    ys, xs = np.nonzero(below & ~above)
+    right = (xs, ys, np.zeros_like(xs))
+    ys, xs = np.nonzero(above & ~below)
+    left = (xs + 1, ys, np.full_like(xs, 2))
+    # Vertical edge (x, y) lies between pixel columns x - 1 and x
+    leftPixels, rightPixels = padded[1:-1, :-1], padded[1:-1, 1:]
+    ys, xs = np.nonzero(leftPixels & ~rightPixels)
+    down = (xs, ys, np.ones_like(xs))
+    ys, xs = np.nonzero(rightPixels & ~leftPixels)
+    up = (xs, ys + 1, np.full_like(xs, 3))
+    return tuple(np.concatenate(parts).astype(np.int64) for parts in zip(right, left, down, up))
+
+
+def _cycle_order(nxt):
+    """
+        Split the permutation nxt into its cycles. Returns (label, order):
+        label[i] is the smallest index on the cycle of i and order lists
+        every index, cycle by cycle, in the order nxt visits them.
+    """
+    n = len(nxt)
+    index = np.arange(n)
+    # Pointer doubling: after k rounds label is the minimum over 2 ** k steps
+    label, ptr = index.copy(), nxt.copy()
+    for _ in range(max(int(n).bit_length(), 1)):
+        label = np.minimum(label, label[ptr])
+        ptr = ptr[ptr]
+    # Cut every cycle before its smallest index and rank the resulting lists
+    last = nxt == label
+    dist = np.where(last, 0, 1)
+    ptr = np.where(last, index, nxt)
+    while True:
+        jump = ptr[ptr]
+        if np.array_equal(jump, ptr):
+            break
+        dist = dist + dist[ptr]
+        ptr = jump
+    return label, np.lexsort((-dist, label))
+
+
+def trace_rings(mask):
+    """
+        Trace the boundaries of a 2d bool mask along pixel edges.
+
+        Returns (coords, ringIndex, areas, insides): the corner points of
+        all rings one after the other, the ring each point belongs to, the
+        signed area of every ring and a point strictly inside every ring on
+        its unset side. Outer boundaries run clockwise on screen and have a
+        positive area, holes the other way. Pixels touching only at a corner
+        are treated as separate.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    xs, ys, dirs = _boundary_edges(mask)
+    if len(xs) == 0:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 2))
+    h, w = mask.shape
+    stride = w + 1
+    start = ys * stride + xs
+    end = (ys + _STEPS[dirs, 1]) * stride + xs + _STEPS[dirs, 0]
+
+    # Every corner has one outgoing edge, except where two set pixels touch
+    # diagonally; there the ring turns towards the set pixel it came along
+    byStart = np.argsort(start, kind='stable')
+    first = np.searchsorted(start[byStart], end)
+    candidate = byStart[first]
+    second = byStart[np.minimum(first + 1, len(byStart) - 1)]
+    saddle = (first + 1 < len(byStart)) & (start[second] == end)
+    turn = (dirs + 1) % 4
+    nxt = np.where(saddle & (dirs[candidate] != turn), second, candidate)
+
+    label, order = _cycle_order(nxt)
+    # Keep only the corners where the direction changes
+    prev = np.empty_like(order)
+    prev[nxt[order]] = order
+    corner = order[dirs[order] != dirs[prev[order]]]
+    ringStarts = np.flatnonzero(np.r_[True, np.diff(label[corner]) != 0])
+    ringIndex = np.cumsum(np.r_[False, np.diff(label[corner]) != 0])
+    coords = np.stack((xs[corner], ys[corner]), axis=1)
+
+    # Shoelace, wrapping around within every ring
+    following = np.arange(1, len(corner) + 1)
+    ringEnds = np.r_[ringStarts[1:], len(corner)]
+    following[ringEnds - 1] = ringStarts
+    cx, cy = coords[:, 0].astype(np.float64), coords[:, 1].astype(np.float64)
+    areas = 0.5 * np.add.reduceat(cx * cy[following] - cx[following] * cy, ringStarts)
+
+    # Centre of the unset pixel to the left of the first edge of every ring
+    e = corner[ringStarts]
+    steps = _STEPS[dirs[e]]
+    insides = np.stack((xs[e] + 0.5 * steps[:, 0] + 0.5 * steps[:, 1],
+                        ys[e] + 0.5 * steps[:, 1] - 0.5 * steps[:, 0]), axis=1)
+    return coords, ringIndex, areas, insides
+
+
+def mask_polygons(mask, x=0, y=0, tolerance=1.0, minArea=0):
+    """
+        Vectorize a cropped mask placed at (x, y) into a list of shapely
+        Polygons with holes, simplified within tolerance pixels. Components
+        whose outer boundary encloses less than minArea pixels are dropped.
+    """
+    coords, ringIndex, areas, insides = trace_rings(mask)
+    if len(areas) == 0:
+        return []
+    rings = shapely.linearrings(coords + (x, y), indices=ringIndex)
+    shells = np.flatnonzero(areas > 0)
+    holes = np.flatnonzero(areas < 0)
+
+    # A hole belongs to the smallest outer boundary around it
+    polygonOf = np.full(len(areas), -1)
+    polygonOf[shells] = np.arange(len(shells))
+    if len(holes):
+        tree = shapely.STRtree(shapely.polygons(rings[shells]))
+        holeHit, shellHit = tree.query(shapely.points(insides[holes] + (x, y)), predicate='within')
+        bySize = np.lexsort((areas[shells[shellHit]], holeHit))
+        holeHit, shellHit = holeHit[bySize], shellHit[bySize]
+        smallest = np.r_[True, holeHit[1:] != holeHit[:-1]]
+        polygonOf[holes[holeHit[smallest]]] = shellHit[smallest]
+    # Small components go only after their holes found the right shell
+    small = np.flatnonzero(areas[shells] < minArea)
+    polygonOf[np.isin(polygonOf, small)] = -1
+
+    # Shells first, then their holes, grouped by polygon
+    used = np.flatnonzero(polygonOf >= 0)
+    if len(used) == 0:
+        return []
+    used = used[np.lexsort((areas[used] < 0, polygonOf[used]))]
+    polygons = shapely.polygons(rings[used], indices=np.unique(polygonOf[used], return_inverse=True)[1])
+    invalid = ~shapely.is_valid(polygons)
+    if invalid.any():
+        # Rings pinched where pixels touch diagonally
+        polygons[invalid] = shapely.buffer(polygons[invalid], 0)
+    if tolerance:
+        polygons = shapely.simplify(polygons, tolerance, preserve_topology=True)
+    parts = shapely.get_parts(polygons)
+    return [polygon for polygon in parts.tolist() if not polygon.is_empty]
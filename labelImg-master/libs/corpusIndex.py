@@ -0,0 +1,229 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from libs.pascal_voc_io import PascalVocReader, XML_EXT
+
+INDEX_DIR = os.path.join(os.path.expanduser('~'), '.labelImg', 'index')
+INDEX_EXT = '.sqlite'
+# Below this many changed files the parse is not worth a process pool
+PARALLEL_THRESHOLD = 64
+# Upper bound on the parse pool, which is started afresh for every refresh
+MAX_PROCESSES = 8
+# Re-read files are committed, and reported, this many at a time
+BATCH_SIZE = 256
+# Seconds a write waits for another connection's transaction, e.g. the
+# background refresh while the UI re-indexes a saved file
+BUSY_TIMEOUT = 10.0
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    verified INTEGER NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS annotations_directory ON annotations (directory);
+CREATE TABLE IF NOT EXISTS objects (
+    path TEXT NOT NULL,
+    category TEXT NOT NULL,
+    label TEXT NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_path ON objects (path);
+CREATE INDEX IF NOT EXISTS objects_label ON objects (label);
+'''
+
+
+def index_path(key):
+    """Default location of the index for a directory key."""
+    name = hashlib.sha1(os.path.abspath(key).encode('utf-8')).hexdigest() + INDEX_EXT
+    return os.path.join(INDEX_DIR, name)
+
+
+def summarize(args):
+    """Worker: return (path, verified, [(category, label, count)], error) for one annotation file."""
+    path, labelCategories = args
+    try:
+        reader = PascalVocReader(path, labelCategories)
+    except Exception as e:
+        return path, False, [], '%s: %s' % (type(e).__name__, e)
+    shapes = reader.getShapes()
+    objects = {}
+    for _, categoryId in labelCategories:
+        for label, _attributes, _points, _typ in shapes[categoryId]:
+            key = (categoryId, label if label is not None else '')
+            objects[key] = objects.get(key, 0) + 1
+    return path, bool(reader.verified), [k + (n,) for k, n in sorted(objects.items())], None
+
+
+def _parse_pool(processes):
+    """
+        Process pool for summarize(). Its workers are spawned, not forked:
+        the GUI refreshes from a thread, and forking a process that runs
+        other threads can deadlock.
+    """
+    workers = min(processes or os.cpu_count() or 1, MAX_PROCESSES)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+class CorpusIndex(object):
+    """
+        Persistent summary of the annotation files of an image directory.
+
+        Each annotation file has a row with its mtime, size and verified
+        flag, plus per (category, label) object counts. refresh() stats the
+        annotation directories and only re-parses files whose mtime or size
+        changed, so reopening a large directory costs one directory scan.
+    """
+
+    def __init__(self, dbPath, labelCategories):
+        self.dbPath = dbPath
+        self.labelCategories = tuple(tuple(c) for c in labelCategories)
+        if dbPath != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(dbPath)), exist_ok=True)
+        self._db = sqlite3.connect(dbPath, timeout=BUSY_TIMEOUT)
+        # Readers and the one writer of the moment no longer block each other
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.executescript(_SCHEMA)
+        # Counts are per category, so a different category set starts over
+        categories = json.dumps(self.labelCategories)
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'categories'").fetchone()
+        if row is None or row[0] != categories:
+            with self._db:
+                self._db.execute('DELETE FROM annotations')
+                self._db.execute('DELETE FROM objects')
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('categories', ?)", (categories,))
+
+    def close(self):
+        self._db.close()
+
+    def refresh(self, directories, processes=None, progress=None, cancelled=None):
+        """
+            Bring the index up to date with the annotation files directly
+            inside directories. Returns (updated, removed) file counts.
+
+            Changes are committed in batches; progress(updated, removed) is
+            called with the paths of every batch, and once cancelled()
+            returns True the refresh stops after the current batch.
+        """
+        changed, removed = self._scan(directories)
+        if removed:
+            with self._db:
+                for path in removed:
+                    self._forget(path)
+            if progress is not None:
+                progress([], removed)
+
+        jobs = [(path, self.labelCategories) for path, _, _, _ in changed]
+        pool = _parse_pool(processes) if processes != 1 and len(jobs) >= PARALLEL_THRESHOLD else None
+        updated = 0
+        batch = []
+        try:
+            summaries = pool.map(summarize, jobs, chunksize=64) if pool else map(summarize, jobs)
+            for (path, directory, mtime_ns, size), summary in zip(changed, summaries):
+                batch.append((directory, mtime_ns, size) + summary)
+                if len(batch) == BATCH_SIZE:
+                    updated += self._storeBatch(batch, progress)
+                    batch = []
+                    if cancelled is not None and cancelled():
+                        break
+            updated += self._storeBatch(batch, progress)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        return updated, len(removed)
+
+    def _storeBatch(self, batch, progress):
+        if not batch:
+            return 0
+        with self._db:
+            for row in batch:
+                self._store(*row)
+        if progress is not None:
+            progress([row[3] for row in batch], [])
+        return len(batch)
+
+    def _scan(self, directories):
+        """Return ([(path, directory, mtime_ns, size)] of new or changed files, [removed paths])."""
+        changed = []
+        removed = []
+        for directory in sorted(set(os.path.abspath(d) for d in directories)):
+            known = dict((path, (mtime_ns, size)) for path, mtime_ns, size in self._db.execute(
+                'SELECT path, mtime_ns, size FROM annotations WHERE directory = ?', (directory,)))
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                entries = []
+            for entry in entries:
+                if not entry.name.lower().endswith(XML_EXT):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if known.pop(entry.path, None) != (stat.st_mtime_ns, stat.st_size):
+                    changed.append((entry.path, directory, stat.st_mtime_ns, stat.st_size))
+            removed.extend(known)
+        return changed, removed
+
+    def update(self, xmlPath):
+        """Re-index a single annotation file, e.g. right after it was saved."""
+        path = os.path.abspath(xmlPath)
+        with self._db:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self._forget(path)
+                return
+            self._store(os.path.dirname(path), stat.st_mtime_ns, stat.st_size,
+                        *summarize((path, self.labelCategories)))
+
+    def contains(self, xmlPath):
+        return self._db.execute('SELECT 1 FROM annotations WHERE path = ?',
+                                (os.path.abspath(xmlPath),)).fetchone() is not None
+
+    def paths(self):
+        return set(path for path, in self._db.execute('SELECT path FROM annotations'))
+
+    def verifiedPaths(self):
+        return set(path for path, in self._db.execute('SELECT path FROM annotations WHERE verified'))
+
+    def pathsWithLabel(self, label):
+        return set(path for path, in self._db.execute('SELECT DISTINCT path FROM objects WHERE label = ?',
+                                                      (label,)))
+
+    def summary(self, xmlPath):
+        """Return dict(verified, counts={category: n}, labels=set, error) for an indexed file, or None."""
+        path = os.path.abspath(xmlPath)
+        row = self._db.execute('SELECT verified, error FROM annotations WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        counts = dict((categoryId, 0) for _, categoryId in self.labelCategories)
+        labels = set()
+        for category, label, count in self._db.execute(
+                'SELECT category, label, count FROM objects WHERE path = ?', (path,)):
+            counts[category] = counts.get(category, 0) + count
+            labels.add(label)
+        return dict(verified=bool(row[0]), counts=counts, labels=labels, error=row[1])
+
+    def _store(self, directory, mtime_ns, size, path, verified, objects, error):
+        self._db.execute('INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?, ?)',
+                         (path, directory, mtime_ns, size, int(verified), error))
+        self._db.execute('DELETE FROM objects WHERE path = ?', (path,))
+        self._db.executemany('INSERT INTO objects VALUES (?, ?, ?, ?)',
+                             [(path,) + obj for obj in objects])
+
+    def _forget(self, path):
+        self._db.execute('DELETE FROM annotations WHERE path = ?', (path,))
+        self._db.execute('DELETE FROM objects WHERE path = ?', (path,))
@@ -0,0 +1,55 @@
+try:
+    from PyQt5.QtCore import QObject, pyqtSignal
+except ImportError:
+    from PyQt4.QtCore import QObject, pyqtSignal
+
+import threading
+
+from libs.corpusIndex import CorpusIndex
+
+
+class CorpusRefresher(QObject):
+    """
+        Refreshes a CorpusIndex on a background thread, through its own
+        database connection, so opening a large directory does not wait
+        for the scan and parse.
+
+        updated(paths, removed) is emitted for every batch of annotation
+        files re-read or gone, finished(updated, removed) at the end.
+    """
+    updated = pyqtSignal(list, list)
+    finished = pyqtSignal(int, int)
+    failed = pyqtSignal(str)
+
+    def __init__(self, dbPath, labelCategories, directories, processes=None, parent=None):
+        super(CorpusRefresher, self).__init__(parent)
+        self.dbPath = dbPath
+        self.labelCategories = labelCategories
+        self.directories = list(directories)
+        self.processes = processes
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='CorpusRefresher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        """Stop after the current batch."""
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            index = CorpusIndex(self.dbPath, self.labelCategories)
+            try:
+                counts = index.refresh(self.directories, processes=self.processes,
+                                       progress=self.updated.emit, cancelled=self._cancelled.is_set)
+            finally:
+                index.close()
+        except Exception as e:
+            self.failed.emit('%s: %s' % (type(e).__name__, e))
+        else:
+            self.finished.emit(*counts)
@@ -0,0 +1,76 @@
+try:
+    from PyQt5.QtGui import QImage, QImageReader
+except ImportError:
+    from PyQt4.QtGui import QImage, QImageReader
+
+import os.path
+
+# Formats whose header alone tells us the image is grayscale. Mono images
+# are decoded like indexed ones: their two colours may be anything, and
+# QImage.isGrayscale() reports them as colour either way.
+GRAYSCALE_FORMATS = set(getattr(QImage, name) for name in ('Format_Grayscale8', 'Format_Grayscale16')
+                        if hasattr(QImage, name))
+# Formats treated as colour from the header alone. A 32 bit image whose
+# pixels all happen to be grey is reported as colour here, unlike
+# QImage.isGrayscale() on the decoded image.
+COLOR_FORMATS = set(getattr(QImage, name) for name in
+                    ('Format_RGB32', 'Format_ARGB32', 'Format_ARGB32_Premultiplied', 'Format_RGB888',
+                     'Format_BGR888', 'Format_RGB16', 'Format_RGB555', 'Format_RGB666', 'Format_RGB444',
+                     'Format_RGB30', 'Format_BGR30', 'Format_A2RGB30_Premultiplied', 'Format_RGBX8888',
+                     'Format_RGBA8888', 'Format_RGBA8888_Premultiplied', 'Format_RGBX64', 'Format_RGBA64')
+                    if hasattr(QImage, name))
+
+
+class ImageMetadataProvider(object):
+    """
+        [height, width, depth] of images as written to the annotation, cached per path and mtime.
+
+        On a miss, shapes come from an already decoded QImage when the
+        caller has one, otherwise from a QImageReader header read; the
+        image is only fully decoded when its header cannot tell grayscale
+        from colour.
+    """
+
+    def __init__(self):
+        self._cache = {}
+
+    def imageShape(self, imagePath, image=None):
+        key = self._key(imagePath)
+        shape = self._cache.get(key)
+        if shape is None:
+            if image is not None and not image.isNull():
+                shape = self._shapeFromImage(image)
+            else:
+                shape = self._probe(imagePath)
+            self._cache[key] = shape
+        return list(shape)
+
+    def clear(self):
+        self._cache.clear()
+
+    @staticmethod
+    def _key(imagePath):
+        path = os.path.abspath(imagePath)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        return path, mtime
+
+    @staticmethod
+    def _shapeFromImage(image):
+        return (image.height(), image.width(), 1 if image.isGrayscale() else 3)
+
+    def _probe(self, imagePath):
+        reader = QImageReader(imagePath)
+        size = reader.size()
+        fmt = reader.imageFormat()
+        if size.isValid():
+            if fmt in GRAYSCALE_FORMATS:
+                return (size.height(), size.width(), 1)
+            if fmt in COLOR_FORMATS:
+                return (size.height(), size.width(), 3)
+        # Indexed images are only grayscale if their colour table is grey
+        image = QImage()
+        image.load(imagePath)
+        return self._shapeFromImage(image)
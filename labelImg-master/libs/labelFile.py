@@ -1,17 +1,18 @@
 # Copyright (c) 2016 Tzutalin
 # Create by TzuTaLin <tzu.ta.lin@gmail.com>
 
-try:
-    from PyQt5.QtGui import QImage
-except ImportError:
-    from PyQt4.QtGui import QImage
-
 from base64 import b64encode, b64decode
 from libs.pascal_voc_io import PascalVocWriter
 from libs.pascal_voc_io import XML_EXT
+from libs.pascal_voc_io import BRUSH_ENCODING_VERBOSE
+from libs.brush_history import DEFAULT_CHECKPOINT_INTERVAL
+from libs.imageMetadata import ImageMetadataProvider
+import hashlib
 import os.path
 import sys
 
+import numpy as np
+
 
 class LabelFileError(Exception):
     pass
@@ -21,6 +22,13 @@ class LabelFile(object):
     # It might be changed as window creates. By default, using XML ext
     # suffix = '.lif'
     suffix = XML_EXT
+    # Set to BRUSH_ENCODING_PACKED to store brush history as packed records
+    brushEncoding = BRUSH_ENCODING_VERBOSE
+    # Brush histories are compacted on save; None disables checkpoints
+    compactBrushHistory = True
+    brushCheckpointInterval = DEFAULT_CHECKPOINT_INTERVAL
+    # Shared so image sizes are probed once per path and mtime
+    imageMetadata = ImageMetadataProvider()
 
     def __init__(self, filename=None):
         self.shapes = ()
@@ -28,20 +36,14 @@ class LabelFile(object):
         self.imageData = None
         self.verified = False
 
-    def savePascalVocFormat(self, filename, shapes, imagePath, imageData, labelCategories):
-        imgFolderPath = os.path.dirname(imagePath)
-        imgFolderName = os.path.split(imgFolderPath)[-1]
-        imgFileName = os.path.basename(imagePath)
-        # imgFileNameWithoutExt = os.path.splitext(imgFileName)[0]
-        # Read from file path because self.imageData might be empty if saving to
-        # Pascal format
-        image = QImage()
-        image.load(imagePath)
-        imageShape = [image.height(), image.width(),
-                      1 if image.isGrayscale() else 3]
-        writer = PascalVocWriter(imgFolderName, imgFileName,
-                                 imageShape, localImgPath=imagePath, labelCategories=labelCategories)
-        writer.verified = self.verified
+    def savePascalVocFormat(self, filename, shapes, imagePath, imageData, labelCategories, image=None):
+        writer = self.pascalVocWriter(shapes, imagePath, labelCategories, image=image)
+        writer.save(targetFile=filename)
+        return
+
+    def pascalVocWriter(self, shapes, imagePath, labelCategories, image=None):
+        """Return a PascalVocWriter holding shapes, ready to be saved from any thread."""
+        writer = self._newWriter(imagePath, labelCategories, image=image)
 
         for _, categoryId in labelCategories:
             for shape in shapes[categoryId]:
@@ -62,13 +64,57 @@ class LabelFile(object):
                     label = shape['label']
                     offset = shape['offset']
                     attributes = shape['attributes']
-                    writer.addBrush(categoryId, size, offset, history, label, attributes)
-        writer.save(targetFile=filename)
-        return
+                    mask = shape.get('mask')
+                    writer.addBrush(categoryId, size, offset, history, label, attributes, mask=mask)
+        return writer
+
+    def _newWriter(self, imagePath, labelCategories, image=None):
+        imgFolderPath = os.path.dirname(imagePath)
+        imgFolderName = os.path.split(imgFolderPath)[-1]
+        imgFileName = os.path.basename(imagePath)
+        # imgFileNameWithoutExt = os.path.splitext(imgFileName)[0]
+        # Use the already decoded image when given, otherwise only read the
+        # image header since self.imageData might be empty if saving to
+        # Pascal format
+        imageShape = self.imageMetadata.imageShape(imagePath, image)
+        writer = PascalVocWriter(imgFolderName, imgFileName,
+                                 imageShape, localImgPath=imagePath, labelCategories=labelCategories)
+        writer.verified = self.verified
+        writer.brushEncoding = self.brushEncoding
+        writer.compactBrushHistory = self.compactBrushHistory
+        writer.brushCheckpointInterval = self.brushCheckpointInterval
+        return writer
 
     def toggleVerify(self):
         self.verified = not self.verified
 
+    @staticmethod
+    def shapesDigest(shapes, labelCategories, verified=False, header=None):
+        """
+            Canonical content hash of a shape set as passed to pascalVocWriter,
+            with the verified flag and file header (see
+            PascalVocWriter.getHeader) it is saved with, used to tell whether
+            saving would change anything.
+        """
+        digest = hashlib.sha1(repr((bool(verified), header)).encode('utf-8'))
+        for _, categoryId in labelCategories:
+            digest.update(repr(categoryId).encode('utf-8'))
+            for shape in shapes[categoryId]:
+                fields = sorted((k, v) for k, v in shape.items() if k not in ('mask', 'history'))
+                digest.update(repr(fields).encode('utf-8'))
+                for hist_type, hist_data in shape.get('history', ()):
+                    if hist_type == 'checkpoint':
+                        # The repr of a large array is abbreviated
+                        hist_data = (hist_data[0], hist_data[1], np.packbits(hist_data[2]).tobytes())
+                    digest.update(repr((hist_type, hist_data)).encode('utf-8'))
+                mask = shape.get('mask')
+                if mask is not None:
+                    x, y, cropped = mask
+                    cropped = np.asarray(cropped, dtype=bool)
+                    digest.update(repr((x, y, cropped.shape)).encode('utf-8'))
+                    digest.update(np.packbits(cropped).tobytes())
+        return digest.hexdigest()
+
     @staticmethod
     def isLabelFile(filename):
         fileSuffix = os.path.splitext(filename)[1].lower()
@@ -0,0 +1,458 @@
+import numpy as np
+
+from libs.raster import capsule_window, dilate_mask, disc_window, stamp_capsule, stamp_disc
+
+
+class Projections(object):
+    """
+        Number of set pixels in every row and column of a width x height
+        mask. Kept up to date stroke by stroke, so the bounding box of the
+        mask is found without looking at its pixels.
+    """
+
+    def __init__(self, width, height):
+        self.rows = np.zeros(height, dtype=np.int64)
+        self.cols = np.zeros(width, dtype=np.int64)
+
+    def clear(self):
+        self.rows[:] = 0
+        self.cols[:] = 0
+
+    def add(self, x, y, region, sign=1):
+        """Count (sign=1) or uncount (sign=-1) the set pixels of region placed at (x, y)."""
+        h, w = region.shape
+        if h and w:
+            self.rows[y:y + h] += sign * np.count_nonzero(region, axis=1)
+            self.cols[x:x + w] += sign * np.count_nonzero(region, axis=0)
+
+    def stamp(self, data, origin, window, stamp, args):
+        """Apply stamp(data, *args, origin=origin) to data, counting the pixels it changes within window."""
+        ox, oy = origin
+        h, w = data.shape
+        x0, y0 = max(window[0], ox), max(window[1], oy)
+        x1, y1 = min(window[2], ox + w), min(window[3], oy + h)
+        if x1 <= x0 or y1 <= y0:
+            return
+        region = data[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+        self.add(x0, y0, region, -1)
+        stamp(data, *args, origin=origin)
+        self.add(x0, y0, region)
+
+    def bbox(self):
+        rows = np.flatnonzero(self.rows)
+        if len(rows) == 0:
+            return None
+        cols = np.flatnonzero(self.cols)
+        return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+class CroppedMask(object):
+    """
+        Boolean mask of a width x height canvas that only stores the
+        rectangle around its set pixels, at (x, y).
+
+        Painting outside the rectangle grows it, with some slack so a
+        stroke does not reallocate on every mouse move; compact() gives the
+        slack back.
+    """
+    # Minimum number of pixels added on a side when the storage grows
+    growMargin = 32
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.x = 0
+        self.y = 0
+        self.data = np.zeros((0, 0), dtype=bool)
+        self._version = 0
+        self._projections = Projections(width, height)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def blocks(self, window=None):
+        """Yield (key, x, y, data) for the stored blocks intersecting window (x0, y0, x1, y1)."""
+        h, w = self.data.shape
+        if h and w and (window is None or _intersects(window, (self.x, self.y, self.x + w, self.y + h))):
+            yield 0, self.x, self.y, self.data
+
+    def version(self, key):
+        """Counter that changes whenever block key is written, None once the block is gone."""
+        return self._version if key == 0 else None
+
+    def outlineBlocks(self, radius, window=None):
+        """Yield (key, x, y) for the blocks of the mask dilated by radius intersecting window."""
+        box = self._outlineWindow(radius)
+        if box is not None and (window is None or _intersects(window, box)):
+            yield 0, box[0], box[1]
+
+    def outlineVersion(self, key):
+        """Changes whenever outline(key, radius) may have changed."""
+        return self.version(key)
+
+    def outline(self, key, radius):
+        x0, y0, x1, y1 = self._outlineWindow(radius)
+        dilated = dilate_mask(self.data, radius)
+        return dilated[y0 - self.y + radius:y1 - self.y + radius, x0 - self.x + radius:x1 - self.x + radius]
+
+    def _outlineWindow(self, radius):
+        h, w = self.data.shape
+        if not (h and w):
+            return None
+        return (max(self.x - radius, 0), max(self.y - radius, 0),
+                min(self.x + w + radius, self.width), min(self.y + h + radius, self.height))
+
+    def load(self, x, y, cropped):
+        """Replace the contents with cropped placed at (x, y), clipped to the canvas."""
+        x, y = int(x), int(y)
+        h, w = np.shape(cropped)
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, self.width), min(y + h, self.height)
+        self._version += 1
+        self._projections.clear()
+        if x1 <= x0 or y1 <= y0:
+            self.x, self.y, self.data = 0, 0, np.zeros((0, 0), dtype=bool)
+            return
+        self.x, self.y = x0, y0
+        self.data = np.array(cropped[y0 - y:y1 - y, x0 - x:x1 - x], dtype=bool)
+        self._projections.add(x0, y0, self.data)
+
+    def clear(self):
+        self.load(0, 0, np.zeros((0, 0), dtype=bool))
+
+    def region(self, window):
+        """Return the pixels in window (x0, y0, x1, y1) as a bool array, unset outside the storage."""
+        x0, y0, x1, y1 = window
+        out = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        h, w = self.data.shape
+        sx0, sy0 = max(self.x, x0), max(self.y, y0)
+        sx1, sy1 = min(self.x + w, x1), min(self.y + h, y1)
+        if sx1 > sx0 and sy1 > sy0:
+            out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = self.data[sy0 - self.y:sy1 - self.y, sx0 - self.x:sx1 - self.x]
+        return out
+
+    def paste(self, x, y, region):
+        """Overwrite the pixels under region placed at (x, y), clipped to the canvas."""
+        h, w = region.shape
+        if region.any():
+            self._reserve((x, y, x + w, y + h))
+        # Outside the storage everything is unset, and so is region there
+        sh, sw = self.data.shape
+        x0, y0 = max(self.x, x), max(self.y, y)
+        x1, y1 = min(self.x + sw, x + w), min(self.y + sh, y + h)
+        if x1 <= x0 or y1 <= y0:
+            return
+        target = self.data[y0 - self.y:y1 - self.y, x0 - self.x:x1 - self.x]
+        self._projections.add(x0, y0, target, -1)
+        target[...] = region[y0 - y:y1 - y, x0 - x:x1 - x]
+        self._projections.add(x0, y0, target)
+        self._version += 1
+
+    def stampDisc(self, center, radius, value=True):
+        self._stamp(disc_window(center, radius), stamp_disc, (center, radius, value), value)
+
+    def stampCapsule(self, pos1, pos2, radius, value=True):
+        self._stamp(capsule_window(pos1, pos2, radius), stamp_capsule, (pos1, pos2, radius, value), value)
+
+    def _stamp(self, window, stamp, args, value):
+        if value:
+            self._reserve(window)
+        self._projections.stamp(self.data, (self.x, self.y), window, stamp, args)
+        self._version += 1
+
+    def contains(self, x, y):
+        x -= self.x
+        y -= self.y
+        h, w = self.data.shape
+        return 0 <= x < w and 0 <= y < h and bool(self.data[y, x])
+
+    def containsPoints(self, xs, ys):
+        """Vectorized contains() for integer coordinate arrays, returns a bool array."""
+        xs, ys = np.asarray(xs) - self.x, np.asarray(ys) - self.y
+        h, w = self.data.shape
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        out = np.zeros(inside.shape, dtype=bool)
+        out[inside] = self.data[ys[inside], xs[inside]]
+        return out
+
+    def bbox(self):
+        """Return (x0, y0, x1, y1), end exclusive, around the set pixels, or None when empty."""
+        return self._projections.bbox()
+
+    def crop(self):
+        """Return (x, y, cropped) around the set pixels, like rle.crop_mask."""
+        box = self.bbox()
+        if box is None:
+            return 0, 0, np.zeros((0, 0), dtype=bool)
+        x0, y0, x1, y1 = box
+        return x0, y0, self.data[y0 - self.y:y1 - self.y, x0 - self.x:x1 - self.x]
+
+    def compact(self):
+        """Shrink the storage to the bounding box of the set pixels."""
+        x, y, cropped = self.crop()
+        if cropped.shape != self.data.shape:
+            self.x, self.y, self.data = x, y, cropped.copy()
+            self._version += 1
+
+    def full(self):
+        """Return the whole width x height canvas as a bool array."""
+        out = np.zeros((self.height, self.width), dtype=bool)
+        h, w = self.data.shape
+        x0, y0 = max(self.x, 0), max(self.y, 0)
+        x1, y1 = min(self.x + w, self.width), min(self.y + h, self.height)
+        if x1 > x0 and y1 > y0:
+            out[y0:y1, x0:x1] = self.data[y0 - self.y:y1 - self.y, x0 - self.x:x1 - self.x]
+        return out
+
+    def _reserve(self, window):
+        """Grow the storage so it covers window, clipped to the canvas."""
+        x0, y0, x1, y1 = window
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+        if x1 <= x0 or y1 <= y0:
+            return
+        h, w = self.data.shape
+        if h and w:
+            if x0 >= self.x and y0 >= self.y and x1 <= self.x + w and y1 <= self.y + h:
+                return
+            x0, y0 = min(x0, self.x), min(y0, self.y)
+            x1, y1 = max(x1, self.x + w), max(y1, self.y + h)
+        # Grow by at least half the current size so long strokes reallocate
+        # a logarithmic number of times
+        marginX = max(self.growMargin, w // 2)
+        marginY = max(self.growMargin, h // 2)
+        x0, y0 = max(x0 - marginX, 0), max(y0 - marginY, 0)
+        x1, y1 = min(x1 + marginX, self.width), min(y1 + marginY, self.height)
+        data = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        if h and w:
+            data[self.y - y0:self.y - y0 + h, self.x - x0:self.x - x0 + w] = self.data
+        self.x, self.y, self.data = x0, y0, data
+        self._version += 1
+
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class TiledMask(object):
+    """
+        Boolean mask of a width x height canvas stored as fixed size tiles.
+
+        A tile is allocated the first time a pixel in it gets set and is
+        released again once everything in it is erased, so the memory used
+        follows the painted area rather than its bounding box. Same
+        interface as CroppedMask.
+    """
+    tileSize = 256
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self._tiles = {}
+        self._versions = {}
+        self._version = 0
+        self._projections = Projections(width, height)
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self._tiles.values())
+
+    def blocks(self, window=None):
+        """Yield (key, x, y, tile) for the allocated tiles intersecting window (x0, y0, x1, y1)."""
+        size = self.tileSize
+        if window is None:
+            keys = sorted(self._tiles)
+        else:
+            tx0, ty0, tx1, ty1 = self._tileRange(window)
+            keys = [(tx, ty) for ty in range(ty0, ty1) for tx in range(tx0, tx1) if (tx, ty) in self._tiles]
+        for tx, ty in keys:
+            yield (tx, ty), tx * size, ty * size, self._tiles[tx, ty]
+
+    def version(self, key):
+        return self._versions.get(key)
+
+    def outlineBlocks(self, radius, window=None):
+        """Allocated tiles and their neighbours, which the dilation can reach into."""
+        size = self.tileSize
+        keys = set()
+        for (tx, ty), _, _, _ in self.blocks(None if window is None else
+                                              (window[0] - size, window[1] - size,
+                                               window[2] + size, window[3] + size)):
+            keys.update((tx + dx, ty + dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1))
+        tx0, ty0, tx1, ty1 = self._tileRange((0, 0, self.width, self.height) if window is None else window)
+        for tx, ty in sorted(keys):
+            if tx0 <= tx < tx1 and ty0 <= ty < ty1:
+                yield (tx, ty), tx * size, ty * size
+
+    def outlineVersion(self, key):
+        # The outline of a tile depends on the tiles around it
+        tx, ty = key
+        versions = tuple(self._versions.get((tx + dx, ty + dy)) for dy in (-1, 0, 1) for dx in (-1, 0, 1))
+        return None if versions == (None,) * 9 else versions
+
+    def outline(self, key, radius):
+        size = self.tileSize
+        tx, ty = key
+        ox, oy = tx * size, ty * size
+        th, tw = self._tileShape(tx, ty)
+        around = self.region((ox - radius, oy - radius, ox + tw + radius, oy + th + radius))
+        return dilate_mask(around, radius)[2 * radius:2 * radius + th, 2 * radius:2 * radius + tw]
+
+    def region(self, window):
+        """Return the pixels in window (x0, y0, x1, y1) as a bool array, unset outside the canvas."""
+        x0, y0, x1, y1 = window
+        out = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        for _, ox, oy, tile in self.blocks(window):
+            th, tw = tile.shape
+            sx0, sy0 = max(ox, x0), max(oy, y0)
+            sx1, sy1 = min(ox + tw, x1), min(oy + th, y1)
+            out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = tile[sy0 - oy:sy1 - oy, sx0 - ox:sx1 - ox]
+        return out
+
+    def paste(self, x, y, region):
+        """Overwrite the pixels under region placed at (x, y), allocating and releasing tiles as needed."""
+        h, w = region.shape
+        size = self.tileSize
+        for key in self._keys((x, y, x + w, y + h)):
+            ox, oy = key[0] * size, key[1] * size
+            tile = self._tiles.get(key)
+            th, tw = self._tileShape(*key)
+            x0, y0 = max(x, ox), max(y, oy)
+            x1, y1 = min(x + w, ox + tw), min(y + h, oy + th)
+            part = region[y0 - y:y1 - y, x0 - x:x1 - x]
+            if tile is None:
+                if not part.any():
+                    continue
+                tile = self._newTile(*key)
+            target = tile[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+            self._projections.add(x0, y0, target, -1)
+            target[...] = part
+            self._projections.add(x0, y0, target)
+            if tile.any():
+                self._store(key, tile)
+            elif key in self._tiles:
+                del self._tiles[key]
+                del self._versions[key]
+
+    def load(self, x, y, cropped):
+        self.clear()
+        cropped = np.asarray(cropped, dtype=bool)
+        h, w = cropped.shape
+        size = self.tileSize
+        for tx, ty in self._keys((x, y, x + w, y + h)):
+            ox, oy = tx * size, ty * size
+            th, tw = self._tileShape(tx, ty)
+            x0, y0 = max(x, ox), max(y, oy)
+            x1, y1 = min(x + w, ox + tw), min(y + h, oy + th)
+            part = cropped[y0 - y:y1 - y, x0 - x:x1 - x]
+            if not part.any():
+                continue
+            tile = self._newTile(tx, ty)
+            tile[y0 - oy:y1 - oy, x0 - ox:x1 - ox] = part
+            self._store((tx, ty), tile)
+            self._projections.add(ox, oy, tile)
+
+    def clear(self):
+        self._tiles.clear()
+        self._versions.clear()
+        self._projections.clear()
+
+    def stampDisc(self, center, radius, value=True):
+        self._stamp(disc_window(center, radius), stamp_disc, (center, radius, value), value)
+
+    def stampCapsule(self, pos1, pos2, radius, value=True):
+        self._stamp(capsule_window(pos1, pos2, radius), stamp_capsule, (pos1, pos2, radius, value), value)
+
+    def contains(self, x, y):
+        if x < 0 or y < 0:
+            return False
+        size = self.tileSize
+        tile = self._tiles.get((x // size, y // size))
+        if tile is None:
+            return False
+        y, x = y % size, x % size
+        return y < tile.shape[0] and x < tile.shape[1] and bool(tile[y, x])
+
+    def containsPoints(self, xs, ys):
+        xs, ys = np.asarray(xs), np.asarray(ys)
+        out = np.zeros(xs.shape, dtype=bool)
+        inside = np.flatnonzero((xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height))
+        size = self.tileSize
+        tx, ty = xs[inside] // size, ys[inside] // size
+        # One lookup per tile the points fall in
+        columns = self.width // size + 1
+        keys, tileOf = np.unique(ty * columns + tx, return_inverse=True)
+        for i, key in enumerate(keys.tolist()):
+            tile = self._tiles.get((key % columns, key // columns))
+            if tile is not None:
+                hit = inside[tileOf == i]
+                out[hit] = tile[ys[hit] % size, xs[hit] % size]
+        return out
+
+    def bbox(self):
+        return self._projections.bbox()
+
+    def crop(self):
+        box = self.bbox()
+        if box is None:
+            return 0, 0, np.zeros((0, 0), dtype=bool)
+        x0, y0, x1, y1 = box
+        return x0, y0, self.region(box)
+
+    def compact(self):
+        """Tiles are released as soon as they are erased, so there is nothing to give back."""
+
+    def full(self):
+        out = np.zeros((self.height, self.width), dtype=bool)
+        for _, ox, oy, tile in self.blocks():
+            th, tw = tile.shape
+            out[oy:oy + th, ox:ox + tw] = tile
+        return out
+
+    def _tileRange(self, window):
+        size = self.tileSize
+        x0, y0, x1, y1 = window
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+        if x1 <= x0 or y1 <= y0:
+            return 0, 0, 0, 0
+        return x0 // size, y0 // size, (x1 - 1) // size + 1, (y1 - 1) // size + 1
+
+    def _keys(self, window):
+        tx0, ty0, tx1, ty1 = self._tileRange(window)
+        return [(tx, ty) for ty in range(ty0, ty1) for tx in range(tx0, tx1)]
+
+    def _tileShape(self, tx, ty):
+        size = self.tileSize
+        # Tiles on the right and bottom edges stop at the canvas border
+        return min(size, self.height - ty * size), min(size, self.width - tx * size)
+
+    def _newTile(self, tx, ty):
+        return np.zeros(self._tileShape(tx, ty), dtype=bool)
+
+    def _store(self, key, tile):
+        self._tiles[key] = tile
+        self._version += 1
+        self._versions[key] = self._version
+
+    def _stamp(self, window, stamp, args, value):
+        size = self.tileSize
+        for key in self._keys(window):
+            tile = self._tiles.get(key)
+            origin = (key[0] * size, key[1] * size)
+            if tile is not None:
+                self._projections.stamp(tile, origin, window, stamp, args)
+                if value or tile.any():
+                    self._store(key, tile)
+                else:
+                    # Erased completely
+                    del self._tiles[key]
+                    del self._versions[key]
+            elif value:
+                tile = self._newTile(*key)
+                stamp(tile, *args, origin=origin)
+                # The stroke's bounding box can cover tiles it does not touch
+                if tile.any():
+                    self._store(key, tile)
+                    self._projections.add(origin[0], origin[1], tile)
@@ -0,0 +1,90 @@
+import numpy as np
+import shapely
+
+from libs.polygon import Polygon
+
+
+class OcclusionGraph(object):
+    """
+        Visible geometry of stacked polygons: every polygon minus the
+        earlier ones it overlaps.
+
+        Remembers which polygons overlap and the version of each polygon it
+        last saw, so after an edit only the moved polygon and those it
+        covers are cut again. Brushes do not occlude.
+    """
+
+    def __init__(self):
+        self._order = ()
+        self._index = {}
+        self._bounds = np.zeros((0, 4))
+        # STRtree over the bounding boxes, rebuilt after any of them moved
+        self._tree = None
+        self._versions = {}
+        self._boxes = {}
+        # Earlier polygons overlapping each polygon, in paint order
+        self._occluders = {}
+        # polygon -> (key, geom_points) of its visible part
+        self._visible = {}
+
+    def update(self, shapes):
+        """Bring the graph up to date with shapes, in paint order."""
+        order = tuple(shape for shape in shapes if isinstance(shape, Polygon) and shape.points)
+        changed = [shape for shape in order if self._versions.get(shape) != shape.version]
+        oldBoxes = {}
+        for shape in changed:
+            oldBoxes[shape] = self._boxes.get(shape)
+            self._versions[shape] = shape.version
+            points = np.asarray(shape.get_points_tuple())
+            self._boxes[shape] = tuple(points.min(axis=0)) + tuple(points.max(axis=0))
+
+        if order != self._order:
+            for shape in set(self._order) - set(order):
+                for table in (self._versions, self._boxes, self._occluders, self._visible):
+                    table.pop(shape, None)
+            self._order = order
+            self._index = {shape: i for i, shape in enumerate(order)}
+            self._bounds = np.array([self._boxes[shape] for shape in order], dtype=np.float64).reshape(-1, 4)
+            self._tree = None
+            affected = range(len(order))
+        elif changed:
+            for shape in changed:
+                self._bounds[self._index[shape]] = self._boxes[shape]
+            self._tree = None
+            # Polygons covered by a changed one, where it was or where it is
+            affected = set()
+            for shape in changed:
+                i = self._index[shape]
+                affected.add(i)
+                for box in (oldBoxes[shape], self._boxes[shape]):
+                    if box is not None:
+                        hits = self._overlapping(box)
+                        affected.update(hits[hits > i].tolist())
+            affected = sorted(affected)
+        else:
+            affected = ()
+
+        for i in affected:
+            hits = self._overlapping(self._bounds[i])
+            self._occluders[order[i]] = tuple(order[j] for j in hits[hits < i])
+
+    def _overlapping(self, box):
+        """Sorted indices of the polygons whose bounding boxes overlap or touch box."""
+        if self._tree is None:
+            self._tree = shapely.STRtree(shapely.box(*self._bounds.T))
+        return np.sort(self._tree.query(shapely.box(*box)))
+
+    def visible(self, shape):
+        """(geometry, [QPointF, ...]) of every visible part of shape, like Polygon.self_poly_geom_points."""
+        occluders = self._occluders.get(shape, ())
+        key = (shape.version, occluders, tuple(occluder.version for occluder in occluders))
+        cached = self._visible.get(shape)
+        if cached is None or cached[0] != key:
+            geom_points = Polygon.self_poly_geom_points(
+                points=shape.get_points_tuple(),
+                prev_shape_points=tuple(occluder.get_points_tuple() for occluder in occluders),
+            )
+            cached = (key, geom_points)
+            if shape in self._index:
+                self._visible[shape] = cached
+        return cached[1]
@@ -2,13 +2,36 @@
 # -*- coding: utf8 -*-
 import sys
 from collections import defaultdict
-from xml.etree import ElementTree
-from xml.etree.ElementTree import Element, SubElement
+import base64
+import itertools
+import os
 from lxml import etree
-import codecs
+from lxml.etree import Element, SubElement
+import numpy as np
+
+from libs.brush_history import compact_history, DEFAULT_CHECKPOINT_INTERVAL
+from libs.rle import rle_encode, rle_decode
 
 XML_EXT = '.xml'
 ENCODE_METHOD = 'utf-8'
+INDENT = '\t'
+
+# (display name, category id) of the label categories annotation files are
+# written with
+LABEL_CATEGORIES = (
+    ("Objects", "object"),
+    ("Suction Regions", "suction_region")
+)
+
+# How brush stroke history is stored: one element per event, or a single
+# base64 record array per brush
+BRUSH_ENCODING_VERBOSE = 'verbose'
+BRUSH_ENCODING_PACKED = 'packed'
+
+# Packed history records are rows of (type, erasing, radius, x1, y1, x2, y2).
+# A polyline is a header row (2, erasing, radius, count, 0, 0, 0) followed by
+# rows (3, 0, 0, x1, y1, x2, y2) holding its points two at a time
+_PACKED_FIELDS = 7
 
 
 class PascalVocWriter:
@@ -23,18 +46,21 @@ class PascalVocWriter:
         self.localImgPath = localImgPath
         self.labelCategories = labelCategories
         self.verified = False
-
-    def prettify(self, elem):
-        """
-            Return a pretty-printed XML string for the Element.
-        """
-        rough_string = ElementTree.tostring(elem, 'utf8')
-        root = etree.fromstring(rough_string)
-        return etree.tostring(root, pretty_print=True, encoding=ENCODE_METHOD).replace("  ".encode(), "\t".encode())
+        self.brushEncoding = BRUSH_ENCODING_VERBOSE
+        # Compact brush histories before writing them, see brush_history
+        self.compactBrushHistory = False
+        self.brushCheckpointInterval = DEFAULT_CHECKPOINT_INTERVAL
+
+    def getHeader(self):
+        """(folder, filename, path, size) written to the file header."""
+        size = tuple(int(v) for v in self.imgSize) if self.imgSize is not None else None
+        if size is not None and len(size) == 2:
+            size += (1,)
+        return self.foldername, self.filename, self.localImgPath, size
 
     def genXML(self):
         """
-            Return XML root
+            Return XML root attributes and header elements, or None
         """
         # Check conditions
         if self.filename is None or \
@@ -42,25 +68,28 @@ class PascalVocWriter:
                         self.imgSize is None:
             return None
 
-        top = Element('annotation')
+        attrib = {}
         if self.verified:
-            top.set('verified', 'yes')
+            attrib['verified'] = 'yes'
 
-        folder = SubElement(top, 'folder')
+        folder = Element('folder')
         folder.text = self.foldername
 
-        filename = SubElement(top, 'filename')
+        filename = Element('filename')
         filename.text = self.filename
+        header = [folder, filename]
 
         if self.localImgPath is not None:
-            localImgPath = SubElement(top, 'path')
+            localImgPath = Element('path')
             localImgPath.text = self.localImgPath
+            header.append(localImgPath)
 
-        source = SubElement(top, 'source')
+        source = Element('source')
         database = SubElement(source, 'database')
         database.text = self.databaseSrc
+        header.append(source)
 
-        size_part = SubElement(top, 'size')
+        size_part = Element('size')
         width = SubElement(size_part, 'width')
         height = SubElement(size_part, 'height')
         depth = SubElement(size_part, 'depth')
@@ -70,10 +99,12 @@ class PascalVocWriter:
             depth.text = str(self.imgSize[2])
         else:
             depth.text = '1'
+        header.append(size_part)
 
-        segmented = SubElement(top, 'segmented')
+        segmented = Element('segmented')
         segmented.text = '0'
-        return top
+        header.append(segmented)
+        return attrib, header
 
     def addBndBox(self, categoryId, xmin, ymin, xmax, ymax, name, attributes):
         bndbox = {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax}
@@ -87,11 +118,15 @@ class PascalVocWriter:
         polygon['attributes'] = attributes
         self.objlist[categoryId].append(('polygon', polygon))
 
-    def addBrush(self, categoryId, size, offset, history, name, attributes):
-        brush = {'size': size, 'name': name, 'offset': offset, 'history': history, 'attributes': attributes}
+    def addBrush(self, categoryId, size, offset, history, name, attributes, mask=None):
+        brush = {'size': size, 'name': name, 'offset': offset, 'history': history, 'attributes': attributes,
+                 'mask': mask}
         self.objlist[categoryId].append(('brush', brush))
 
-    def appendObjects(self, top):
+    def genObjects(self):
+        """
+            Yield one element per object, in category order
+        """
 
         def _addXY(elem, field, pos):
             pt = SubElement(elem, field)
@@ -118,11 +153,11 @@ class PascalVocWriter:
         for _, categoryId in self.labelCategories:
             for typ, each_object in self.objlist[categoryId]:
                 if typ == 'bndbox':
-                    object_item = SubElement(top, categoryId)
+                    object_item = Element(categoryId)
                     name = SubElement(object_item, 'name')
                     name.text = each_object['name']
                     for attr in each_object['attributes']:
-                        attrElem = SubElement((object_item, 'attribute'))
+                        attrElem = SubElement(object_item, 'attribute')
                         attrElem.text = attr
                     bndbox = SubElement(object_item, 'bndbox')
                     xmin = SubElement(bndbox, 'xmin')
@@ -133,8 +168,9 @@ class PascalVocWriter:
                     xmax.text = str(each_object['xmax'])
                     ymax = SubElement(bndbox, 'ymax')
                     ymax.text = str(each_object['ymax'])
+                    yield object_item
                 elif typ == 'polygon':
-                    object_item = SubElement(top, categoryId)
+                    object_item = Element(categoryId)
                     name = SubElement(object_item, 'name')
                     name.text = each_object['name']
                     for attr in each_object['attributes']:
@@ -143,8 +179,9 @@ class PascalVocWriter:
                     polygon = SubElement(object_item, "polygon")
                     for point in each_object['points']:
                         _addXY(polygon, "point", point)
+                    yield object_item
                 elif typ == 'brush':
-                    object_item = SubElement(top, categoryId)
+                    object_item = Element(categoryId)
                     name = SubElement(object_item, 'name')
                     name.text = each_object['name']
                     for attr in each_object['attributes']:
@@ -153,9 +190,30 @@ class PascalVocWriter:
                     brush = SubElement(object_item, "brush")
                     _addWH(brush, "size", each_object['size'])
                     _addXY(brush, "offset", each_object['offset'])
+                    if each_object['mask'] is not None:
+                        _addMask(brush, each_object['mask'])
+
+                    hist_list = each_object['history']
+                    if self.compactBrushHistory:
+                        width, height = each_object['size']
+                        # Compact what will be stored, i.e. integer coordinates
+                        hist_list = compact_history(_truncateHistory(hist_list), width, height,
+                                                    self.brushCheckpointInterval)
+                    if hist_list and hist_list[0][0] == 'checkpoint':
+                        if _sameMask(hist_list[0][1], each_object['mask']):
+                            # Nothing was painted since, do not store the mask twice
+                            SubElement(brush, 'checkpoint', source='mask')
+                        else:
+                            _addMask(brush, hist_list[0][1], tag='checkpoint')
+                        hist_list = hist_list[1:]
+
+                    if self.brushEncoding == BRUSH_ENCODING_PACKED:
+                        _addPackedHistory(brush, hist_list)
+                        yield object_item
+                        continue
 
                     history = SubElement(brush, "history")
-                    for hist_type, hist_data in each_object['history']:
+                    for hist_type, hist_data in hist_list:
                         if hist_type == 'addPoint':
                             point, radius, erasing = hist_data
                             addPoint = SubElement(history, 'addPoint')
@@ -169,20 +227,199 @@ class PascalVocWriter:
                             _addXY(addLine, "pos2", pos2)
                             _addInt(addLine, "radius", radius)
                             _addBool(addLine, "erasing", erasing)
+                        elif hist_type == 'addPolyline':
+                            points, radius, erasing = hist_data
+                            addPolyline = SubElement(history, 'addPolyline')
+                            for point in points:
+                                _addXY(addPolyline, "point", point)
+                            _addInt(addPolyline, "radius", radius)
+                            _addBool(addPolyline, "erasing", erasing)
+                        else:
+                            raise ValueError(f"Unrecognized history type {hist_type}")
+                    yield object_item
 
     def save(self, targetFile=None):
-        root = self.genXML()
-        self.appendObjects(root)
-        out_file = None
+        result = self.genXML()
+        if result is None:
+            return
+        attrib, header = result
         if targetFile is None:
-            out_file = codecs.open(
-                self.filename + XML_EXT, 'w', encoding=ENCODE_METHOD)
+            targetFile = self.filename + XML_EXT
+
+        # Write next to the target and rename over it, so readers never
+        # see a half written file
+        tmpFile = targetFile + '.tmp'
+        with open(tmpFile, 'wb') as out_file:
+            # Objects are built, indented and flushed one at a time
+            with etree.xmlfile(out_file, encoding=ENCODE_METHOD) as xf:
+                with xf.element('annotation', attrib):
+                    for elem in itertools.chain(header, self.genObjects()):
+                        _indent(elem, level=1)
+                        xf.write('\n' + INDENT, elem)
+                    xf.write('\n')
+            out_file.write(b'\n')
+        os.replace(tmpFile, targetFile)
+
+
+def _is_blank(path):
+    """True if the file is empty or holds nothing but whitespace."""
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            if chunk.strip():
+                return False
+    return True
+
+
+def _indent(elem, level=0):
+    """
+        Indent the children of elem in place, leaving its own tail untouched
+    """
+    if len(elem):
+        childIndent = '\n' + INDENT * (level + 1)
+        elem.text = childIndent
+        for child in elem:
+            _indent(child, level + 1)
+            child.tail = childIndent
+        child.tail = '\n' + INDENT * level
+
+
+def _truncateHistory(history):
+    """History with its coordinates truncated to integers, as they are written."""
+    def pt(p):
+        return (int(p[0]), int(p[1]))
+    truncated = []
+    for hist_type, hist_data in history:
+        if hist_type == 'addPoint':
+            point, radius, erasing = hist_data
+            hist_data = (pt(point), radius, erasing)
+        elif hist_type == 'addLine':
+            pos1, pos2, radius, erasing = hist_data
+            hist_data = (pt(pos1), pt(pos2), radius, erasing)
+        elif hist_type == 'addPolyline':
+            points, radius, erasing = hist_data
+            hist_data = ([pt(p) for p in points], radius, erasing)
+        truncated.append((hist_type, hist_data))
+    return truncated
+
+
+def _addMask(brush, mask, tag="mask"):
+    x, y, cropped = mask
+    height, width = cropped.shape
+    elem = SubElement(brush, tag, encoding="rle", x=str(int(x)), y=str(int(y)),
+                      width=str(width), height=str(height))
+    elem.text = base64.b64encode(rle_encode(cropped).astype('<u4').tobytes()).decode('ascii')
+
+
+def _sameMask(mask, other):
+    if mask is None or other is None:
+        return False
+    (x, y, cropped), (otherX, otherY, otherCropped) = mask, other
+    return (x, y) == (otherX, otherY) and np.array_equal(cropped, otherCropped)
+
+
+def _readMask(elem):
+    width = int(elem.get('width'))
+    height = int(elem.get('height'))
+    counts = np.frombuffer(base64.b64decode(elem.text or ''), dtype='<u4')
+    return int(elem.get('x')), int(elem.get('y')), rle_decode(counts, (height, width))
+
+
+def pack_history(history):
+    """Brush history, without a checkpoint, as (n, 7) packed records of the smallest dtype that holds them."""
+    rows = []
+    for hist_type, hist_data in history:
+        if hist_type == 'addPoint':
+            point, radius, erasing = hist_data
+            rows.append((0, erasing, radius, point[0], point[1], 0, 0))
+        elif hist_type == 'addLine':
+            pos1, pos2, radius, erasing = hist_data
+            rows.append((1, erasing, radius, pos1[0], pos1[1], pos2[0], pos2[1]))
+        elif hist_type == 'addPolyline':
+            points, radius, erasing = hist_data
+            rows.append((2, erasing, radius, len(points), 0, 0, 0))
+            for i in range(0, len(points), 2):
+                pos1 = points[i]
+                pos2 = points[i + 1] if i + 1 < len(points) else (0, 0)
+                rows.append((3, 0, 0, pos1[0], pos1[1], pos2[0], pos2[1]))
+        else:
+            raise ValueError(f"Unrecognized history type {hist_type}")
+    records = np.array(rows, dtype=np.int64).reshape(-1, _PACKED_FIELDS)
+    if len(records) == 0 or np.abs(records).max() <= np.iinfo(np.int16).max:
+        return records.astype('<i2')
+    return records.astype('<i4')
+
+
+def unpack_history(records):
+    """Brush history from pack_history records."""
+    history = []
+    rows = iter(np.asarray(records).reshape(-1, _PACKED_FIELDS).tolist())
+    for typ, erasing, radius, x1, y1, x2, y2 in rows:
+        if typ == 0:
+            history.append(('addPoint', ((x1, y1), radius, bool(erasing))))
+        elif typ == 1:
+            history.append(('addLine', ((x1, y1), (x2, y2), radius, bool(erasing))))
+        elif typ == 2:
+            points = []
+            for _ in range((x1 + 1) // 2):
+                _, _, _, px1, py1, px2, py2 = next(rows)
+                points.extend(((px1, py1), (px2, py2)))
+            history.append(('addPolyline', (points[:x1], radius, bool(erasing))))
         else:
-            out_file = codecs.open(targetFile, 'w', encoding=ENCODE_METHOD)
+            raise ValueError(f"Unrecognized packed history type {typ}")
+    return history
+
 
-        prettifyResult = self.prettify(root)
-        out_file.write(prettifyResult.decode('utf8'))
-        out_file.close()
+def _addPackedHistory(brush, history):
+    records = pack_history(history)
+    elem = SubElement(brush, "history", encoding=BRUSH_ENCODING_PACKED, dtype=records.dtype.str,
+                      count=str(len(records)))
+    elem.text = base64.b64encode(records.tobytes()).decode('ascii')
+
+
+def _readVerboseHistory(historyElem):
+    history = []
+    for hist in historyElem:
+        if hist.tag == 'addPoint':
+            history.append(
+                (
+                    'addPoint',
+                    (
+                        (int(hist.find("point").find("x").text), int(hist.find("point").find("y").text)),
+                        int(hist.find("radius").text),
+                        _str_to_bool(hist.find("erasing").text),
+                    )
+                )
+            )
+        elif hist.tag == 'addPolyline':
+            history.append(
+                (
+                    'addPolyline',
+                    (
+                        [(int(p.find("x").text), int(p.find("y").text)) for p in hist.iterfind("point")],
+                        int(hist.find("radius").text),
+                        _str_to_bool(hist.find("erasing").text),
+                    )
+                )
+            )
+        elif hist.tag == 'addLine':
+            history.append(
+                (
+                    'addLine',
+                    (
+                        (int(hist.find("pos1").find("x").text), int(hist.find("pos1").find("y").text)),
+                        (int(hist.find("pos2").find("x").text), int(hist.find("pos2").find("y").text)),
+                        int(hist.find("radius").text),
+                        _str_to_bool(hist.find("erasing").text),
+                    )
+                )
+            )
+    return history
+
+
+def _readPackedHistory(elem):
+    dtype = np.dtype(elem.get('dtype'))
+    count = int(elem.get('count'))
+    return unpack_history(np.frombuffer(base64.b64decode(elem.text or ''), dtype=dtype, count=count * _PACKED_FIELDS))
 
 
 def _str_to_bool(s):
@@ -195,11 +432,20 @@ class PascalVocReader:
         self.filepath = filepath
         self.labelCategories = labelCategories
         self.verified = False
+        self.foldername = None
+        self.filename = None
+        self.localImgPath = None
+        # (height, width, depth), as given to PascalVocWriter
+        self.imgSize = None
         self.parseXML()
 
     def getShapes(self):
         return self.shapes
 
+    def getHeader(self):
+        """(folder, filename, path, size) as PascalVocWriter.getHeader."""
+        return self.foldername, self.filename, self.localImgPath, self.imgSize
+
     def addShape(self, category, label, attributes, bndbox):
         xmin = int(bndbox.find('xmin').text)
         ymin = int(bndbox.find('ymin').text)
@@ -218,61 +464,79 @@ class PascalVocReader:
     def addBrush(self, category, label, attributes, brush):
         size = (int(brush.find("size").find("width").text), int(brush.find("size").find("height").text))
         offset = (int(brush.find("offset").find("x").text), int(brush.find("offset").find("y").text))
-        history = []
-        for hist in brush.find("history"):
-            if hist.tag == 'addPoint':
-                history.append(
-                    (
-                        'addPoint',
-                        (
-                            (int(hist.find("point").find("x").text), int(hist.find("point").find("y").text)),
-                            int(hist.find("radius").text),
-                            _str_to_bool(hist.find("erasing").text),
-                        )
-                    )
-                )
-            if hist.tag == 'addLine':
-                history.append(
-                    (
-                        'addLine',
-                        (
-                            (int(hist.find("pos1").find("x").text), int(hist.find("pos1").find("y").text)),
-                            (int(hist.find("pos2").find("x").text), int(hist.find("pos2").find("y").text)),
-                            int(hist.find("radius").text),
-                            _str_to_bool(hist.find("erasing").text),
-                        )
-                    )
-                )
-        self.shapes[category].append((label, attributes, (size, offset, history), 'brush'))
+        historyElem = brush.find("history")
+        if historyElem.get('encoding') == BRUSH_ENCODING_PACKED:
+            history = _readPackedHistory(historyElem)
+        else:
+            history = _readVerboseHistory(historyElem)
+        maskElem = brush.find("mask")
+        mask = None if maskElem is None else _readMask(maskElem)
+        checkpointElem = brush.find("checkpoint")
+        if checkpointElem is not None:
+            if checkpointElem.get('source') == 'mask':
+                if mask is None:
+                    raise ValueError('brush checkpoint refers to a missing <mask>')
+                checkpoint = mask
+            else:
+                checkpoint = _readMask(checkpointElem)
+            history.insert(0, ('checkpoint', checkpoint))
+        self.shapes[category].append((label, attributes, (size, offset, history, mask), 'brush'))
 
     def parseXML(self):
         assert self.filepath.endswith(XML_EXT), "Unsupport file format"
-        parser = etree.XMLParser(encoding=ENCODE_METHOD)
-        if len(open(self.filepath, 'rb').read().strip()) == 0:
-            return True
-        xmltree = ElementTree.parse(self.filepath, parser=parser).getroot()
+        categories = set(cat_id for _, cat_id in self.labelCategories)
+        root = None
+        depth = 0
         try:
-            verified = xmltree.attrib['verified']
-            if verified == 'yes':
-                self.verified = True
-        except KeyError:
-            self.verified = False
-
-        for _, cat_id in self.labelCategories:
-            for object_iter in xmltree.findall(cat_id):
-                bndbox = object_iter.find("bndbox")
-                label = object_iter.find('name').text
-                polygon = object_iter.find("polygon")
-                brush = object_iter.find("brush")
-                attributes = []
-                for attr in object_iter.findall('attribute'):
-                    attributes.append(attr.text.strip())
-                if bndbox is not None:
-                    self.addShape(cat_id, label, attributes, bndbox)
-                elif polygon is not None:
-                    self.addPolygon(cat_id, label, attributes, polygon)
-                elif brush is not None:
-                    self.addBrush(cat_id, label, attributes, brush)
-                else:
-                    raise NotImplementedError
+            for event, elem in etree.iterparse(self.filepath, events=('start', 'end'), encoding=ENCODE_METHOD,
+                                               remove_blank_text=True):
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                        self.verified = elem.get('verified') == 'yes'
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                # Top-level child of <annotation> is complete
+                if elem.tag in categories:
+                    self.addObject(elem.tag, elem)
+                elif elem.tag == 'size':
+                    self.imgSize = (int(elem.findtext('height')), int(elem.findtext('width')),
+                                    int(elem.findtext('depth', '1')))
+                elif elem.tag == 'filename':
+                    self.filename = elem.text
+                elif elem.tag == 'folder':
+                    self.foldername = elem.text
+                elif elem.tag == 'path':
+                    self.localImgPath = elem.text
+                # Drop what has been consumed so memory stays flat
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del root[0]
+        except etree.XMLSyntaxError:
+            # An empty (or blank) file has no annotations yet; anything else
+            # is corrupt and must not load as empty, or the next save would
+            # overwrite it with nothing
+            if root is None and _is_blank(self.filepath):
+                return True
+            raise
         return True
+
+    def addObject(self, cat_id, object_iter):
+        bndbox = object_iter.find("bndbox")
+        label = object_iter.find('name').text
+        polygon = object_iter.find("polygon")
+        brush = object_iter.find("brush")
+        attributes = []
+        for attr in object_iter.iterfind('attribute'):
+            attributes.append(attr.text.strip())
+        if bndbox is not None:
+            self.addShape(cat_id, label, attributes, bndbox)
+        elif polygon is not None:
+            self.addPolygon(cat_id, label, attributes, polygon)
+        elif brush is not None:
+            self.addBrush(cat_id, label, attributes, brush)
+        else:
+            raise NotImplementedError
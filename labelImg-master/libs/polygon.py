@@ -13,6 +13,7 @@ except ImportError:
     from PyQt4.QtCore import *
 
 from libs.lib import distance
+import shapely
 import shapely.geometry
 import shapely.errors
 import numpy as np
@@ -50,7 +51,8 @@ class Polygon(object):
         self.attributes = attributes
         self.points = []
         self.points_tuple = ()
-        self.points_dirty = False
+        # Bumped whenever the points change, see OcclusionGraph
+        self._version = 0
         self.fill = False
         self.selected = False
         self.difficult = difficult
@@ -74,6 +76,20 @@ class Polygon(object):
     def close(self):
         self._closed = True
 
+    @property
+    def points(self):
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        self._points = points
+        self.points_dirty = True
+
+    @property
+    def version(self):
+        self.get_points_tuple()
+        return self._version
+
     @property
     def labelWithAttributes(self):
         if len(self.attributes) > 0:
@@ -103,6 +119,7 @@ class Polygon(object):
         if self.points_dirty:
             self.points_tuple = tuple([(p.x(), p.y()) for p in self.points])
             self.points_dirty = False
+            self._version += 1
         return self.points_tuple
 
     def isClosed(self):
@@ -128,26 +145,31 @@ class Polygon(object):
     @lru_cache(maxsize=1000)
     @profile
     def compute_self_poly(points, prev_shape_points):
+        # prev_shape_points are expected to be pre-filtered, see overlapping_points
         poly = Polygon.get_shapely_polygon(points)
-        min_xy = np.min(points, axis=0)
-        max_xy = np.max(points, axis=0)
-
-        if prev_shape_points:
-            for prev_shape_pts in prev_shape_points:
-                prev_shape_pts_np = np.asarray(prev_shape_pts)
-                prev_min_xy = np.min(prev_shape_pts_np, axis=0)
-                if np.any(max_xy < prev_min_xy):
-                    continue
-                prev_max_xy = np.max(prev_shape_pts_np, axis=0)
-                if np.any(min_xy > prev_max_xy):
-                    continue
-                prev_poly = Polygon.get_shapely_polygon(prev_shape_pts)
-                try:
-                    poly = poly.difference(prev_poly)
-                except shapely.errors.TopologicalError:
-                    poly = poly.buffer(0).difference(prev_poly.buffer(0))
+
+        for prev_shape_pts in prev_shape_points or ():
+            prev_poly = Polygon.get_shapely_polygon(prev_shape_pts)
+            try:
+                poly = poly.difference(prev_poly)
+            except (shapely.errors.TopologicalError, shapely.errors.GEOSException):
+                poly = poly.buffer(0).difference(prev_poly.buffer(0))
         return poly
 
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def _occluder_tree(prev_shape_points):
+        # Built once per stack of shapes rather than once per shape painted over it
+        return shapely.STRtree([Polygon.get_shapely_polygon(pts) for pts in prev_shape_points])
+
+    @staticmethod
+    def overlapping_points(points, prev_shape_points):
+        """The prev_shape_points, in order, whose bounding boxes meet the shape at points."""
+        if not prev_shape_points:
+            return ()
+        hits = Polygon._occluder_tree(prev_shape_points).query(Polygon.get_shapely_polygon(points))
+        return tuple(prev_shape_points[i] for i in np.sort(hits))
+
     @staticmethod
     @lru_cache(maxsize=1000)
     @profile
@@ -174,7 +196,7 @@ class Polygon(object):
         return geom_points
 
     @profile
-    def paint(self, painter, prev_shapes=None, scale=None):
+    def paint(self, painter, prev_shapes=None, scale=None, occlusion=None):
         drawAllVertices = True
         if scale is None:
             scale = self.scale
@@ -184,8 +206,10 @@ class Polygon(object):
                 dists = [abs(p.x() - q.x()) + abs(p.y() - q.y()) for q in self.points]
                 return min(dists) < 1e-5
 
-            if prev_shapes is None:
-                prev_shape_points = None
+            if occlusion is not None:
+                geom_points = occlusion.visible(self)
+            elif prev_shapes is None:
+                geom_points = self.self_poly_geom_points(points=self.get_points_tuple(), prev_shape_points=None)
             else:
                 prev_shape_points = []
                 for shape in prev_shapes:
@@ -193,12 +217,14 @@ class Polygon(object):
                         continue
                     if isinstance(shape, Polygon):
                         prev_shape_points.append(shape.get_points_tuple())
-                prev_shape_points = tuple(prev_shape_points)
-
-            for geom, points in self.self_poly_geom_points(
+                # Only the shapes whose bounding boxes meet this one can cut it
+                prev_shape_points = self.overlapping_points(self.get_points_tuple(), tuple(prev_shape_points))
+                geom_points = self.self_poly_geom_points(
                     points=self.get_points_tuple(),  # tuple([(p.x(), p.y()) for p in self.points]),
                     prev_shape_points=prev_shape_points,
-            ):
+                )
+
+            for geom, points in geom_points:
                 color = self.select_line_color if self.selected else self.line_color
                 pen = QPen(color)
                 # Try using integer sizes for smoother drawing(?)
@@ -333,13 +359,15 @@ class Polygon(object):
     def __setitem__(self, key, value):
         self.points[key] = value
 
-    def get_unoccluded_mask(self, size):
+    def get_unoccluded_mask(self, size, window=None):
         import numpy as np
         assert self._closed
-        bitmap = QBitmap(size)
+        x0, y0, x1, y1 = window if window is not None else (0, 0, size.width(), size.height())
+        bitmap = QBitmap(QSize(x1 - x0, y1 - y0))
         bitmap.clear()
         p = QPainter()
         p.begin(bitmap)
+        p.translate(-x0, -y0)
         p.setPen(Qt.color1)
         p.setBrush(Qt.color1)
         line_path = QPainterPath()
@@ -353,7 +381,8 @@ class Polygon(object):
         image = bitmap.toImage().convertToFormat(QImage.Format_Indexed8)
         ptr = image.constBits()
         ptr.setsize(image.byteCount())
+        # Copied, the buffer goes away with image
         mask = np.frombuffer(ptr, count=image.byteCount(), dtype=np.uint8).reshape(
-            image.height(), image.bytesPerLine())[:image.height(), :image.width()]
+            image.height(), image.bytesPerLine())[:image.height(), :image.width()].copy()
 
         return mask
@@ -0,0 +1,168 @@
+import numpy as np
+
+
+def dilate_mask(mask, radius):
+    """Grow mask by a disc of the given radius; the result is padded by radius on every side."""
+    h, w = mask.shape
+    out = np.zeros((h + 2 * radius, w + 2 * radius), dtype=bool)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if dx * dx + dy * dy <= radius * radius:
+                out[radius + dy:radius + dy + h, radius + dx:radius + dx + w] |= mask
+    return out
+
+
+def polygon_mask(points, height, width):
+    """
+        Rasterize a polygon with the even-odd rule, sampling pixel centres.
+        Returns (x, y, cropped) with cropped covering the polygon's bounding
+        box clipped to the image.
+    """
+    pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(pts) < 3:
+        return 0, 0, np.zeros((0, 0), dtype=bool)
+    x0 = max(int(np.floor(pts[:, 0].min())), 0)
+    y0 = max(int(np.floor(pts[:, 1].min())), 0)
+    x1 = min(int(np.ceil(pts[:, 0].max())) + 1, width)
+    y1 = min(int(np.ceil(pts[:, 1].max())) + 1, height)
+    if x1 <= x0 or y1 <= y0:
+        return 0, 0, np.zeros((0, 0), dtype=bool)
+
+    # Crossings of every edge with every scanline through pixel centres
+    ax, ay = pts[:, 0], pts[:, 1]
+    bx, by = np.roll(ax, -1), np.roll(ay, -1)
+    yc = np.arange(y0, y1, dtype=np.float64)[:, None] + 0.5
+    crosses = (ay <= yc) != (by <= yc)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xs = ax + (yc - ay) * (bx - ax) / (by - ay)
+    rows, edges = np.nonzero(crosses)
+    # A pixel is inside once its centre passes an odd number of crossings
+    cols = np.clip(np.ceil(xs[rows, edges] - 0.5).astype(np.int64) - x0, 0, x1 - x0)
+    toggles = np.zeros((y1 - y0, x1 - x0 + 1), dtype=np.int32)
+    np.add.at(toggles, (rows, cols), 1)
+    inside = np.cumsum(toggles, axis=1)[:, :-1] % 2 == 1
+    return x0, y0, inside
+
+
+# QPainter's aliased drawEllipse also covers its one pixel outline, so its
+# discs reach slightly past the radius around the pixel the centre falls in
+DISC_RADIUS_PAD = 0.4
+
+
+def disc_window(center, radius):
+    """Pixel rectangle (x0, y0, x1, y1), end exclusive, that stamp_disc may touch."""
+    cx, cy = np.floor(center[0]), np.floor(center[1])
+    reach = radius + DISC_RADIUS_PAD
+    return (int(np.floor(cx - reach)), int(np.floor(cy - reach)),
+            int(np.ceil(cx + reach)) + 1, int(np.ceil(cy + reach)) + 1)
+
+
+def capsule_window(pos1, pos2, radius):
+    """Pixel rectangle (x0, y0, x1, y1), end exclusive, that stamp_capsule may touch."""
+    return (int(np.floor(min(pos1[0], pos2[0]) - radius - 1)), int(np.floor(min(pos1[1], pos2[1]) - radius - 1)),
+            int(np.ceil(max(pos1[0], pos2[0]) + radius)) + 1, int(np.ceil(max(pos1[1], pos2[1]) + radius)) + 1)
+
+
+def _clip(window, mask, origin):
+    ox, oy = origin
+    h, w = mask.shape
+    x0, y0, x1, y1 = window
+    return max(x0, ox), max(y0, oy), min(x1, ox + w), min(y1, oy + h)
+
+
+def stamp_disc(mask, center, radius, value=True, origin=(0, 0)):
+    """
+        Set (or clear) the pixels that QPainter.drawEllipse(center, radius,
+        radius) covers. mask[0, 0] is the pixel at origin.
+    """
+    x0, y0, x1, y1 = _clip(disc_window(center, radius), mask, origin)
+    if x1 <= x0 or y1 <= y0:
+        return
+    cx, cy = np.floor(center[0]), np.floor(center[1])
+    reach = radius + DISC_RADIUS_PAD
+    dx = np.arange(x0, x1, dtype=np.float64)[None, :] - cx
+    dy = np.arange(y0, y1, dtype=np.float64)[:, None] - cy
+    ox, oy = origin
+    mask[y0 - oy:y1 - oy, x0 - ox:x1 - ox][dx * dx + dy * dy <= reach * reach] = value
+
+
+def stamp_capsule(mask, pos1, pos2, radius, value=True, origin=(0, 0)):
+    """
+        Set (or clear) the pixels whose centres lie within radius of the
+        segment pos1-pos2, i.e. a line drawn with a round capped pen.
+        mask[0, 0] is the pixel at origin.
+    """
+    x0, y0, x1, y1 = _clip(capsule_window(pos1, pos2, radius), mask, origin)
+    if x1 <= x0 or y1 <= y0:
+        return
+    ax, ay = float(pos1[0]), float(pos1[1])
+    bx, by = float(pos2[0]), float(pos2[1])
+    px = np.arange(x0, x1, dtype=np.float64)[None, :] + 0.5 - ax
+    py = np.arange(y0, y1, dtype=np.float64)[:, None] + 0.5 - ay
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    if length2 > 0:
+        t = np.clip((px * dx + py * dy) / length2, 0.0, 1.0)
+        px = px - t * dx
+        py = py - t * dy
+    ox, oy = origin
+    mask[y0 - oy:y1 - oy, x0 - ox:x1 - ox][px * px + py * py <= radius * radius] = value
+
+
+def stroke_window(hist_type, hist_data):
+    """Pixel rectangle (x0, y0, x1, y1), end exclusive, that a history stroke may touch."""
+    if hist_type == 'addPoint':
+        point, radius, erasing = hist_data
+        return disc_window(point, radius)
+    elif hist_type == 'addLine':
+        pos1, pos2, radius, erasing = hist_data
+        return capsule_window(pos1, pos2, radius)
+    elif hist_type == 'addPolyline':
+        points, radius, erasing = hist_data
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        return capsule_window((min(xs), min(ys)), (max(xs), max(ys)), radius)
+    raise ValueError(f"Unrecognized history type {hist_type}")
+
+
+def stamp_stroke(mask, hist_type, hist_data, value=None, origin=(0, 0)):
+    """Apply one history stroke to mask; value overrides what the stroke paints."""
+    if value is None:
+        value = not hist_data[-1]
+    if hist_type == 'addPoint':
+        point, radius, erasing = hist_data
+        stamp_disc(mask, point, radius, value, origin)
+    elif hist_type == 'addLine':
+        pos1, pos2, radius, erasing = hist_data
+        stamp_capsule(mask, pos1, pos2, radius, value, origin)
+    elif hist_type == 'addPolyline':
+        points, radius, erasing = hist_data
+        for pos1, pos2 in zip(points[:-1], points[1:]):
+            stamp_capsule(mask, pos1, pos2, radius, value, origin)
+    else:
+        raise ValueError(f"Unrecognized history type {hist_type}")
+
+
+def replay_history(history, height, width, mask=None, origin=(0, 0)):
+    """
+        Replay brush history into a (height, width) bool mask in brush
+        coordinates. mask[0, 0] is the pixel at origin, so a window of the
+        brush can be replayed without allocating the rest of it.
+    """
+    if mask is None:
+        mask = np.zeros((height, width), dtype=bool)
+    ox, oy = origin
+    for hist_type, hist_data in history:
+        if hist_type == 'checkpoint':
+            # A checkpoint holds the whole mask at that point of the history
+            x, y, cropped = hist_data
+            x, y = x - ox, y - oy
+            mask[:] = False
+            h, w = cropped.shape
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + w, width), min(y + h, height)
+            if x1 > x0 and y1 > y0:
+                mask[y0:y1, x0:x1] = cropped[y0 - y:y1 - y, x0 - x:x1 - x]
+        else:
+            stamp_stroke(mask, hist_type, hist_data, origin=origin)
+    return mask
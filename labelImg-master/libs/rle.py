@@ -0,0 +1,88 @@
+import numpy as np
+
+
+def rle_encode(mask):
+    """
+        Run-length encode a 2d mask in row-major order. Runs alternate
+        between unset and set pixels, starting with an unset run.
+    """
+    flat = np.asarray(mask, dtype=bool).ravel()
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.uint32)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(bounds)
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.astype(np.uint32)
+
+
+def rle_decode(counts, shape):
+    counts = np.asarray(counts, dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(shape)
+
+
+def crop_mask(mask):
+    """
+        Return (x, y, cropped) where cropped is the bounding box of the set
+        pixels of mask, or an empty (0, 0) array when nothing is set.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return 0, 0, np.zeros((0, 0), dtype=bool)
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0, y1 = rows[0], rows[-1] + 1
+    x0, x1 = cols[0], cols[-1] + 1
+    return int(x0), int(y0), mask[y0:y1, x0:x1]
+
+
+def clip_mask(x, y, cropped, height, width):
+    """Return (x, y, cropped) with a cropped mask placed at (x, y) cut down to the image."""
+    cropped = np.asarray(cropped, dtype=bool)
+    h, w = cropped.shape
+    cx0, cy0 = max(-x, 0), max(-y, 0)
+    cx1, cy1 = min(w, width - x), min(h, height - y)
+    if cx1 <= cx0 or cy1 <= cy0:
+        return 0, 0, np.zeros((0, 0), dtype=bool)
+    return x + cx0, y + cy0, cropped[cy0:cy1, cx0:cx1]
+
+
+def coco_rle_counts(x, y, cropped, height, width):
+    """
+        Column-major run lengths over the whole image for a cropped mask
+        placed at (x, y), as used by COCO segmentation RLE.
+    """
+    x, y, cropped = clip_mask(x, y, cropped, height, width)
+    h, w = cropped.shape
+    if h == 0 or w == 0:
+        return [height * width]
+    strip = np.zeros((w, height), dtype=bool)
+    strip[:, y:y + h] = cropped.T
+    counts = rle_encode(strip).astype(np.int64)
+    # Whole empty columns before and after the strip join the first and last runs
+    counts[0] += x * height
+    if len(counts) % 2 == 1:
+        counts[-1] += (width - x - w) * height
+    elif width - x - w > 0:
+        counts = np.append(counts, (width - x - w) * height)
+    return counts.tolist()
+
+
+def coco_rle_string(counts):
+    """Compress run lengths into the COCO (pycocotools) RLE string form."""
+    out = []
+    for i, value in enumerate(counts):
+        value = int(value)
+        if i > 2:
+            value -= int(counts[i - 2])
+        more = True
+        while more:
+            c = value & 0x1f
+            value >>= 5
+            more = value != -1 if c & 0x10 else value != 0
+            if more:
+                c |= 0x20
+            out.append(chr(c + 48))
+    return ''.join(out)
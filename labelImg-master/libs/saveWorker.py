@@ -0,0 +1,101 @@
+try:
+    from PyQt5.QtCore import QObject, pyqtSignal
+except ImportError:
+    from PyQt4.QtCore import QObject, pyqtSignal
+
+import threading
+from collections import OrderedDict
+
+
+class SaveWorker(QObject):
+    """
+        Writes annotation files on a background thread.
+
+        Jobs are keyed on their target path; submitting a new job for a path
+        that has not been written yet replaces the pending one, so only the
+        latest snapshot of an image is serialized. Jobs that fail are kept
+        until they are retried or discarded, so their snapshot is not lost.
+    """
+    saved = pyqtSignal(str)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, parent=None):
+        super(SaveWorker, self).__init__(parent)
+        self._pending = OrderedDict()
+        self._active = None
+        self._failed = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='SaveWorker', daemon=True)
+        self._thread.start()
+
+    def submit(self, path, job):
+        """Queue job(path) to run off the UI thread, replacing any pending job for path."""
+        with self._cond:
+            self._pending.pop(path, None)
+            self._failed.pop(path, None)
+            self._pending[path] = job
+            self._cond.notify_all()
+
+    def failedPaths(self):
+        with self._cond:
+            return list(self._failed)
+
+    def retry(self, path):
+        """Queue the failed job for path again; returns False when there is none."""
+        with self._cond:
+            job = self._failed.pop(path, None)
+        if job is None:
+            return False
+        self.submit(path, job)
+        return True
+
+    def discard(self, path):
+        with self._cond:
+            self._failed.pop(path, None)
+
+    def isPending(self, path=None):
+        with self._cond:
+            return self._isPending(path)
+
+    def wait(self, path=None):
+        """Block until path (or every queued path when None) has been written."""
+        with self._cond:
+            while self._isPending(path):
+                self._cond.wait()
+
+    def shutdown(self):
+        self.wait()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _isPending(self, path):
+        if path is None:
+            return bool(self._pending) or self._active is not None
+        return path in self._pending or self._active == path
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                path, job = self._pending.popitem(last=False)
+                self._active = path
+            try:
+                job(path)
+            except Exception as e:
+                with self._cond:
+                    # Unless a newer snapshot was queued in the meantime
+                    if path not in self._pending:
+                        self._failed[path] = job
+                self.failed.emit(path, str(e))
+            else:
+                self.saved.emit(path)
+            finally:
+                with self._cond:
+                    self._active = None
+                    self._cond.notify_all()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import shapely.geometry
+from shapely.validation import explain_validity
+
+from libs.bulk_reader import list_annotation_files
+from libs.coco_export import brush_mask
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocReader
+from libs.rle import crop_mask
+
+# A file is a slow outlier when it parses this many times slower than the median
+DEFAULT_SLOW_FACTOR = 10.0
+# ... and takes at least this long, so tiny corpora do not flag noise
+MIN_SLOW_SECONDS = 0.05
+
+
+def _bounds_problem(xmin, ymin, xmax, ymax, height, width):
+    if xmin < 0 or ymin < 0 or xmax > width or ymax > height:
+        return 'out of bounds (%g, %g, %g, %g) for a %dx%d image' % (xmin, ymin, xmax, ymax, width, height)
+    return None
+
+
+def _shape_problems(points, typ, height, width):
+    problems = []
+    if typ == 'rect':
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        if min(xs) >= max(xs) or min(ys) >= max(ys):
+            problems.append('empty bounding box')
+        bbox = (min(xs), min(ys), max(xs), max(ys))
+    elif typ == 'polygon':
+        if len(points) < 3:
+            return ['polygon with %d points' % len(points)]
+        polygon = shapely.geometry.Polygon(points)
+        if not polygon.is_valid:
+            problems.append('invalid polygon: %s' % explain_validity(polygon))
+        bbox = polygon.bounds
+    elif typ == 'brush':
+        # The painted pixels themselves, a stroke's radius may reach past the edge unpainted
+        x, y, mask = brush_mask(points)
+        cx, cy, cropped = crop_mask(mask)
+        h, w = cropped.shape
+        if h == 0 or w == 0:
+            return ['empty brush']
+        bbox = (x + cx, y + cy, x + cx + w, y + cy + h)
+    else:
+        return ['unknown shape type %r' % typ]
+    problem = _bounds_problem(*bbox, height=height, width=width)
+    if problem is not None:
+        problems.append(problem)
+    return problems
+
+
+def validate_file(args):
+    """Worker: return (path, parse seconds, [problem, ...]) for one annotation file."""
+    xmlPath, labelCategories = args
+    start = time.perf_counter()
+    try:
+        reader = PascalVocReader(xmlPath, labelCategories)
+    except Exception as e:
+        message = '%s: %s' % (type(e).__name__, e) if str(e) else type(e).__name__
+        return xmlPath, time.perf_counter() - start, ['malformed: ' + message]
+    seconds = time.perf_counter() - start
+
+    if reader.imgSize is None:
+        return xmlPath, seconds, ['missing <size>']
+    height, width = reader.imgSize[:2]
+    problems = []
+    shapes = reader.getShapes()
+    for _, categoryId in labelCategories:
+        for i, (label, _attributes, points, typ) in enumerate(shapes[categoryId]):
+            try:
+                shapeProblems = _shape_problems(points, typ, height, width)
+            except Exception as e:
+                shapeProblems = ['malformed: %s: %s' % (type(e).__name__, e)]
+            for problem in shapeProblems:
+                problems.append('%s %d (%s %r): %s' % (categoryId, i, typ, label, problem))
+    return xmlPath, seconds, problems
+
+
+class ValidationReport(object):
+
+    def __init__(self, paths, seconds, problems, slowFactor=DEFAULT_SLOW_FACTOR):
+        self.paths = paths
+        self.seconds = seconds
+        self.problems = problems
+        self.totalSeconds = 0.0
+        median = float(np.median(seconds)) if len(seconds) else 0.0
+        threshold = max(median * slowFactor, MIN_SLOW_SECONDS)
+        slow = np.flatnonzero(seconds > threshold)
+        self.slow = [(paths[i], float(seconds[i])) for i in slow[np.argsort(-seconds[slow])]]
+        self.medianSeconds = median
+
+    def summary(self):
+        rate = len(self.paths) / self.totalSeconds if self.totalSeconds > 0 else float('inf')
+        return ('%d files, %d with problems, %d slow to parse (median %.1f ms) in %.1fs (%.1f files/s)'
+                % (len(self.paths), len(self.problems), len(self.slow), self.medianSeconds * 1000,
+                   self.totalSeconds, rate))
+
+
+def validate(source, labelCategories, processes=None, chunksize=64, slowFactor=DEFAULT_SLOW_FACTOR):
+    """
+        Check every annotation file in source (a directory or a list of XML
+        paths) across a process pool and return a ValidationReport.
+    """
+    labelCategories = tuple(tuple(c) for c in labelCategories)
+    paths = list_annotation_files(source)
+    start = time.time()
+    seconds = np.zeros(len(paths), dtype=np.float64)
+    problems = {}
+    index = dict((path, i) for i, path in enumerate(paths))
+    jobs = ((path, labelCategories) for path in paths)
+
+    pool = Pool(processes) if processes != 1 else None
+    try:
+        results = pool.imap_unordered(validate_file, jobs, chunksize) if pool else map(validate_file, jobs)
+        for path, parseSeconds, fileProblems in results:
+            seconds[index[path]] = parseSeconds
+            if fileProblems:
+                problems[path] = fileProblems
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    report = ValidationReport(paths, seconds, dict(sorted(problems.items())), slowFactor=slowFactor)
+    report.totalSeconds = time.time() - start
+    return report
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Check annotation XML files for problems')
+    parser.add_argument('source', type=str, help='directory of annotation XML files')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--slow-factor', type=float, default=DEFAULT_SLOW_FACTOR,
+                        help='report files parsing this many times slower than the median')
+    args = parser.parse_args(argv)
+
+    report = validate(args.source, LABEL_CATEGORIES, processes=args.processes, slowFactor=args.slow_factor)
+    for path, problems in report.problems.items():
+        for problem in problems:
+            print('%s: %s' % (path, problem))
+    for path, parseSeconds in report.slow:
+        print('%s: slow to parse (%.1f ms)' % (path, parseSeconds * 1000))
+    print(report.summary(), file=sys.stderr)
+    return 1 if report.problems else 0
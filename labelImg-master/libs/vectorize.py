@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+import json
+import sys
+import time
+from multiprocessing import Pool
+
+from libs.bulk_reader import list_annotation_files
+from libs.coco_export import brush_mask
+from libs.contour import mask_polygons
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocReader
+
+# Polygons may deviate this many pixels from the traced pixel outline
+DEFAULT_TOLERANCE = 1.0
+
+
+def polygon_rings(polygon):
+    """Coordinates of a shapely Polygon as [exterior, hole, ...], each ring a list of [x, y] without repeating the first point."""
+    return [[list(p) for p in ring.coords[:-1]] for ring in [polygon.exterior] + list(polygon.interiors)]
+
+
+def vectorize_file(args):
+    """
+        Worker: return (path, brushes, errors) with the traced polygons of
+        every brush in one annotation file. brushes is None when the file
+        could not be read at all; a brush that fails to trace is left out
+        and its error listed.
+    """
+    xmlPath, labelCategories, tolerance, minArea = args
+    try:
+        shapes = PascalVocReader(xmlPath, labelCategories).getShapes()
+    except Exception as e:
+        return xmlPath, None, ['%s: %s' % (type(e).__name__, e)]
+    brushes = []
+    errors = []
+    for _, categoryId in labelCategories:
+        for label, attributes, points, typ in shapes[categoryId]:
+            if typ != 'brush':
+                continue
+            try:
+                x, y, cropped = brush_mask(points)
+                polygons = mask_polygons(cropped, x, y, tolerance=tolerance, minArea=minArea)
+            except Exception as e:
+                errors.append('brush %r: %s: %s' % (label, type(e).__name__, e))
+                continue
+            brushes.append(dict(
+                file=xmlPath,
+                category=categoryId,
+                label=label,
+                attributes=list(attributes),
+                polygons=[polygon_rings(polygon) for polygon in polygons],
+            ))
+    return xmlPath, brushes, errors
+
+
+class VectorizeStats(object):
+
+    def __init__(self):
+        self.files = 0
+        self.brushes = 0
+        self.polygons = 0
+        self.holes = 0
+        # Brushes left out of a traced file, and files not traced at all
+        self.failed = []
+        self.errors = []
+        self.seconds = 0.0
+
+    def summary(self):
+        return ('%d files, %d brushes traced into %d polygons with %d holes, %d failed, %d errors in %.1fs'
+                % (self.files, self.brushes, self.polygons, self.holes, len(self.failed), len(self.errors),
+                   self.seconds))
+
+
+def vectorize(source, outPath, labelCategories, processes=None, chunksize=16, tolerance=DEFAULT_TOLERANCE,
+              minArea=0):
+    """
+        Trace the brushes of every annotation file in source (a directory or
+        a list of XML paths) across a process pool and stream them into a
+        JSON file as they arrive, in path order. Returns the stats.
+    """
+    labelCategories = tuple(tuple(c) for c in labelCategories)
+    paths = list_annotation_files(source)
+    start = time.time()
+    stats = VectorizeStats()
+    jobs = ((path, labelCategories, tolerance, minArea) for path in sorted(paths))
+
+    with open(outPath, 'w', encoding='utf-8') as out:
+        out.write('{"brushes": [')
+        pool = Pool(processes) if processes != 1 else None
+        try:
+            traced = pool.imap(vectorize_file, jobs, chunksize) if pool else map(vectorize_file, jobs)
+            for path, brushes, errors in traced:
+                stats.files += 1
+                if brushes is None:
+                    stats.errors.extend((path, error) for error in errors)
+                    continue
+                stats.failed.extend((path, error) for error in errors)
+                for brush in brushes:
+                    out.write((',' if stats.brushes else '') + json.dumps(brush))
+                    stats.brushes += 1
+                    stats.polygons += len(brush['polygons'])
+                    stats.holes += sum(len(rings) - 1 for rings in brush['polygons'])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        out.write(']}\n')
+
+    stats.seconds = time.time() - start
+    return stats
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Trace the brushes of annotation XML files into polygons')
+    parser.add_argument('source', type=str, help='directory of annotation XML files')
+    parser.add_argument('output', type=str, help='JSON file to write the polygons to')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='simplification tolerance in pixels, 0 keeps the exact pixel outline')
+    parser.add_argument('--min-area', type=float, default=0, help='drop components smaller than this many pixels')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    stats = vectorize(args.source, args.output, LABEL_CATEGORIES, processes=args.processes,
+                      tolerance=args.tolerance, minArea=args.min_area)
+    for path, error in stats.failed + stats.errors:
+        print('%s: %s' % (path, error), file=sys.stderr)
+    print(stats.summary(), file=sys.stderr)
+    return 1 if stats.failed or stats.errors else 0
@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocWriter
+
+
+class AnnotationSample(object):
+    """Mixin for test cases working in a temporary directory, with writeSample() writing test.xml there."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.xmlPath = os.path.join(self.tmpdir, 'test.xml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeSample(self, brushEncoding=None):
+        writer = PascalVocWriter('tests', 'test', (512, 512, 1), LABEL_CATEGORIES, localImgPath='tests/test.bmp')
+        writer.verified = True
+        if brushEncoding is not None:
+            writer.brushEncoding = brushEncoding
+        writer.addBndBox('object', 60, 40, 430, 504, 'person', [])
+        writer.addPolygon('object', [(1, 2), (30, 4), (15, 60)], 'face', ['occluded'])
+        history = [
+            ('addPoint', ((3, 4), 5, False)),
+            ('addLine', ((3, 4), (10, 12), 5, True)),
+        ]
+        writer.addBrush('suction_region', (512, 512), (7, 9), history, 'cup', [])
+        writer.save(self.xmlPath)
+        return history
@@ -0,0 +1,23 @@
+import random
+
+from libs.brush import Brush
+
+
+def randomHistory(width, height, count, seed=0):
+    random.seed(seed)
+    history = []
+    for i in range(count):
+        radius = random.randint(1, 12)
+        erasing = i % 5 == 4
+        p1 = (random.uniform(0, width), random.uniform(0, height))
+        if i % 3 == 0:
+            history.append(('addPoint', (p1, radius, erasing)))
+        else:
+            p2 = (p1[0] + random.uniform(-30, 30), p1[1] + random.uniform(-30, 30))
+            history.append(('addLine', (p1, p2, radius, erasing)))
+    return history
+
+
+class TiledBrush(Brush):
+    """Brush with every stroke going to tiled storage."""
+    tiledArea = 0
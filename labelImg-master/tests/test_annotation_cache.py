@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.annotationCache import AnnotationCache
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocReader, PascalVocWriter
+from libs.rle import crop_mask
+from annotation_samples import AnnotationSample
+
+
+class TestAnnotationCache(AnnotationSample, TestCase):
+
+    def test_annotation_cache(self):
+        self.writeSample()
+        sidecarDir = os.path.join(self.tmpdir, 'cache')
+        cache = AnnotationCache(sidecarDir=sidecarDir)
+        shapes, verified, header = cache.read(self.xmlPath, LABEL_CATEGORIES)
+        # The header as it was written, to compare with the one a save would write
+        self.assertEqual(header, ('tests', 'test', 'tests/test.bmp', (512, 512, 1)))
+        self.assertEqual(cache.read(self.xmlPath, LABEL_CATEGORIES), (shapes, verified, header))
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+
+        # A fresh cache finds the sidecar, a rewritten file misses again
+        other = AnnotationCache(sidecarDir=sidecarDir)
+        self.assertEqual(other.read(self.xmlPath, LABEL_CATEGORIES), (shapes, verified, header))
+        self.assertEqual((other.misses, other.sidecarHits), (0, 1))
+        with open(self.xmlPath, 'a') as f:
+            f.write('\n')
+        other.read(self.xmlPath, LABEL_CATEGORIES)
+        self.assertEqual(other.misses, 1)
+
+        tiny = AnnotationCache(maxBytes=1)
+        tiny.read(self.xmlPath, LABEL_CATEGORIES)
+        self.assertEqual(tiny.stats()['entries'], 0)
+
+    def test_annotation_cache_encoding(self):
+        writer = PascalVocWriter('tests', 'test', (512, 512, 1), LABEL_CATEGORIES, localImgPath='tests/test.bmp')
+        writer.addPolygon('object', [(1, 2), (30, 4), (15, 60)], 'face', ['occluded'])
+        mask = np.zeros((20, 30), dtype=bool)
+        mask[3:9, 4:25] = True
+        checkpoint = crop_mask(mask)
+        history = [('checkpoint', checkpoint), ('addLine', ((3, 4), (10, 12), 5, False))]
+        writer.addBrush('suction_region', (30, 20), (7, 9), history, 'cup', [], mask=crop_mask(mask))
+        writer.addBrush('suction_region', (30, 20), (0, 0), [], 'empty', [])
+        writer.save(self.xmlPath)
+
+        sidecarDir = os.path.join(self.tmpdir, 'cache')
+        AnnotationCache(sidecarDir=sidecarDir).read(self.xmlPath, LABEL_CATEGORIES)
+        cache = AnnotationCache(sidecarDir=sidecarDir)
+        shapes, verified, header = cache.read(self.xmlPath, LABEL_CATEGORIES)
+        self.assertEqual(cache.sidecarHits, 1)
+        # The same values, and types, as parsing the file
+        reader = PascalVocReader(self.xmlPath, LABEL_CATEGORIES)
+        np.testing.assert_equal(shapes, reader.getShapes())
+        self.assertEqual(repr(shapes), repr(reader.getShapes()))
+        self.assertEqual((verified, header), (reader.verified, reader.getHeader()))
+
+        # A versioned header followed by plain data, never a pickle
+        sidecar, = os.listdir(sidecarDir)
+        with open(os.path.join(sidecarDir, sidecar), 'rb') as f:
+            data = f.read()
+        self.assertTrue(data.startswith(b'LHAC3'))
+        self.assertNotIn(b'pickle', data)
+        # Sidecars of another version are parsed again
+        with open(os.path.join(sidecarDir, sidecar), 'wb') as f:
+            f.write(b'LHAC2' + data[5:])
+        stale = AnnotationCache(sidecarDir=sidecarDir)
+        self.assertEqual(stale.read(self.xmlPath, LABEL_CATEGORIES)[2], header)
+        self.assertEqual((stale.misses, stale.sidecarHits), (1, 0))
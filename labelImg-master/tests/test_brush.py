@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+import os
+import sys
+
+import numpy as np
+from PyQt5.QtCore import QPointF, QRect, QRectF, QSize
+from PyQt5.QtGui import QColor, QImage, QPainter
+from PyQt5.QtWidgets import QApplication
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.brush import Brush
+from libs.raster import replay_history
+from brush_samples import TiledBrush
+
+app = QApplication.instance() or QApplication([])
+
+
+class TestBrush(TestCase):
+
+    def test_cropped_storage(self):
+        size = QSize(4000, 3000)
+        brush = Brush(size)
+        brush.addPoint(QPointF(100, 200), 5, False)
+        brush.addLine(QPointF(100, 200), QPointF(160, 210), 5, False)
+        self.assertEqual(brush.dirtyRect(), QRectF(92, 192, 168 - 92, 218 - 192))
+        brush.close()
+        self.assertIsNone(brush.dirtyRect())
+        self.assertLess(brush._storage.nbytes, 100 * 100)
+        rect = brush.boundingRect()
+        self.assertEqual((rect.x(), rect.y(), rect.width(), rect.height()), (95, 195, 164 - 95, 214 - 195))
+        brush.moveBy(QPointF(0.5, -0.25))
+        self.assertEqual(brush.boundingRect(), QRectF(95.5, 194.75, 164 - 95, 214 - 195))
+        brush.moveBy(QPointF(-0.5, 0.25))
+        self.assertTrue(brush.containsPoint(QPointF(130, 205)))
+        self.assertFalse(brush.containsPoint(QPointF(130, 230)))
+        points = [QPointF(130, 205), QPointF(130, 230), QPointF(96, 199), QPointF(-5, 205), QPointF(5000, 205)]
+        self.assertEqual(brush.containsPoints(points).tolist(), [brush.containsPoint(point) for point in points])
+        self.assertEqual(brush.containsPoints(np.zeros((0, 2))).tolist(), [])
+
+        # Strokes far away grow the storage, erasing never does
+        brush.addLine(QPointF(3000, 2500), QPointF(3990, 2990), 20, False)
+        brush.addPoint(QPointF(10, 10), 8, True)
+        brush.close()
+        x, y, mask = brush.croppedMask()
+        self.assertEqual((x, y), (95, 195))
+        self.assertEqual(mask.shape, (3000 - 195, 4000 - 95))
+        expected = replay_history(brush.history, 3000, 4000)
+        np.testing.assert_array_equal(brush.get_unoccluded_mask(size).astype(bool), expected)
+
+    def test_paint(self):
+        size = QSize(200, 100)
+        for cls in (Brush, TiledBrush):
+            brush = cls(size, history=[('addLine', ((20, 50), (180, 50), 10, False))])
+            brush.close()
+            # Filled brushes also get an outline just outside the mask
+            brush.fill = True
+            image = QImage(size, QImage.Format_RGB32)
+            image.fill(QColor('white'))
+            p = QPainter(image)
+            # Only the exposed left half gets painted
+            p.setClipRect(QRect(0, 0, 100, 100))
+            brush.paint(p)
+            p.end()
+            self.assertNotEqual(image.pixelColor(50, 50), QColor('white'))
+            self.assertEqual(image.pixelColor(150, 50), QColor('white'))
+            self.assertNotEqual(image.pixelColor(50, 38), QColor('white'))
+            self.assertEqual(image.pixelColor(50, 36), QColor('white'))
+            self.assertEqual(image.pixelColor(50, 80), QColor('white'))
+            # Half transparent outline, then fill colour, over the white image
+            color = image.pixelColor(50, 50)
+            for channel, outline, fill in zip((color.red(), color.green(), color.blue()), (220, 220, 220), (0, 220, 0)):
+                self.assertAlmostEqual(channel, ((255 + outline) / 2 + fill) / 2, delta=2)
+
+            # Overlays are reused until the mask or the colour changes
+            overlays = dict(brush._overlays)
+            p = QPainter(image)
+            brush.paint(p)
+            self.assertEqual(brush._overlays, overlays)
+            brush.label = 'Rank2'
+            brush.paint(p)
+            p.end()
+            changed = [name for name in overlays if brush._overlays[name] != overlays[name]]
+            self.assertEqual({name for name, _ in changed}, {'mask'})
+
+            # Nothing is built for blocks an erase left empty, even mid-stroke
+            brush.addLine(QPointF(20, 50), QPointF(180, 50), 12, True)
+            overlays = dict(brush._overlays)
+            p = QPainter(image)
+            brush.paint(p)
+            p.end()
+            self.assertEqual(brush._overlays, overlays)
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+import os
+import sys
+import tracemalloc
+
+import numpy as np
+from PyQt5.QtCore import QPointF, QSize
+from PyQt5.QtWidgets import QApplication
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.brush import Brush
+from libs.brush_history import compact_history, simplify_polyline
+from libs.raster import replay_history
+from brush_samples import randomHistory, TiledBrush
+
+app = QApplication.instance() or QApplication([])
+
+
+class TestBrushHistory(TestCase):
+
+    def test_compacted_history(self):
+        width, height = 300, 200
+        history = randomHistory(width, height, 200, seed=2)
+        compacted = compact_history(history, width, height, checkpointInterval=16)
+        self.assertEqual(compacted[0][0], 'checkpoint')
+        self.assertLess(len(compacted), 16 + 1)
+        for cls in (Brush, TiledBrush):
+            brush = cls(QSize(width, height), history=compacted)
+            np.testing.assert_array_equal(brush.get_unoccluded_mask(QSize(width, height)).astype(bool),
+                                          replay_history(history, height, width))
+
+    def test_polyline(self):
+        points = [(0, 0), (5, 0.2), (10, 0), (10, 10), (10, 5)]
+        self.assertEqual(simplify_polyline(points, 0.5), [(0, 0), (10, 0), (10, 10), (10, 5)])
+        self.assertEqual(simplify_polyline(points[:1], 0.5), [(0, 0)])
+
+        # Polylines that continue one another are recorded as one
+        brush = Brush(QSize(100, 100))
+        brush.addPoint(QPointF(10, 10), 3, False)
+        brush.addPolyline([QPointF(10, 10), QPointF(20, 10)], 3, False)
+        brush.addPolyline([QPointF(20, 10), QPointF(20, 30), QPointF(40, 30)], 3, False)
+        brush.addPolyline([QPointF(40, 30), QPointF(40, 50)], 3, True)
+        self.assertEqual([hist_type for hist_type, _ in brush.history], ['addPoint', 'addPolyline', 'addPolyline'])
+        self.assertEqual(brush.history[1][1][0], [(10, 10), (20, 10), (20, 30), (40, 30)])
+        np.testing.assert_array_equal(brush.get_unoccluded_mask(QSize(100, 100)).astype(bool),
+                                      replay_history(brush.history, 100, 100))
+
+    def test_compact_huge_canvas(self):
+        # Small strokes on a canvas far too large to allocate
+        width = height = 100000
+        x0, y0 = 50000, 70000
+        history = []
+        for hist_type, hist_data in randomHistory(300, 200, 40, seed=6):
+            points = [(x + x0, y + y0) for x, y in hist_data[:-2]]
+            history.append((hist_type, tuple(points) + hist_data[-2:]))
+        tracemalloc.start()
+        try:
+            compacted = compact_history(history, width, height, checkpointInterval=16)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 16 * 1024 * 1024)
+        self.assertEqual(compacted[0][0], 'checkpoint')
+        self.assertLess(len(compacted), 16 + 1)
+
+        # Replayed around the strokes, it is the same mask
+        origin = (x0 - 50, y0 - 50)
+        np.testing.assert_array_equal(replay_history(compacted, 300, 400, origin=origin),
+                                      replay_history(history, 300, 400, origin=origin))
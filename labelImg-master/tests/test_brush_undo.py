@@ -0,0 +1,88 @@
+from unittest import TestCase
+
+import os
+import sys
+
+import numpy as np
+from PyQt5.QtCore import QPointF, QSize
+from PyQt5.QtWidgets import QApplication
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.brush import Brush
+from libs.brush_undo import BrushUndoStack
+from libs.canvas import Canvas
+from brush_samples import randomHistory, TiledBrush
+
+app = QApplication.instance() or QApplication([])
+
+
+class CursorlessCanvas(Canvas):
+    # Brush cursors are pixmaps of the scaled radius, not needed here
+    def _updateBrushCursors(self):
+        pass
+
+
+class TestBrushUndo(TestCase):
+
+    def test_stroke_undo(self):
+        size = QSize(300, 200)
+        for cls in (Brush, TiledBrush):
+            brush = cls(size, history=randomHistory(300, 200, 20, seed=4))
+            undo = BrushUndoStack()
+            states = [(brush.get_unoccluded_mask(size).copy(), list(brush.history))]
+            for i, points in enumerate([[(10, 10), (290, 190)], [(150, 20), (150, 180), (20, 100)], [(100, 100)]]):
+                brush.beginStroke()
+                brush.addPoint(QPointF(*points[0]), 6, i == 1)
+                brush.addPolyline([QPointF(*point) for point in points], 6, i == 1)
+                undo.push(brush.endStroke())
+                states.append((brush.get_unoccluded_mask(size).copy(), list(brush.history)))
+            for mask, history in states[-2::-1]:
+                undo.undo()
+                np.testing.assert_array_equal(brush.get_unoccluded_mask(size), mask)
+                self.assertEqual(brush.history, history)
+            self.assertIsNone(undo.undo())
+            for mask, history in states[1:]:
+                undo.redo()
+                np.testing.assert_array_equal(brush.get_unoccluded_mask(size), mask)
+                self.assertEqual(brush.history, history)
+
+            # The oldest strokes go once the budget is used up
+            undo.maxBytes = undo.nbytes - 1
+            brush.beginStroke()
+            brush.addPoint(QPointF(5, 5), 3, False)
+            undo.push(brush.endStroke())
+            self.assertLessEqual(undo.nbytes, undo.maxBytes)
+            self.assertTrue(undo.canUndo())
+
+    def test_history_in_budget(self):
+        brush = Brush(QSize(300, 200))
+        undo = BrushUndoStack()
+        brush.beginStroke()
+        brush.addPolyline([QPointF(10 + i % 2, 10) for i in range(2000)], 3, False)
+        undo.push(brush.endStroke())
+        stroke = undo.undo()
+        # Once undone the stroke holds the polyline, not only a few packed pixels
+        self.assertGreater(stroke.nbytes - stroke.packed.nbytes, 2000 * 2 * 8)
+        self.assertEqual(undo.nbytes, stroke.nbytes)
+        undo.redo()
+        self.assertEqual(undo.nbytes, stroke.nbytes)
+        self.assertLess(stroke.nbytes, 2000 * 2 * 8)
+
+    def test_cleared_on_load(self):
+        canvas = CursorlessCanvas()
+        brush = Brush(QSize(100, 100), history=[('addPoint', ((50, 50), 10, False))])
+        brush.close()
+        canvas.loadShapes({'object': [brush]})
+        canvas.selectedShape = brush
+        canvas.setMode(Canvas.EDIT_BRUSH)
+        brush.beginStroke()
+        brush.addPoint(QPointF(50, 50), 20, True)
+        canvas.brushUndo.push(brush.endStroke())
+        self.assertTrue(canvas.brushUndo.canUndo())
+        mask = brush.get_unoccluded_mask(QSize(100, 100)).copy()
+
+        # Another image, still in brush mode: the stroke belongs to a brush no longer shown
+        canvas.loadShapes({'object': []})
+        self.assertFalse(canvas.undoBrushStroke())
+        np.testing.assert_array_equal(brush.get_unoccluded_mask(QSize(100, 100)), mask)
+        self.assertEqual(canvas.brushUndo.nbytes, 0)
@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.bulk_reader import read_annotations, SHAPE_TYPES
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocWriter
+from annotation_samples import AnnotationSample
+
+
+class TestBulkReader(AnnotationSample, TestCase):
+
+    def test_bulk_reader(self):
+        self.writeSample()
+        broken = os.path.join(self.tmpdir, 'broken.xml')
+        with open(broken, 'w') as f:
+            f.write('<annotation><object>')
+        # Parses, but its pointless polygon has no bounding box
+        empty = os.path.join(self.tmpdir, 'empty.xml')
+        writer = PascalVocWriter('tests', 'empty', (100, 100, 3), LABEL_CATEGORIES)
+        writer.addBndBox('object', 1, 1, 5, 5, 'kept', [])
+        writer.addPolygon('object', [], 'pointless', [])
+        writer.save(empty)
+        for processes in (1, 2):
+            table = read_annotations(self.tmpdir, LABEL_CATEGORIES, processes=processes, chunksize=2)
+            self.assertEqual(len(table), 3)
+            self.assertEqual([p for p, _ in table.errors], [broken, empty])
+            self.assertIn('ValueError', table.errors[1][1])
+            self.assertEqual([table.labels[i] for i in table.label], ['person', 'face', 'cup'])
+            self.assertEqual([SHAPE_TYPES[t] for t in table.shape_type], ['rect', 'polygon', 'brush'])
+            self.assertEqual(table.category.tolist(), [0, 0, 1])
+            np.testing.assert_array_equal(table.objectVertices(1), [(1, 2), (30, 4), (15, 60)])
+            self.assertEqual(len(table.objectVertices(2)), 0)
+            np.testing.assert_array_equal(table.bbox[2], (7 + 3 - 5, 9 + 4 - 5, 7 + 3 + 5, 9 + 4 + 5))
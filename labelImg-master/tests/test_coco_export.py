@@ -0,0 +1,45 @@
+from unittest import TestCase
+
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.coco_export import export_coco
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocWriter
+from annotation_samples import AnnotationSample
+
+
+class TestCocoExport(AnnotationSample, TestCase):
+
+    def test_coco_export(self):
+        writer = PascalVocWriter('tests', 'test.bmp', (8, 6, 1), LABEL_CATEGORIES)
+        writer.addBndBox('object', 1, 1, 3, 4, 'box', [])
+        writer.addPolygon('object', [(0, 0), (4, 0), (4, 4), (0, 4)], 'square', [])
+        writer.addBrush('suction_region', (6, 8), (1, 0), [], 'cup', [], mask=(0, 2, np.ones((1, 2), dtype=bool)))
+        writer.addBrush('suction_region', (6, 8), (0, 0), [('addPoint', ((2, 5), 1, False))], 'dot', [])
+        writer.addBrush('suction_region', (8, 8), (4, 0), [], 'edge', [], mask=(0, 0, np.ones((2, 4), dtype=bool)))
+        writer.addBrush('suction_region', (-1, 8), (0, 0), [], 'broken', [])
+        writer.save(self.xmlPath)
+        outPath = os.path.join(self.tmpdir, 'coco.json')
+        stats = export_coco([self.xmlPath], outPath, LABEL_CATEGORIES, processes=1)
+        self.assertEqual((stats.images, stats.annotations, stats.errors), (1, 5, []))
+        # A shape that cannot be converted leaves the rest of its image in the export
+        self.assertEqual(len(stats.failed), 1)
+        self.assertIn("'broken'", stats.failed[0][1])
+        self.assertIn('1 failed', stats.summary())
+        with open(outPath) as f:
+            coco = json.load(f)
+        self.assertEqual(coco['images'][0]['width'], 6)
+        box, square, cup, dot, edge = coco['annotations']
+        # Only the part of a brush on the image counts
+        self.assertEqual((edge['bbox'], edge['area']), ([4, 0, 2, 2], 4))
+        self.assertEqual(box['bbox'], [1, 1, 2, 3])
+        self.assertEqual((square['bbox'], square['area']), ([0, 0, 4, 4], 16))
+        self.assertEqual((cup['bbox'], cup['category_id']), ([1, 2, 2, 1], 2))
+        # Column-major runs of 10 empty pixels, 1 set, 7 empty, 1 set, 29 empty
+        self.assertEqual(cup['segmentation']['counts'], ':170f0')
+        # Brushes without a stored mask are replayed from their history
+        self.assertEqual((dot['bbox'], dot['area']), ([1, 4, 3, 3], 5))
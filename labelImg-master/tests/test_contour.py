@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+import os
+import sys
+
+import numpy as np
+from shapely import contains_xy, union_all
+from PyQt5.QtCore import QSize
+from PyQt5.QtWidgets import QApplication
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.brush import Brush
+from libs.contour import mask_polygons
+
+app = QApplication.instance() or QApplication([])
+
+
+class TestContour(TestCase):
+
+    def test_polygons(self):
+        # Components, holes, islands in holes and pixels touching diagonally
+        mask = np.random.RandomState(3).rand(60, 80) < 0.5
+        polygons = mask_polygons(mask, 3, 4, tolerance=0)
+        self.assertTrue(all(polygon.is_valid for polygon in polygons))
+        self.assertEqual(sum(polygon.area for polygon in polygons), np.count_nonzero(mask))
+        ys, xs = np.nonzero(mask)
+        self.assertTrue(contains_xy(union_all(polygons), xs + 3.5, ys + 4.5).all())
+
+        brush = Brush(QSize(100, 100), history=[('addPoint', ((50, 50), 20, False)), ('addPoint', ((50, 50), 8, True))])
+        polygon, = brush.toPolygons(tolerance=1.0)
+        self.assertEqual(len(polygon.interiors), 1)
+        self.assertLess(len(polygon.exterior.coords), 60)
+        self.assertAlmostEqual(polygon.area, np.count_nonzero(brush.croppedMask()[2]), delta=0.05 * polygon.area)
@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs import corpusIndex
+from libs.corpusIndex import CorpusIndex
+from libs.pascal_voc_io import LABEL_CATEGORIES
+from annotation_samples import AnnotationSample
+
+
+class TestCorpusIndex(AnnotationSample, TestCase):
+
+    def test_corpus_index(self):
+        self.writeSample()
+        index = CorpusIndex(os.path.join(self.tmpdir, 'index', 'corpus.sqlite'), LABEL_CATEGORIES)
+        batches = []
+        self.assertEqual(index.refresh([self.tmpdir], progress=lambda *batch: batches.append(batch)), (1, 0))
+        self.assertEqual(batches, [([self.xmlPath], [])])
+        self.assertEqual(index.refresh([self.tmpdir]), (0, 0))
+        self.assertEqual(index.verifiedPaths(), {self.xmlPath})
+        self.assertEqual(index.pathsWithLabel('cup'), {self.xmlPath})
+        summary = index.summary(self.xmlPath)
+        self.assertEqual(summary['counts'], {'object': 2, 'suction_region': 1})
+        self.assertEqual(summary['labels'], {'person', 'face', 'cup'})
+        index.close()
+
+        # A reopened index only notices removed files
+        index = CorpusIndex(os.path.join(self.tmpdir, 'index', 'corpus.sqlite'), LABEL_CATEGORIES)
+        os.remove(self.xmlPath)
+        self.assertEqual(index.refresh([self.tmpdir], cancelled=lambda: True), (0, 1))
+        self.assertFalse(index.contains(self.xmlPath))
+        index.close()
+
+    def test_corpus_index_concurrent(self):
+        self.writeSample()
+        dbPath = os.path.join(self.tmpdir, 'index', 'corpus.sqlite')
+        index = CorpusIndex(dbPath, LABEL_CATEGORIES)
+        self.assertEqual(index._db.execute('PRAGMA journal_mode').fetchone(), ('wal',))
+        # Another connection, as the background refresh has, in the middle of a write
+        other = sqlite3.connect(dbPath, check_same_thread=False)
+        other.execute('BEGIN IMMEDIATE')
+        other.execute('DELETE FROM objects')
+        release = threading.Timer(0.3, other.commit)
+        release.start()
+        try:
+            # Reading does not wait, writing waits instead of failing
+            self.assertEqual(index.paths(), set())
+            index.update(self.xmlPath)
+        finally:
+            release.join()
+            other.close()
+        self.assertEqual(index.summary(self.xmlPath)['labels'], {'person', 'face', 'cup'})
+        index.close()
+
+    def test_corpus_index_batches(self):
+        self.writeSample()
+        for i in range(80):
+            shutil.copy(self.xmlPath, os.path.join(self.tmpdir, 'copy%02d.xml' % i))
+        index = CorpusIndex(':memory:', LABEL_CATEGORIES)
+        batches = []
+        batchSize, corpusIndex.BATCH_SIZE = corpusIndex.BATCH_SIZE, 32
+        try:
+            # Parsed in a spawned pool, committed batch by batch until cancelled
+            updated = index.refresh([self.tmpdir], progress=lambda paths, removed: batches.append(paths),
+                                    cancelled=lambda: len(batches) == 2)
+        finally:
+            corpusIndex.BATCH_SIZE = batchSize
+        self.assertEqual(updated, (64, 0))
+        self.assertEqual([len(paths) for paths in batches], [32, 32])
+        self.assertEqual(index.paths(), set(batches[0] + batches[1]))
+        # The next refresh picks up where the cancelled one stopped
+        self.assertEqual(index.refresh([self.tmpdir]), (17, 0))
+        index.close()
@@ -0,0 +1,99 @@
+from unittest import TestCase
+
+import os
+import shutil
+import sys
+import tempfile
+
+from PyQt5.QtGui import QColor, QImage, qRgb
+from PyQt5.QtWidgets import QApplication
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.imageMetadata import ImageMetadataProvider
+
+app = QApplication.instance() or QApplication([])
+
+
+def indexedImage(width, height, colorTable):
+    image = QImage(width, height, QImage.Format_Indexed8)
+    image.setColorTable(colorTable)
+    for y in range(height):
+        for x in range(width):
+            image.setPixel(x, y, (x + y) % len(colorTable))
+    return image
+
+
+class ScannedImage(QImage):
+    scans = 0
+
+    def isGrayscale(self):
+        self.scans += 1
+        return super(ScannedImage, self).isGrayscale()
+
+
+class TestImageMetadata(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def save(self, image, name):
+        path = os.path.join(self.tmpdir, name)
+        self.assertTrue(image.save(path))
+        return path
+
+    def test_probe_matches_decoded_image(self):
+        rgb = QImage(40, 30, QImage.Format_RGB32)
+        rgb.fill(QColor(200, 30, 10))
+        grayscale = QImage(41, 31, QImage.Format_Grayscale8)
+        grayscale.fill(QColor(90, 90, 90))
+        mono = QImage(42, 32, QImage.Format_Mono)
+        mono.fill(1)
+        images = {
+            'rgb.png': rgb,
+            'rgb.bmp': rgb,
+            'grayscale.png': grayscale,
+            'mono.png': mono,
+            'grey_indexed.png': indexedImage(43, 33, [qRgb(v, v, v) for v in range(0, 256, 64)]),
+            'grey_indexed.bmp': indexedImage(44, 34, [qRgb(v, v, v) for v in range(0, 256, 64)]),
+            'color_indexed.png': indexedImage(45, 35, [qRgb(255, 0, 0), qRgb(0, 0, 255)]),
+        }
+        depths = set()
+        for name, image in images.items():
+            path = self.save(image, name)
+            decoded = QImage()
+            self.assertTrue(decoded.load(path))
+            expected = [decoded.height(), decoded.width(), 1 if decoded.isGrayscale() else 3]
+            self.assertEqual(ImageMetadataProvider().imageShape(path), expected, name)
+            # And the same from the decoded image the caller already has
+            self.assertEqual(ImageMetadataProvider().imageShape(path, decoded), expected, name)
+            depths.add(expected[2])
+        self.assertEqual(depths, {1, 3})
+
+    def test_cache_follows_mtime(self):
+        path = self.save(QImage(20, 10, QImage.Format_RGB32), 'image.png')
+        metadata = ImageMetadataProvider()
+        self.assertEqual(metadata.imageShape(path), [10, 20, 3])
+
+        # Rewritten with the same mtime, the cached shape is still used
+        mtime = os.stat(path).st_mtime_ns
+        grayscale = QImage(25, 15, QImage.Format_Grayscale8)
+        grayscale.fill(0)
+        self.save(grayscale, 'image.png')
+        os.utime(path, ns=(mtime, mtime))
+        self.assertEqual(metadata.imageShape(path), [10, 20, 3])
+
+        # A new mtime reads the header again
+        os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+        self.assertEqual(metadata.imageShape(path), [15, 25, 1])
+
+        # A decoded image is only scanned on a miss
+        image = ScannedImage(25, 15, QImage.Format_RGB32)
+        self.assertEqual(metadata.imageShape(path, image), [15, 25, 1])
+        self.assertEqual(image.scans, 0)
+        metadata.clear()
+        self.assertEqual(metadata.imageShape(path, image), [15, 25, 3])
+        self.assertEqual(metadata.imageShape(path, image), [15, 25, 3])
+        self.assertEqual(image.scans, 1)
@@ -1,20 +1,128 @@
-
 from unittest import TestCase
 
-import sys
 import os
-dir_name = os.path.abspath(os.path.dirname(__file__))
-libs_path = os.path.join(dir_name, '..', 'libs')
-sys.path.insert(0, libs_path)
-from pascal_voc_io import PascalVocWriter
-from pascal_voc_io import PascalVocReader
-
-# Test Write/Read
-writer = PascalVocWriter('tests', 'test', (512, 512, 1), localImgPath='tests/test.bmp')
-difficult = 1
-writer.addBndBox(60, 40, 430, 504, 'person', difficult)
-writer.addBndBox(113, 40, 450, 403, 'face', difficult)
-writer.save('tests/test.xml')
-
-reader = PascalVocReader('tests/test.xml')
-shapes = reader.getShapes()
+import sys
+
+import numpy as np
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.brush_history import compact_history
+from libs.bulk_reader import brush_bbox
+from libs.pascal_voc_io import BRUSH_ENCODING_PACKED, BRUSH_ENCODING_VERBOSE, LABEL_CATEGORIES
+from libs.pascal_voc_io import PascalVocReader, PascalVocWriter
+from libs.raster import replay_history
+from libs.rle import crop_mask
+from annotation_samples import AnnotationSample
+
+
+class TestPascalVocIO(AnnotationSample, TestCase):
+
+    def test_roundtrip(self):
+        history = self.writeSample()
+        reader = PascalVocReader(self.xmlPath, LABEL_CATEGORIES)
+        shapes = reader.getShapes()
+        self.assertTrue(reader.verified)
+        self.assertEqual(shapes['object'][0], ('person', [], [(60, 40), (430, 40), (430, 504), (60, 504)], 'rect'))
+        self.assertEqual(shapes['object'][1], ('face', ['occluded'], [(1, 2), (30, 4), (15, 60)], 'polygon'))
+        label, attributes, (size, offset, readHistory, mask), typ = shapes['suction_region'][0]
+        self.assertEqual((label, typ, size, offset), ('cup', 'brush', (512, 512), (7, 9)))
+        self.assertEqual(readHistory, history)
+        self.assertIsNone(mask)
+
+    def test_packed_brush_history(self):
+        history = self.writeSample(BRUSH_ENCODING_PACKED)
+        history.append(('addPoint', ((70000, 2), 3, False)))
+        shapes = PascalVocReader(self.xmlPath, LABEL_CATEGORIES).getShapes()
+        self.assertEqual(shapes['suction_region'][0][2][2], history[:2])
+
+        writer = PascalVocWriter('tests', 'test', (512, 512, 1), LABEL_CATEGORIES)
+        writer.brushEncoding = BRUSH_ENCODING_PACKED
+        writer.addBrush('object', (512, 512), (0, 0), history, 'wide', [])
+        writer.save(self.xmlPath)
+        shapes = PascalVocReader(self.xmlPath, LABEL_CATEGORIES).getShapes()
+        self.assertEqual(shapes['object'][0][2][2], history)
+
+    def test_compacted_brush_history(self):
+        history = [('addLine', ((10, 10), (20, 10), 3, False)),
+                   ('addLine', ((20, 10), (20, 30), 3, False)),
+                   ('addLine', ((20, 30), (40, 30), 3, False)),
+                   ('addPoint', ((60, 60), 4, False)),
+                   ('addPoint', ((60, 60), 6, True)),
+                   ('addPoint', ((15, 10), 2, False))]
+        expected = replay_history(history, 100, 100)
+        compacted = compact_history(history, 100, 100, checkpointInterval=None)
+        self.assertEqual(compacted, [('addPolyline', ([(10, 10), (20, 10), (20, 30), (40, 30)], 3, False))])
+        # Short histories are left alone until a checkpoint is due
+        self.assertEqual(compact_history(history, 100, 100, checkpointInterval=16), history)
+
+        history = history * 3 + [('addLine', ((0, 90), (30, 90), 2, False))]
+        expected = replay_history(history, 100, 100)
+        for encoding in (BRUSH_ENCODING_VERBOSE, BRUSH_ENCODING_PACKED):
+            writer = PascalVocWriter('tests', 'test', (100, 100, 1), LABEL_CATEGORIES)
+            writer.brushEncoding = encoding
+            writer.compactBrushHistory = True
+            writer.brushCheckpointInterval = 2
+            writer.addBrush('object', (100, 100), (0, 0), history, 'compacted', [])
+            writer.save(self.xmlPath)
+            readHistory = PascalVocReader(self.xmlPath, LABEL_CATEGORIES).getShapes()['object'][0][2][2]
+            # The polyline and the last line are folded into the checkpoint
+            self.assertEqual([hist_type for hist_type, _ in readHistory], ['checkpoint'])
+            np.testing.assert_array_equal(replay_history(readHistory, 100, 100), expected)
+            self.assertEqual(brush_bbox((0, 0), readHistory, None), (0, 7, 42, 91))
+
+        # A checkpoint equal to the stored mask refers to it
+        writer = PascalVocWriter('tests', 'test', (100, 100, 1), LABEL_CATEGORIES)
+        writer.compactBrushHistory = True
+        writer.brushCheckpointInterval = 2
+        writer.addBrush('object', (100, 100), (0, 0), history, 'masked', [], mask=crop_mask(expected))
+        writer.save(self.xmlPath)
+        checkpoint = etree.parse(self.xmlPath).find('object/brush/checkpoint')
+        self.assertEqual((dict(checkpoint.attrib), checkpoint.text), ({'source': 'mask'}, None))
+        (_, readCheckpoint), = PascalVocReader(self.xmlPath, LABEL_CATEGORIES).getShapes()['object'][0][2][2]
+        np.testing.assert_array_equal(replay_history([('checkpoint', readCheckpoint)], 100, 100), expected)
+
+    def test_missing_depth(self):
+        writer = PascalVocWriter('tests', 'test', (512, 256), LABEL_CATEGORIES, localImgPath='tests/test.bmp')
+        writer.save(self.xmlPath)
+        tree = etree.parse(self.xmlPath)
+        depth = tree.find('size/depth')
+        self.assertEqual(depth.text, '1')
+        # Files without a depth read back with the depth the writer defaults to
+        depth.getparent().remove(depth)
+        tree.write(self.xmlPath)
+        self.assertEqual(PascalVocReader(self.xmlPath, LABEL_CATEGORIES).getHeader(), writer.getHeader())
+
+    def test_brush_mask(self):
+        cropped = np.zeros((4, 6), dtype=bool)
+        cropped[0, 1:] = True
+        cropped[3, 0] = True
+        writer = PascalVocWriter('tests', 'test', (512, 512, 1), LABEL_CATEGORIES)
+        writer.addBrush('object', (512, 512), (0, 0), [], 'masked', [], mask=(10, 20, cropped))
+        writer.save(self.xmlPath)
+        shapes = PascalVocReader(self.xmlPath, LABEL_CATEGORIES).getShapes()
+        x, y, readMask = shapes['object'][0][2][3]
+        self.assertEqual((x, y), (10, 20))
+        np.testing.assert_array_equal(readMask, cropped)
+
+    def test_empty_file(self):
+        open(self.xmlPath, 'w').write('  \n')
+        reader = PascalVocReader(self.xmlPath, LABEL_CATEGORIES)
+        self.assertEqual(dict(reader.getShapes()), {})
+        self.assertFalse(reader.verified)
+
+        # Corrupt files are errors, not empty annotations
+        for content in (b'\x00\x01binary', b'<?xml version="1.0" encoding="bogus"?>', b'<annotation><obj'):
+            with open(self.xmlPath, 'wb') as f:
+                f.write(content)
+            with self.assertRaises(Exception):
+                PascalVocReader(self.xmlPath, LABEL_CATEGORIES)
+
+    def test_text_is_preserved(self):
+        writer = PascalVocWriter('tests', 'test', (512, 512, 3), LABEL_CATEGORIES)
+        writer.addBndBox('object', 1, 2, 3, 4, 'two  spaces', ['side  view'])
+        writer.save(self.xmlPath)
+        shapes = PascalVocReader(self.xmlPath, LABEL_CATEGORIES).getShapes()
+        self.assertEqual(shapes['object'][0][:2], ('two  spaces', ['side  view']))
+        with open(self.xmlPath, 'rb') as f:
+            self.assertTrue(f.read().startswith(b'<annotation>\n\t<folder>tests</folder>\n'))
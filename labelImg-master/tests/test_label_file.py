@@ -0,0 +1,32 @@
+from unittest import TestCase
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.labelFile import LabelFile
+from libs.pascal_voc_io import LABEL_CATEGORIES
+from annotation_samples import AnnotationSample
+
+
+class TestLabelFile(AnnotationSample, TestCase):
+
+    def test_shapes_digest(self):
+        def shapes(label='cat', mask=np.ones((2, 3), dtype=bool)):
+            return {
+                'object': [dict(type='rect', label=label, attributes=['a'], points=[(1, 2), (3, 2), (3, 4), (1, 4)])],
+                'suction_region': [dict(type='brush', label='b', attributes=[], size=(8, 8), offset=(0, 0),
+                                        history=[], mask=(1, 1, mask))],
+            }
+        digest = LabelFile.shapesDigest(shapes(), LABEL_CATEGORIES)
+        self.assertEqual(digest, LabelFile.shapesDigest(shapes(), LABEL_CATEGORIES))
+        self.assertNotEqual(digest, LabelFile.shapesDigest(shapes(), LABEL_CATEGORIES, verified=True))
+        header = ('tests', 'test.bmp', 'tests/test.bmp', (512, 512, 1))
+        self.assertNotEqual(LabelFile.shapesDigest(shapes(), LABEL_CATEGORIES, header=header),
+                            LabelFile.shapesDigest(shapes(), LABEL_CATEGORIES, header=header[:3] + ((256, 512, 1),)))
+        self.assertNotEqual(digest, LabelFile.shapesDigest(shapes(label='dog'), LABEL_CATEGORIES))
+        mask = np.ones((2, 3), dtype=bool)
+        mask[1, 2] = False
+        self.assertNotEqual(digest, LabelFile.shapesDigest(shapes(mask=mask), LABEL_CATEGORIES))
@@ -0,0 +1,51 @@
+from unittest import TestCase
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.mask_storage import CroppedMask, TiledMask
+from libs.raster import dilate_mask
+from brush_samples import randomHistory
+
+
+class TestMaskStorage(TestCase):
+
+    def test_tiled_storage(self):
+        width, height = 300, 200
+        history = randomHistory(width, height, 80, seed=1)
+        cropped, tiled = CroppedMask(width, height), TiledMask(width, height)
+        tiled.tileSize = 64
+        for storage in (cropped, tiled):
+            for hist_type, hist_data in history:
+                if hist_type == 'addPoint':
+                    storage.stampDisc(hist_data[0], hist_data[1], not hist_data[2])
+                else:
+                    storage.stampCapsule(hist_data[0], hist_data[1], hist_data[2], not hist_data[3])
+        np.testing.assert_array_equal(tiled.full(), cropped.full())
+        self.assertEqual(tiled.bbox(), cropped.bbox())
+        x, y, mask = tiled.crop()
+        self.assertEqual((x, y), cropped.crop()[:2])
+        np.testing.assert_array_equal(mask, cropped.crop()[2])
+        ys, xs = np.nonzero(cropped.full())
+        self.assertEqual(cropped.bbox(), (xs.min(), ys.min(), xs.max() + 1, ys.max() + 1))
+        self.assertTrue(all(tiled.contains(int(px), int(py)) for px, py in zip(xs[::50], ys[::50])))
+        qx, qy = np.random.RandomState(5).randint(-20, 320, size=(2, 500))
+        expected = [cropped.contains(int(px), int(py)) for px, py in zip(qx, qy)]
+        for storage in (cropped, tiled):
+            self.assertEqual(storage.containsPoints(qx, qy).tolist(), expected)
+
+        # Outlines are the dilated mask, however it is split into blocks
+        expected = dilate_mask(cropped.full(), 2)[2:-2, 2:-2]
+        for storage in (cropped, tiled):
+            outline = np.zeros_like(expected)
+            for key, ox, oy in storage.outlineBlocks(2):
+                block = storage.outline(key, 2)
+                outline[oy:oy + block.shape[0], ox:ox + block.shape[1]] |= block
+            np.testing.assert_array_equal(outline, expected)
+
+        # Erasing everything releases every tile
+        tiled.stampCapsule((0, 100), (300, 100), 200, False)
+        self.assertEqual((tiled.nbytes, tiled.bbox()), (0, None))
@@ -0,0 +1,80 @@
+from unittest import TestCase
+
+import os
+import random
+import sys
+
+import numpy as np
+from shapely import union_all
+from PyQt5.QtCore import QPointF, QSize
+from PyQt5.QtWidgets import QApplication
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.occlusion import OcclusionGraph
+from libs.polygon import Polygon
+
+app = QApplication.instance() or QApplication([])
+
+
+def randomPolygons(count, seed=0):
+    random.seed(seed)
+    polygons = []
+    for _ in range(count):
+        x, y = random.uniform(0, 1000), random.uniform(0, 1000)
+        polygon = Polygon()
+        for dx, dy in [(0, 0), (60, 10), (70, 80), (-10, 50)]:
+            polygon.addPoint(QPointF(x + dx * random.uniform(0.5, 1.5), y + dy * random.uniform(0.5, 1.5)))
+        polygon.close()
+        polygons.append(polygon)
+    return polygons
+
+
+def visibleArea(geom_points):
+    return sum(geom.area for geom, _ in geom_points)
+
+
+class TestOcclusion(TestCase):
+
+    def assertMatchesFullCut(self, graph, polygons):
+        geoms = [Polygon.get_shapely_polygon(polygon.get_points_tuple()) for polygon in polygons]
+        for i, polygon in enumerate(polygons):
+            expected = geoms[i].difference(union_all(geoms[:i])).area
+            self.assertAlmostEqual(visibleArea(graph.visible(polygon)), expected, places=6)
+            # The same cut without a graph, as painting with prev_shapes does
+            near = Polygon.overlapping_points(polygon.get_points_tuple(),
+                                              tuple(prev.get_points_tuple() for prev in polygons[:i]))
+            self.assertEqual(near, tuple(occluder.get_points_tuple() for occluder in graph._occluders[polygon]))
+            cut = Polygon.self_poly_geom_points(polygon.get_points_tuple(), near)
+            self.assertAlmostEqual(visibleArea(cut), expected, places=6)
+
+    def test_incremental_updates(self):
+        polygons = randomPolygons(150)
+        graph = OcclusionGraph()
+        graph.update(polygons)
+        self.assertMatchesFullCut(graph, polygons)
+
+        # Moving one polygon only recomputes the polygons it covers
+        moved = polygons[40]
+        before = {polygon: graph.visible(polygon) for polygon in polygons}
+        moved.moveBy(QPointF(35, -20))
+        graph.update(polygons)
+        recomputed = [polygon for polygon in polygons if graph.visible(polygon) is not before[polygon]]
+        self.assertIn(moved, recomputed)
+        self.assertLess(len(recomputed), 20)
+        self.assertTrue(all(polygons.index(polygon) >= 40 for polygon in recomputed))
+        self.assertMatchesFullCut(graph, polygons)
+
+        # Reordering and removing polygons
+        polygons = polygons[::-1][:100]
+        graph.update(polygons)
+        self.assertMatchesFullCut(graph, polygons)
+
+    def test_unoccluded_mask_window(self):
+        polygon, = randomPolygons(1)
+        full = polygon.get_unoccluded_mask(QSize(1200, 1200))
+        x0, y0, x1, y1 = (int(v) for v in polygon.boundingRect().getCoords())
+        window = (x0 - 2, y0 - 2, x1 + 3, y1 + 3)
+        np.testing.assert_array_equal(polygon.get_unoccluded_mask(QSize(1200, 1200), window),
+                                      full[window[1]:window[3], window[0]:window[2]])
+        self.assertEqual(np.count_nonzero(polygon.get_unoccluded_mask(QSize(1200, 1200), window)),
+                         np.count_nonzero(full))
@@ -0,0 +1,59 @@
+from unittest import TestCase
+
+import os
+import sys
+
+import numpy as np
+from PyQt5.QtCore import QPointF, QSize, Qt
+from PyQt5.QtGui import QBitmap, QImage, QPainter, QPen
+from PyQt5.QtWidgets import QApplication
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.brush import Brush
+from libs.raster import replay_history
+from brush_samples import randomHistory
+
+app = QApplication.instance() or QApplication([])
+
+
+def qtMask(width, height, history):
+    """Paint history the way brushes used to, with QPainter on a QBitmap."""
+    bitmap = QBitmap(width, height)
+    bitmap.clear()
+    p = QPainter(bitmap)
+    for hist_type, hist_data in history:
+        color = Qt.color0 if hist_data[-1] else Qt.color1
+        radius = hist_data[-2]
+        if hist_type == 'addPoint':
+            p.setPen(color)
+            p.setBrush(color)
+            p.drawEllipse(QPointF(*hist_data[0]), radius, radius)
+        else:
+            pen = QPen(color)
+            pen.setWidth(radius * 2)
+            pen.setCapStyle(Qt.RoundCap)
+            p.setPen(pen)
+            p.drawLine(QPointF(*hist_data[0]), QPointF(*hist_data[1]))
+    p.end()
+    image = bitmap.toImage().convertToFormat(QImage.Format_Indexed8)
+    ptr = image.constBits()
+    ptr.setsize(image.byteCount())
+    return np.frombuffer(ptr, dtype=np.uint8).reshape(height, image.bytesPerLine())[:, :width] > 0
+
+
+class TestRaster(TestCase):
+
+    def test_numpy_replay_matches_qt(self):
+        width, height = 160, 120
+        history = randomHistory(width, height, 60)
+        expected = qtMask(width, height, history)
+        actual = replay_history(history, height, width)
+        # Only edge pixels of the stamped discs may differ
+        self.assertLess(np.count_nonzero(actual != expected), 0.03 * np.count_nonzero(expected))
+
+        brush = Brush(QSize(width, height), history=history)
+        np.testing.assert_array_equal(brush.get_unoccluded_mask(QSize(width, height)).astype(bool), actual)
+        # or only the part asked for
+        window = (30, 20, 110, 90)
+        np.testing.assert_array_equal(brush.get_unoccluded_mask(QSize(width, height), window).astype(bool),
+                                      actual[20:90, 30:110])
@@ -0,0 +1,100 @@
+from unittest import TestCase
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from lxml import etree
+from PyQt5.QtCore import Qt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import libs.pascal_voc_io as pascal_voc_io
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocWriter
+from libs.saveWorker import SaveWorker
+
+
+class TestSaveWorker(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.worker = SaveWorker()
+        self.saved, self.failed = [], []
+        # Record straight from the worker thread, there is no event loop here
+        self.worker.saved.connect(self.saved.append, Qt.DirectConnection)
+        self.worker.failed.connect(lambda path, message: self.failed.append((path, message)), Qt.DirectConnection)
+
+    def tearDown(self):
+        self.worker.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def blockWorker(self):
+        """Keep the worker busy until the returned event is set."""
+        started, release = threading.Event(), threading.Event()
+
+        def job(path):
+            started.set()
+            release.wait(5)
+        self.worker.submit(os.path.join(self.tmpdir, 'busy'), job)
+        started.wait(5)
+        return release
+
+    def test_coalescing(self):
+        written = []
+        release = self.blockWorker()
+        for version in range(5):
+            self.worker.submit('a.xml', lambda path, version=version: written.append((path, version)))
+        self.worker.submit('b.xml', lambda path: written.append((path, 0)))
+        self.assertTrue(self.worker.isPending('a.xml'))
+        release.set()
+        self.worker.wait()
+        # Only the latest snapshot of a.xml, and in the order paths were first queued
+        self.assertEqual(written, [('a.xml', 4), ('b.xml', 0)])
+        self.assertFalse(self.worker.isPending())
+
+    def test_atomic_write(self):
+        target = os.path.join(self.tmpdir, 'test.xml')
+        with open(target, 'w') as f:
+            f.write('previous')
+        replaced = []
+        replace = os.replace
+
+        def checkedReplace(src, dst):
+            # The temporary file is complete before it takes the target's place
+            self.assertEqual(etree.parse(src).findtext('object/name'), 'person')
+            with open(dst) as f:
+                self.assertEqual(f.read(), 'previous')
+            replaced.append((src, dst))
+            replace(src, dst)
+
+        writer = PascalVocWriter('tests', 'test', (512, 512, 1), LABEL_CATEGORIES)
+        writer.addBndBox('object', 60, 40, 430, 504, 'person', [])
+        pascal_voc_io.os.replace = checkedReplace
+        try:
+            self.worker.submit(target, writer.save)
+            self.worker.wait()
+        finally:
+            pascal_voc_io.os.replace = replace
+        self.assertEqual(self.failed, [])
+        self.assertEqual(replaced, [(target + '.tmp', target)])
+        self.assertEqual(self.saved, [target])
+        self.assertEqual(os.listdir(self.tmpdir), ['test.xml'])
+
+    def test_failure(self):
+        target = os.path.join(self.tmpdir, 'missing', 'test.xml')
+        writer = PascalVocWriter('tests', 'test', (512, 512, 1), LABEL_CATEGORIES)
+        writer.addBndBox('object', 60, 40, 430, 504, 'person', [])
+        self.worker.submit(target, writer.save)
+        self.worker.wait()
+        self.assertEqual([path for path, _ in self.failed], [target])
+        self.assertEqual(self.saved, [])
+
+        # The failed snapshot is kept and can be written once the problem is fixed
+        self.assertEqual(self.worker.failedPaths(), [target])
+        os.mkdir(os.path.dirname(target))
+        self.assertTrue(self.worker.retry(target))
+        self.worker.wait()
+        self.assertEqual(self.saved, [target])
+        self.assertEqual(self.worker.failedPaths(), [])
+        self.assertFalse(self.worker.retry(target))
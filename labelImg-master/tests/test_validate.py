@@ -0,0 +1,36 @@
+from unittest import TestCase
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocWriter
+from libs.validate import validate
+from annotation_samples import AnnotationSample
+
+
+class TestValidate(AnnotationSample, TestCase):
+
+    def test_validate(self):
+        self.writeSample()
+        writer = PascalVocWriter('tests', 'bad', (100, 100, 3), LABEL_CATEGORIES)
+        writer.addBndBox('object', 10, 10, 120, 50, 'person', [])
+        writer.addPolygon('object', [(0, 0), (10, 10), (10, 0), (0, 10)], 'bowtie', [])
+        writer.addBrush('suction_region', (-1, 8), (0, 0), [], 'broken', [])
+        writer.save(os.path.join(self.tmpdir, 'bad.xml'))
+        # A stroke whose radius reaches past the edge only paints up to it
+        writer = PascalVocWriter('tests', 'edge', (100, 100, 3), LABEL_CATEGORIES)
+        writer.addBrush('suction_region', (100, 100), (0, 0), [('addPoint', ((98, 50), 5, False))], 'edge', [])
+        writer.save(os.path.join(self.tmpdir, 'edge.xml'))
+        with open(os.path.join(self.tmpdir, 'broken.xml'), 'w') as f:
+            f.write('<annotation><object><name>x</name></object></annotation>')
+
+        report = validate(self.tmpdir, LABEL_CATEGORIES, processes=1)
+        self.assertEqual(sorted(os.path.basename(p) for p in report.problems), ['bad.xml', 'broken.xml'])
+        bad = report.problems[os.path.join(self.tmpdir, 'bad.xml')]
+        self.assertEqual(len(bad), 3)
+        self.assertIn('out of bounds', bad[0])
+        self.assertIn('invalid polygon', bad[1])
+        self.assertIn("'broken'): malformed", bad[2])
+        self.assertIn('malformed', report.problems[os.path.join(self.tmpdir, 'broken.xml')][0])
+        self.assertEqual(len(report.seconds), 4)
@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.pascal_voc_io import LABEL_CATEGORIES, PascalVocWriter
+from libs.vectorize import vectorize
+from annotation_samples import AnnotationSample
+
+
+class TestVectorize(AnnotationSample, TestCase):
+
+    def test_vectorize(self):
+        ring = np.ones((6, 6), dtype=bool)
+        ring[2:4, 2:4] = False
+        writer = PascalVocWriter('tests', 'test.bmp', (20, 20, 1), LABEL_CATEGORIES)
+        writer.addBrush('suction_region', (20, 20), (1, 0), [], 'ring', ['a'], mask=(3, 4, ring))
+        writer.addBrush('suction_region', (20, 20), (0, 0), [], 'empty', [], mask=(0, 0, np.zeros((0, 0), dtype=bool)))
+        writer.addBrush('suction_region', (-1, 8), (0, 0), [], 'broken', [])
+        writer.addPolygon('object', [(0, 0), (4, 0), (4, 4)], 'triangle', [])
+        writer.save(self.xmlPath)
+        broken = os.path.join(self.tmpdir, 'broken.xml')
+        with open(broken, 'w') as f:
+            f.write('<annotation><object>')
+        outPath = os.path.join(self.tmpdir, 'brushes.json')
+        stats = vectorize(self.tmpdir, outPath, LABEL_CATEGORIES, processes=1, tolerance=0)
+        self.assertEqual((stats.files, stats.brushes, stats.polygons, stats.holes), (2, 2, 1, 1))
+        # A brush or file that cannot be traced leaves the rest in the output
+        self.assertEqual([path for path, _ in stats.errors], [broken])
+        self.assertEqual(len(stats.failed), 1)
+        self.assertIn("'broken'", stats.failed[0][1])
+        with open(outPath) as f:
+            brushes = json.load(f)['brushes']
+        self.assertEqual((brushes[0]['label'], brushes[0]['attributes'], brushes[1]['polygons']), ('ring', ['a'], []))
+        (exterior, hole), = brushes[0]['polygons']
+        self.assertEqual(sorted(map(tuple, exterior)), [(4, 4), (4, 10), (10, 4), (10, 10)])
+        self.assertEqual(sorted(map(tuple, hole)), [(6, 6), (6, 8), (8, 6), (8, 8)])
@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+import sys
+
+from libs.validate import main
+
+if __name__ == "__main__":
+    sys.exit(main())